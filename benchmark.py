@@ -0,0 +1,266 @@
+"""
+Throughput benchmarks for message handling, without a radio.
+
+A FakeInterface stands in for the Meshtastic interface: it has a node
+database and myInfo, and records every frame passed to sendText. Synthetic
+workloads are fed through on_receive exactly as packets from the radio
+would be, against a scratch database in a temporary directory, and each run
+reports commands/sec, p50/p99 latency, frames emitted and database calls.
+
+    python benchmark.py                      # every workload
+    python benchmark.py menus mail --users 200 --rounds 10
+    python benchmark.py --json results.json  # also save the results
+
+Workloads:
+    menus   users browsing the main, BBS and utilities menus
+    mail    users sending each other mail with SM,, and checking it with CM
+    sync    a peer BBS flooding bulletins and mail, a quarter of them repeats
+    nodes   the mail workload against a large node database
+
+The pause after each sent packet is skipped, so the numbers measure the
+BBS itself rather than the radio.
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+MY_NODE_NUM = 1
+PEER_NODE_NUM = 2
+FIRST_USER_NUM = 0x1000
+
+
+class FakePacket:
+    __slots__ = ('id',)
+
+    def __init__(self, packet_id):
+        self.id = packet_id
+
+
+class FakeMyInfo:
+    def __init__(self, my_node_num):
+        self.my_node_num = my_node_num
+
+
+class FakeInterface:
+    """Just enough of a Meshtastic interface for the BBS, recording frames instead of sending them."""
+
+    def __init__(self, node_count, bbs_nodes=(), my_node_num=MY_NODE_NUM):
+        self.myInfo = FakeMyInfo(my_node_num)
+        self.nodes = {}
+        for num in [my_node_num, PEER_NODE_NUM] + list(range(FIRST_USER_NUM, FIRST_USER_NUM + node_count)):
+            self.add_node(num)
+        self.bbs_nodes = list(bbs_nodes)
+        self.allowed_nodes = []
+        self.frames = []
+        self.bytes = 0
+        self._lock = threading.Lock()
+
+    def add_node(self, num):
+        node_id = node_id_for(num)
+        self.nodes[node_id] = {
+            'num': num,
+            'user': {'id': node_id, 'shortName': short_name_for(num), 'longName': f"Bench {num:x}"}
+        }
+
+    def sendText(self, text, destinationId=None, wantAck=False, wantResponse=False, **kwargs):
+        with self._lock:
+            self.frames.append((destinationId, text))
+            self.bytes += len(text.encode('utf-8'))
+            return FakePacket(len(self.frames))
+
+    def close(self):
+        pass
+
+
+def node_id_for(num):
+    return f"!{num:08x}"
+
+
+def short_name_for(num):
+    # Four base-36 digits, unique for the first 1.6 million nodes
+    digits = '0123456789abcdefghijklmnopqrstuvwxyz'
+    name = ''
+    for _ in range(4):
+        num, digit = divmod(num, 36)
+        name = digits[digit] + name
+    return name
+
+
+def packet(sender_num, text, to=MY_NODE_NUM):
+    return {
+        'from': sender_num,
+        'fromId': node_id_for(sender_num),
+        'to': to,
+        'decoded': {'portnum': 'TEXT_MESSAGE_APP', 'payload': text.encode('utf-8')}
+    }
+
+
+def menus_workload(args):
+    """Each user walks the menus, interleaved with the other users."""
+    steps = ["Hi", "B", "B", "G", "R", "C", "X", "U", "F", "S", "X", "Q", "X"]
+    users = range(FIRST_USER_NUM, FIRST_USER_NUM + args.users)
+    return [[packet(user, text) for user in users] for _ in range(args.rounds) for text in steps]
+
+
+def mail_workload(args):
+    """Each user mails the next user, then checks their own mail."""
+    rounds = []
+    users = list(range(FIRST_USER_NUM, FIRST_USER_NUM + args.users))
+    for round_number in range(args.rounds):
+        sends = []
+        for index, user in enumerate(users):
+            recipient = users[(index + 1) % len(users)]
+            text = f"SM,,{short_name_for(recipient)},,Round {round_number},,Hello from {short_name_for(user)}, this is mail number {round_number}."
+            sends.append(packet(user, text))
+        rounds.append(sends)
+        rounds.append([packet(user, "CM") for user in users])
+        rounds.append([packet(user, "X") for user in users])
+    return rounds
+
+
+def sync_workload(args):
+    """A peer BBS sends a burst of bulletins and mail; every fourth message repeats the one before."""
+    messages = []
+    users = list(range(FIRST_USER_NUM, FIRST_USER_NUM + args.users))
+    for round_number in range(args.rounds):
+        for index, user in enumerate(users):
+            if index % 4 == 3:
+                messages.append(messages[-1])
+                continue
+            unique_id = f"bench-{round_number}-{index}"
+            if index % 2:
+                text = f"MAIL|{node_id_for(user)}|{short_name_for(user)}|{node_id_for(users[0])}|Sync {round_number}|Mail body {index}|{unique_id}"
+            else:
+                text = f"BULLETIN|General|{short_name_for(user)}|Sync {round_number}|Bulletin body {index}|{unique_id}"
+            messages.append(packet(PEER_NODE_NUM, text))
+    return [messages]
+
+
+WORKLOADS = {
+    'menus': (menus_workload, False),
+    'mail': (mail_workload, False),
+    'sync': (sync_workload, True),
+    'nodes': (mail_workload, False)
+}
+
+
+def db_calls():
+    """Total calls to db_operations functions so far, from the bbs_db_seconds histogram."""
+    from metrics import registry
+    metric = registry.metrics.get('bbs_db_seconds')
+    if metric is None:
+        return 0
+    return sum(sum(counts[:-1]) for _, counts in metric.collect())
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def run_workload(name, args):
+    from message_processing import on_receive
+
+    build, from_peer = WORKLOADS[name]
+    node_count = args.large_nodes if name == 'nodes' else max(args.nodes, args.users)
+    interface = FakeInterface(node_count, bbs_nodes=[node_id_for(PEER_NODE_NUM)] if from_peer else ())
+    rounds = build(args)
+    latencies = []
+    latency_lock = threading.Lock()
+
+    def worker(packets):
+        timings = []
+        for received in packets:
+            start = time.perf_counter()
+            on_receive(received, interface)
+            timings.append(time.perf_counter() - start)
+        with latency_lock:
+            latencies.extend(timings)
+
+    db_before = db_calls()
+    start = time.perf_counter()
+    for packets in rounds:
+        # A user's messages always go to the same thread, so each user's commands stay in order
+        threads = [threading.Thread(target=worker, args=(packets[index::args.threads],))
+                   for index in range(args.threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    commands = len(latencies)
+    return {
+        'workload': name,
+        'commands': commands,
+        'seconds': elapsed,
+        'commands_per_second': commands / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'frames': len(interface.frames),
+        'bytes': interface.bytes,
+        'db_calls': db_calls() - db_before,
+        'nodes': len(interface.nodes)
+    }
+
+
+def print_results(results):
+    print(f"{'workload':<8} {'commands':>9} {'cmd/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'frames':>8} {'db calls':>9} {'nodes':>7}")
+    for result in results:
+        print(f"{result['workload']:<8} {result['commands']:>9} {result['commands_per_second']:>9.0f} "
+              f"{result['p50_ms']:>8.2f} {result['p99_ms']:>8.2f} {result['frames']:>8} "
+              f"{result['db_calls']:>9} {result['nodes']:>7}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the BBS message handling against a fake interface.")
+    parser.add_argument('workloads', nargs='*', help=f"Workloads to run: {', '.join(WORKLOADS)} (default: all)")
+    parser.add_argument('--users', type=int, default=50, help="Simulated users (default: 50)")
+    parser.add_argument('--rounds', type=int, default=5, help="Times each user repeats the workload (default: 5)")
+    parser.add_argument('--nodes', type=int, default=100, help="Nodes in the node database (default: 100)")
+    parser.add_argument('--large-nodes', type=int, default=10000, help="Nodes in the database for the nodes workload (default: 10000)")
+    parser.add_argument('--threads', type=int, default=1, help="Threads calling on_receive (default: 1, as with one radio)")
+    parser.add_argument('--json', help="Also write the results to this JSON file")
+    parser.add_argument('--verbose', action='store_true', help="Show the BBS log output")
+    args = parser.parse_args()
+    unknown = [name for name in args.workloads if name not in WORKLOADS]
+    if unknown:
+        parser.error(f"unknown workload: {', '.join(unknown)}")
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+
+    repo = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, repo)
+    json_path = os.path.abspath(args.json) if args.json else None
+
+    with tempfile.TemporaryDirectory(prefix='bbs-bench-') as scratch:
+        # The database lives in the working directory, so run in a scratch one
+        os.chdir(scratch)
+
+        import utils
+        from db_operations import initialize_database
+        from fortune_provider import fortunes
+        utils.SEND_INTERVAL = 0
+        initialize_database()
+        fortunes.configure([(os.path.join(repo, 'fortunes.txt'), 1)])
+
+        results = [run_workload(name, args) for name in (args.workloads or list(WORKLOADS))]
+        os.chdir(repo)
+
+    print_results(results)
+    if json_path:
+        with open(json_path, 'w') as file:
+            json.dump({'time': time.time(), 'args': vars(args), 'results': results}, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,4 @@
-import configparser
 import logging
-import random
 import time
 
 from meshtastic import BROADCAST_NUM
@@ -8,64 +6,29 @@ from meshtastic import BROADCAST_NUM
 from db_operations import (
     add_bulletin, add_mail, delete_mail,
     get_bulletin_content, get_bulletins,
-    get_mail, get_mail_content,
-    add_channel, get_channels, get_sender_id_by_mail_id
+    get_mail, get_mail_content, get_mail_count,
+    add_channel, get_channels, get_channels_with_ids, get_channel_by_id, get_sender_id_by_mail_id
 )
 from utils import (
-    get_node_id_from_num, get_node_info,
-    get_node_short_name, send_message,
+    append_user_content, get_draft_limit, get_node_id_from_num, get_node_info,
+    get_node_short_name, pack_lines, send_frames, send_message,
     update_user_state
 )
+from fortune_provider import fortunes
+from menus import render_menu
+import tracing
+from tracing import traced
 
-# Read the configuration for menu options
-config = configparser.ConfigParser()
-config.read('config.ini')
-
-main_menu_items = config['menu']['main_menu_items'].split(',')
-bbs_menu_items = config['menu']['bbs_menu_items'].split(',')
-utilities_menu_items = config['menu']['utilities_menu_items'].split(',')
-
-
-def build_menu(items, menu_name):
-    menu_str = f"{menu_name}\n"
-    for item in items:
-        if item.strip() == 'Q':
-            menu_str += "[Q]uick Commands\n"
-        elif item.strip() == 'B':
-            if menu_name == "📰BBS Menu📰":
-                menu_str += "[B]ulletins\n"
-            else:
-                menu_str += "[B]BS\n"
-        elif item.strip() == 'U':
-            menu_str += "[U]tilities\n"
-        elif item.strip() == 'X':
-            menu_str += "E[X]IT\n"
-        elif item.strip() == 'M':
-            menu_str += "[M]ail\n"
-        elif item.strip() == 'C':
-            menu_str += "[C]hannel Dir\n"
-        elif item.strip() == 'J':
-            menu_str += "[J]S8CALL\n"
-        elif item.strip() == 'S':
-            menu_str += "[S]tats\n"
-        elif item.strip() == 'F':
-            menu_str += "[F]ortune\n"
-        elif item.strip() == 'W':
-            menu_str += "[W]all of Shame\n"
-    return menu_str
-
+@traced()
 def handle_help_command(sender_id, interface, menu_name=None):
     if menu_name:
         update_user_state(sender_id, {'command': 'MENU', 'menu': menu_name, 'step': 1})
-        if menu_name == 'bbs':
-            response = build_menu(bbs_menu_items, "📰BBS Menu📰")
-        elif menu_name == 'utilities':
-            response = build_menu(utilities_menu_items, "🛠️Utilities Menu🛠️")
+        frames = render_menu(menu_name)
     else:
         update_user_state(sender_id, {'command': 'MAIN_MENU', 'step': 1})  # Reset to main menu state
-        mail = get_mail(get_node_id_from_num(sender_id, interface))
-        response = build_menu(main_menu_items, f"💾TC² BBS💾 (✉️:{len(mail)})")
-    send_message(response, sender_id, interface)
+        mail_count = get_mail_count(get_node_id_from_num(sender_id, interface))
+        frames = render_menu('main', mail_count=mail_count)
+    send_frames(frames, sender_id, interface)
 
 def get_node_name(node_id, interface):
     node_info = interface.nodes.get(node_id)
@@ -74,6 +37,7 @@ def get_node_name(node_id, interface):
     return f"Node {node_id}"
 
 
+@traced()
 def handle_mail_command(sender_id, interface):
     response = "✉️Mail Menu✉️\nWhat would you like to do with mail?\n[R]ead  [S]end E[X]IT"
     send_message(response, sender_id, interface)
@@ -81,37 +45,40 @@ def handle_mail_command(sender_id, interface):
 
 
 
+@traced()
 def handle_bulletin_command(sender_id, interface):
     response = f"📰Bulletin Menu📰\nWhich board would you like to enter?\n[G]eneral  [I]nfo  [N]ews  [U]rgent"
     send_message(response, sender_id, interface)
     update_user_state(sender_id, {'command': 'BULLETIN_MENU', 'step': 1})
 
 
+@traced()
 def handle_exit_command(sender_id, interface):
     send_message("Type 'HELP' for a list of commands.", sender_id, interface)
     update_user_state(sender_id, None)
 
 
+@traced()
 def handle_stats_command(sender_id, interface):
     response = "📊Stats Menu📊\nWhat stats would you like to view?\n[N]odes  [H]ardware  [R]oles  E[X]IT"
     send_message(response, sender_id, interface)
     update_user_state(sender_id, {'command': 'STATS', 'step': 1})
 
 
+@traced()
 def handle_fortune_command(sender_id, interface):
     try:
-        with open('fortunes.txt', 'r') as file:
-            fortunes = file.readlines()
-        if not fortunes:
+        fortune = fortunes.pick()
+        if not fortune:
             send_message("No fortunes available.", sender_id, interface)
             return
-        fortune = random.choice(fortunes).strip()
         decorated_fortune = f"🔮 {fortune} 🔮"
         send_message(decorated_fortune, sender_id, interface)
     except Exception as e:
         send_message(f"Error generating fortune: {e}", sender_id, interface)
 
 
+@traced()
 def handle_stats_steps(sender_id, message, step, interface):
     message = message.lower().strip()
     if len(message) == 2 and message[1] == 'x':
@@ -161,6 +128,7 @@ def handle_stats_steps(sender_id, message, step, interface):
             handle_stats_command(sender_id, interface)
 
 
+@traced()
 def handle_bb_steps(sender_id, message, step, state, interface, bbs_nodes):
     boards = {0: "General", 1: "Info", 2: "News", 3: "Urgent"}
     if step == 1:
@@ -213,7 +181,7 @@ def handle_bb_steps(sender_id, message, step, state, interface, bbs_nodes):
         if message.lower() == "end":
             board = state['board']
             subject = state['subject']
-            content = state['content']
+            content = str(state['content'])
             node_id = get_node_id_from_num(sender_id, interface)
             node_info = interface.nodes.get(node_id)
             if node_info is None:
@@ -225,11 +193,25 @@ def handle_bb_steps(sender_id, message, step, state, interface, bbs_nodes):
             send_message(f"Your bulletin '{subject}' has been posted to {board}.\n(╯°□°)╯📄📌[{board}]", sender_id, interface)
             handle_bb_steps(sender_id, 'e', 1, state, interface, bbs_nodes)
         else:
-            state['content'] += message + "\n"
-            update_user_state(sender_id, state)
+            handle_draft_line(sender_id, message, interface)
 
 
 
+@traced()
+def handle_draft_line(sender_id, message, interface):
+    try:
+        added = append_user_content(sender_id, message + "\n")
+    except KeyError:
+        send_message("Your session expired and the message you were writing was lost. Please start again.",
+                     sender_id, interface)
+        handle_help_command(sender_id, interface)
+        return
+    if not added:
+        send_message(f"Your message has reached the maximum length ({get_draft_limit()} bytes) and that part was not "
+                     f"added. Send END to post what you have.", sender_id, interface)
+
+
+@traced()
 def handle_mail_steps(sender_id, message, step, state, interface, bbs_nodes):
     message = message.strip()
     if len(message) == 2 and message[1] == 'x':
@@ -261,7 +243,7 @@ def handle_mail_steps(sender_id, message, step, state, interface, bbs_nodes):
             sender, date, subject, content, unique_id = get_mail_content(mail_id, sender_node_id)
             send_message(f"Date: {date}\nFrom: {sender}\nSubject: {subject}\n{content}", sender_id, interface)
             send_message("What would you like to do with this message?\n[K]eep  [D]elete  [R]eply", sender_id, interface)
-            update_user_state(sender_id, {'command': 'MAIL', 'step': 4, 'mail_id': mail_id, 'unique_id': unique_id, 'sender': sender, 'subject': subject, 'content': content})
+            update_user_state(sender_id, {'command': 'MAIL', 'step': 4, 'mail_id': mail_id, 'unique_id': unique_id, 'sender': sender, 'subject': subject})
         except TypeError:
             logging.info(f"Node {sender_id} tried to access non-existent message")
             send_message("Mail not found", sender_id, interface)
@@ -282,7 +264,7 @@ def handle_mail_steps(sender_id, message, step, state, interface, bbs_nodes):
             send_message("There are multiple nodes with that short name. Which one would you like to leave a message for?", sender_id, interface)
             for i, node in enumerate(nodes):
                 send_message(f"[{i}] {node['longName']}", sender_id, interface)
-            update_user_state(sender_id, {'command': 'MAIL', 'step': 6, 'nodes': nodes})
+            update_user_state(sender_id, {'command': 'MAIL', 'step': 6, 'node_nums': [node['num'] for node in nodes]})
 
     elif step == 4:
         if message.lower() == "d":
@@ -306,8 +288,7 @@ def handle_mail_steps(sender_id, message, step, state, interface, bbs_nodes):
 
     elif step == 6:
         selected_node_index = int(message)
-        selected_node = state['nodes'][selected_node_index]
-        recipient_id = selected_node['num']
+        recipient_id = state['node_nums'][selected_node_index]
         recipient_name = get_node_name(recipient_id, interface)
         send_message(f"What is the subject of your message to {recipient_name}?\nKeep it short.", sender_id, interface)
         update_user_state(sender_id, {'command': 'MAIL', 'step': 5, 'recipient_id': recipient_id})
@@ -319,7 +300,7 @@ def handle_mail_steps(sender_id, message, step, state, interface, bbs_nodes):
             else:
                 recipient_id = state.get('recipient_id')
             subject = state['subject']
-            content = state['content']
+            content = str(state['content'])
             recipient_name = get_node_name(recipient_id, interface)
 
             sender_short_name = get_node_short_name(get_node_id_from_num(sender_id, interface), interface)
@@ -332,8 +313,7 @@ def handle_mail_steps(sender_id, message, step, state, interface, bbs_nodes):
             update_user_state(sender_id, None)
             update_user_state(sender_id, {'command': 'MAIL', 'step': 8})
         else:
-            state['content'] += message + "\n"
-            update_user_state(sender_id, state)
+            handle_draft_line(sender_id, message, interface)
 
     elif step == 8:
         if message.lower() == "y":
@@ -343,6 +323,7 @@ def handle_mail_steps(sender_id, message, step, state, interface, bbs_nodes):
             update_user_state(sender_id, None)
 
 
+@traced()
 def handle_wall_of_shame_command(sender_id, interface):
     response = "Devices with battery levels below 20%:\n"
     for node_id, node in interface.nodes.items():
@@ -356,12 +337,14 @@ def handle_wall_of_shame_command(sender_id, interface):
     send_message(response, sender_id, interface)
 
 
+@traced()
 def handle_channel_directory_command(sender_id, interface):
     response = "📚CHANNEL DIRECTORY📚\nWhat would you like to do?\n[V]iew  [P]ost  E[X]IT"
     send_message(response, sender_id, interface)
     update_user_state(sender_id, {'command': 'CHANNEL_DIRECTORY', 'step': 1})
 
 
+@traced()
 def handle_channel_directory_steps(sender_id, message, step, state, interface):
     message = message.strip()
     if len(message) == 2 and message[1] == 'x':
@@ -407,6 +390,7 @@ def handle_channel_directory_steps(sender_id, message, step, state, interface):
         handle_channel_directory_command(sender_id, interface)
 
 
+@traced()
 def handle_send_mail_command(sender_id, message, interface, bbs_nodes):
     try:
         parts = message.split(",,", 3)
@@ -440,6 +424,7 @@ def handle_send_mail_command(sender_id, message, interface, bbs_nodes):
         send_message("Error processing send mail command.", sender_id, interface)
 
 
+@traced()
 def handle_check_mail_command(sender_id, interface):
     try:
         sender_node_id = get_node_id_from_num(sender_id, interface)
@@ -454,29 +439,30 @@ def handle_check_mail_command(sender_id, interface):
         response += "\nPlease reply with the number of the message you want to read."
         send_message(response, sender_id, interface)
 
-        update_user_state(sender_id, {'command': 'CHECK_MAIL', 'step': 1, 'mail': mail})
+        update_user_state(sender_id, {'command': 'CHECK_MAIL', 'step': 1, 'mail_ids': [msg[0] for msg in mail]})
 
     except Exception as e:
         logging.error(f"Error processing check mail command: {e}")
         send_message("Error processing check mail command.", sender_id, interface)
 
 
+@traced()
 def handle_read_mail_command(sender_id, message, state, interface):
     try:
-        mail = state.get('mail', [])
+        mail_ids = state.get('mail_ids', [])
         message_number = int(message) - 1
 
-        if message_number < 0 or message_number >= len(mail):
+        if message_number < 0 or message_number >= len(mail_ids):
             send_message("Invalid message number. Please try again.", sender_id, interface)
             return
 
-        mail_id = mail[message_number][0]
+        mail_id = mail_ids[message_number]
         sender_node_id = get_node_id_from_num(sender_id, interface)
         sender, date, subject, content, unique_id = get_mail_content(mail_id, sender_node_id)
         response = f"Date: {date}\nFrom: {sender}\nSubject: {subject}\n\n{content}"
         send_message(response, sender_id, interface)
         send_message("What would you like to do with this message?\n[K]eep  [D]elete  [R]eply", sender_id, interface)
-        update_user_state(sender_id, {'command': 'CHECK_MAIL', 'step': 2, 'mail_id': mail_id, 'unique_id': unique_id, 'sender': sender, 'subject': subject, 'content': content})
+        update_user_state(sender_id, {'command': 'CHECK_MAIL', 'step': 2, 'mail_id': mail_id, 'unique_id': unique_id, 'sender': sender, 'subject': subject})
 
     except ValueError:
         send_message("Invalid input. Please enter a valid message number.", sender_id, interface)
@@ -485,6 +471,7 @@ def handle_read_mail_command(sender_id, message, state, interface):
         send_message("Error processing read mail command.", sender_id, interface)
 
 
+@traced()
 def handle_delete_mail_confirmation(sender_id, message, state, interface, bbs_nodes):
     try:
         choice = message.lower().strip()
@@ -511,6 +498,7 @@ def handle_delete_mail_confirmation(sender_id, message, state, interface, bbs_no
 
 
 
+@traced()
 def handle_post_bulletin_command(sender_id, message, interface, bbs_nodes):
     try:
         parts = message.split(",,", 3)
@@ -530,6 +518,7 @@ def handle_post_bulletin_command(sender_id, message, interface, bbs_nodes):
         send_message("Error processing post bulletin command.", sender_id, interface)
 
 
+@traced()
 def handle_check_bulletin_command(sender_id, message, interface):
     try:
         # Split the message only once
@@ -553,22 +542,23 @@ def handle_check_bulletin_command(sender_id, message, interface):
         response += "\nPlease reply with the number of the bulletin you want to read."
         send_message(response, sender_id, interface)
 
-        update_user_state(sender_id, {'command': 'CHECK_BULLETIN', 'step': 1, 'board_name': board_name, 'bulletins': bulletins})
+        update_user_state(sender_id, {'command': 'CHECK_BULLETIN', 'step': 1, 'board_name': board_name, 'bulletin_ids': [bulletin[0] for bulletin in bulletins]})
 
     except Exception as e:
         logging.error(f"Error processing check bulletin command: {e}")
         send_message("Error processing check bulletin command.", sender_id, interface)
 
+@traced()
 def handle_read_bulletin_command(sender_id, message, state, interface):
     try:
-        bulletins = state.get('bulletins', [])
+        bulletin_ids = state.get('bulletin_ids', [])
         message_number = int(message) - 1
 
-        if message_number < 0 or message_number >= len(bulletins):
+        if message_number < 0 or message_number >= len(bulletin_ids):
             send_message("Invalid bulletin number. Please try again.", sender_id, interface)
             return
 
-        bulletin_id = bulletins[message_number][0]
+        bulletin_id = bulletin_ids[message_number]
         sender, date, subject, content, unique_id = get_bulletin_content(bulletin_id)
         response = f"Date: {date}\nFrom: {sender}\nSubject: {subject}\n\n{content}"
         send_message(response, sender_id, interface)
@@ -582,6 +572,7 @@ def handle_read_bulletin_command(sender_id, message, state, interface):
         send_message("Error processing read bulletin command.", sender_id, interface)
 
 
+@traced()
 def handle_post_channel_command(sender_id, message, interface):
     try:
         parts = message.split("|", 3)
@@ -599,36 +590,43 @@ def handle_post_channel_command(sender_id, message, interface):
         send_message("Error processing post channel command.", sender_id, interface)
 
 
+@traced()
 def handle_check_channel_command(sender_id, interface):
     try:
-        channels = get_channels()
+        channels = get_channels_with_ids()
         if not channels:
             send_message("No channels available in the directory.", sender_id, interface)
             return
 
         response = "Available Channels:\n"
         for i, channel in enumerate(channels):
-            response += f"{i + 1:02d}. Name: {channel[0]}\n"
+            response += f"{i + 1:02d}. Name: {channel[1]}\n"
         response += "\nPlease reply with the number of the channel you want to view."
         send_message(response, sender_id, interface)
 
-        update_user_state(sender_id, {'command': 'CHECK_CHANNEL', 'step': 1, 'channels': channels})
+        update_user_state(sender_id, {'command': 'CHECK_CHANNEL', 'step': 1, 'channel_ids': [channel[0] for channel in channels]})
 
     except Exception as e:
         logging.error(f"Error processing check channel command: {e}")
         send_message("Error processing check channel command.", sender_id, interface)
 
 
+@traced()
 def handle_read_channel_command(sender_id, message, state, interface):
     try:
-        channels = state.get('channels', [])
+        channel_ids = state.get('channel_ids', [])
         message_number = int(message) - 1
 
-        if message_number < 0 or message_number >= len(channels):
+        if message_number < 0 or message_number >= len(channel_ids):
             send_message("Invalid channel number. Please try again.", sender_id, interface)
             return
 
-        channel_name, channel_url = channels[message_number]
+        channel = get_channel_by_id(channel_ids[message_number])
+        if channel is None:
+            send_message("That channel is no longer in the directory.", sender_id, interface)
+            update_user_state(sender_id, None)
+            return
+        channel_name, channel_url = channel
         response = f"Channel Name: {channel_name}\nChannel URL: {channel_url}"
         send_message(response, sender_id, interface)
 
@@ -641,27 +639,40 @@ def handle_read_channel_command(sender_id, message, state, interface):
         send_message("Error processing read channel command.", sender_id, interface)
 
 
+@traced()
 def handle_list_channels_command(sender_id, interface):
     try:
-        channels = get_channels()
+        channels = get_channels_with_ids()
         if not channels:
             send_message("No channels available in the directory.", sender_id, interface)
             return
 
         response = "Available Channels:\n"
         for i, channel in enumerate(channels):
-            response += f"{i+1:02d}. Name: {channel[0]}\n"
+            response += f"{i+1:02d}. Name: {channel[1]}\n"
         response += "\nPlease reply with the number of the channel you want to view."
         send_message(response, sender_id, interface)
 
-        update_user_state(sender_id, {'command': 'LIST_CHANNELS', 'step': 1, 'channels': channels})
+        update_user_state(sender_id, {'command': 'LIST_CHANNELS', 'step': 1, 'channel_ids': [channel[0] for channel in channels]})
 
     except Exception as e:
         logging.error(f"Error processing list channels command: {e}")
         send_message("Error processing list channels command.", sender_id, interface)
 
 
+@traced()
 def handle_quick_help_command(sender_id, interface):
     response = ("✈️QUICK COMMANDS✈️\nSend command below for usage info:\nSM,, - Send "
                 "Mail\nCM - Check Mail\nPB,, - Post Bulletin\nCB,, - Check Bulletins\n")
     send_message(response, sender_id, interface)
+
+
+@traced()
+def handle_trace_command(sender_id, interface):
+    node_id = get_node_id_from_num(sender_id, interface)
+    if not tracing.enabled or node_id not in tracing.admins:
+        handle_help_command(sender_id, interface)
+        return
+    count = tracing.dump()
+    response, _ = pack_lines(f"Dumped {count} traces. Slowest:", tracing.slowest(5))
+    send_message(response, sender_id, interface)
@@ -1,12 +1,14 @@
 import configparser
 import time
-from typing import Any
-import meshtastic.stream_interface
-import meshtastic.serial_interface
-import meshtastic.tcp_interface
-import serial.tools.list_ports
+from typing import Any, TYPE_CHECKING
 import argparse
 
+from fortune_provider import parse_fortune_files
+
+if TYPE_CHECKING:
+    # meshtastic and serial are slow to import, so get_interface() imports them when it is called
+    import meshtastic.stream_interface
+
 
 def init_cli_parser() -> argparse.Namespace:
     """Function build the CLI parser and parses the arguments.
@@ -41,6 +43,11 @@ def init_cli_parser() -> argparse.Namespace:
         help="TCP host address",
         default=None)
     
+    parser.add_argument(
+        "--startup-profile",
+        action="store_true",
+        help="Print how long each startup phase took")
+
     parser.add_argument(
         "--mqtt-topic", '-t', 
         action="store",
@@ -77,7 +84,14 @@ def merge_config(system_config:dict[str, Any], args:argparse.Namespace) -> dict[
         
     if args.host is not None:
         system_config['hostname'] = args.host
-    
+
+    # The command line only describes the first radio
+    system_config['interfaces'][0].update(
+        interface_type=system_config['interface_type'],
+        hostname=system_config['hostname'],
+        port=system_config['port']
+    )
+
     return system_config
 
 
@@ -87,10 +101,41 @@ def initialize_config(config_file: str = None) -> dict[str, Any]:
 
     Returns a dict with the following entries:
     config - parsed config file
+    config_file - path of the config file, used to reload it
     interface_type - type of the active interface
     hostname - host name for TCP interface
     port - serial port name for serial interface
+    interfaces - one dict per radio with name, interface_type, hostname and port; the first is the
+        [interface] section, the rest come from [interface.<name>] sections
+    heartbeat_interval - seconds between checks that each radio link is still up
+    reconnect_min - first delay in seconds before retrying a dropped radio link
+    reconnect_max - longest delay in seconds between retries of a dropped radio link
     bbs_nodes - list of peer nodes to sync with
+    reconcile_interval - seconds between reconciliation rounds with the peers (0 disables)
+    outbox_expiry - seconds an undelivered sync message stays in the outbox
+    outbox_retry - base delay in seconds before a failed sync send is retried
+    peer_heard_window - a peer heard within this many seconds is considered reachable
+    delta_batch_bytes - most bytes of changes sent in reply to one SYNC_SINCE request
+    delta_interval - least number of seconds between SYNC_SINCE batches for one peer
+    session_ttl - seconds an idle user session is kept
+    max_sessions - most user sessions kept in memory
+    max_session_bytes - memory budget for all user sessions, mostly draft content
+    max_draft_bytes - longest mail or bulletin body a user can compose over several messages
+    fortune_files - list of (path, weight) fortune files for the fortune teller
+    metrics_port - local port serving Prometheus metrics (0 disables)
+    metrics_host - address the metrics port listens on
+    metrics_file - file JSON metric snapshots are written to (empty disables)
+    metrics_interval - seconds between JSON metric snapshots
+    lora_modem - (spreading factor, bandwidth in Hz, coding rate) used to estimate airtime
+    tracing_enabled - record a trace of every message handled
+    trace_buffer - number of recent traces kept for dumping
+    trace_file - file traces are dumped to
+    trace_admins - node IDs allowed to dump traces with the TRACE command
+    profiler_interval - seconds between sampling profiler samples (0 disables the profiler)
+    profiler_file - file the profiler's collapsed stacks are written to
+    capture_file - file every received packet is appended to for replay.py (empty disables)
+    shutdown_timeout - seconds shutdown waits for replies and queued sync messages to go out
+    worker_count - number of processes handling messages, with this one as the radio gateway (0 handles them here)
 
     Args:
         config_file (str, optional): Path to config file. Function reads from './config.ini' if this arg is set to None. Defaults to None.
@@ -108,12 +153,61 @@ def initialize_config(config_file: str = None) -> dict[str, Any]:
     hostname = config['interface'].get('hostname', None)
     port = config['interface'].get('port', None)
 
+    heartbeat_interval = config.getint('interface', 'heartbeat_interval', fallback=60)
+    reconnect_min = config.getint('interface', 'reconnect_min', fallback=1)
+    reconnect_max = config.getint('interface', 'reconnect_max', fallback=60)
+
+    interfaces = [{'name': 'primary', 'interface_type': interface_type, 'hostname': hostname, 'port': port}]
+    for section in config.sections():
+        if section.startswith('interface.'):
+            interfaces.append({
+                'name': section.split('.', 1)[1],
+                'interface_type': config[section]['type'],
+                'hostname': config[section].get('hostname', None),
+                'port': config[section].get('port', None)
+            })
+
     bbs_nodes = config.get('sync', 'bbs_nodes', fallback='').split(',')
     if bbs_nodes == ['']:
         bbs_nodes = []
 
     print(f"Configured to sync with the following BBS nodes: {bbs_nodes}")
 
+    reconcile_interval = config.getint('sync', 'reconcile_interval', fallback=3600)
+    outbox_expiry = config.getint('sync', 'outbox_expiry', fallback=604800)
+    outbox_retry = config.getint('sync', 'outbox_retry', fallback=30)
+    peer_heard_window = config.getint('sync', 'peer_heard_window', fallback=3600)
+    delta_batch_bytes = config.getint('sync', 'delta_batch_bytes', fallback=2000)
+    delta_interval = config.getint('sync', 'delta_interval', fallback=60)
+
+    session_ttl = config.getint('sessions', 'ttl', fallback=3600)
+    max_sessions = config.getint('sessions', 'max_sessions', fallback=1000)
+    max_session_bytes = config.getint('sessions', 'max_bytes', fallback=1048576)
+    max_draft_bytes = config.getint('sessions', 'max_draft_bytes', fallback=4096)
+
+    fortune_files = parse_fortune_files(config.get('fortune', 'files', fallback='fortunes.txt'))
+
+    metrics_port = config.getint('metrics', 'http_port', fallback=0)
+    metrics_host = config.get('metrics', 'http_host', fallback='127.0.0.1')
+    metrics_file = config.get('metrics', 'json_file', fallback='')
+    metrics_interval = config.getint('metrics', 'json_interval', fallback=60)
+    lora_modem = (
+        config.getint('metrics', 'spreading_factor', fallback=11),
+        config.getint('metrics', 'bandwidth', fallback=250000),
+        config.getint('metrics', 'coding_rate', fallback=5)
+    )
+
+    tracing_enabled = config.getboolean('tracing', 'enabled', fallback=False)
+    trace_buffer = config.getint('tracing', 'buffer_size', fallback=200)
+    trace_file = config.get('tracing', 'dump_file', fallback='traces.txt')
+    trace_admins = [node_id.strip() for node_id in config.get('tracing', 'admin_nodes', fallback='').split(',')
+                    if node_id.strip()]
+    profiler_interval = config.getfloat('tracing', 'profiler_interval', fallback=0)
+    profiler_file = config.get('tracing', 'profiler_file', fallback='profile.folded')
+    capture_file = config.get('capture', 'file', fallback='')
+    shutdown_timeout = config.getint('shutdown', 'timeout', fallback=30)
+    worker_count = config.getint('workers', 'count', fallback=0)
+
     allowed_nodes = config.get('allow_list', 'allowed_nodes', fallback='').split(',')
     if allowed_nodes == ['']:
         allowed_nodes = []
@@ -122,17 +216,47 @@ def initialize_config(config_file: str = None) -> dict[str, Any]:
 
     return {
         'config': config,
+        'config_file': config_file,
         'interface_type': interface_type,
         'hostname': hostname,
         'port': port,
+        'interfaces': interfaces,
+        'heartbeat_interval': heartbeat_interval,
+        'reconnect_min': reconnect_min,
+        'reconnect_max': reconnect_max,
         'bbs_nodes': bbs_nodes,
+        'reconcile_interval': reconcile_interval,
+        'outbox_expiry': outbox_expiry,
+        'outbox_retry': outbox_retry,
+        'peer_heard_window': peer_heard_window,
+        'delta_batch_bytes': delta_batch_bytes,
+        'delta_interval': delta_interval,
+        'session_ttl': session_ttl,
+        'max_sessions': max_sessions,
+        'max_session_bytes': max_session_bytes,
+        'max_draft_bytes': max_draft_bytes,
+        'fortune_files': fortune_files,
+        'metrics_port': metrics_port,
+        'metrics_host': metrics_host,
+        'metrics_file': metrics_file,
+        'metrics_interval': metrics_interval,
+        'lora_modem': lora_modem,
+        'tracing_enabled': tracing_enabled,
+        'trace_buffer': trace_buffer,
+        'trace_file': trace_file,
+        'trace_admins': trace_admins,
+        'profiler_interval': profiler_interval,
+        'profiler_file': profiler_file,
+        'capture_file': capture_file,
+        'shutdown_timeout': shutdown_timeout,
+        'worker_count': worker_count,
         'allowed_nodes': allowed_nodes,
         'mqtt_topic': 'meshtastic.receive'
     }
 
 
 
-def get_interface(system_config:dict[str, Any]) -> meshtastic.stream_interface.StreamInterface:
+def get_interface(system_config:dict[str, Any]) -> 'meshtastic.stream_interface.StreamInterface':
     """
     Function opens and returns an instance meshtastic interface of type specified by the configuration
     
@@ -154,6 +278,10 @@ def get_interface(system_config:dict[str, Any]) -> meshtastic.stream_interface.S
     Returns:
         meshtastic.stream_interface.StreamInterface: An instance of StreamInterface
     """
+    import meshtastic.serial_interface
+    import meshtastic.tcp_interface
+    import serial.tools.list_ports
+
     while True:
         try:
             if system_config['interface_type'] == 'serial':
@@ -1,42 +1,14 @@
 import os
-import sqlite3
-import threading
 
-thread_local = threading.local()
+from db_operations import add_tombstone, get_db_connection, initialize_database
 
-def get_db_connection():
-    if not hasattr(thread_local, 'connection'):
-        thread_local.connection = sqlite3.connect('bulletins.db')
-    return thread_local.connection
-
-def initialize_database():
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS bulletins (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    board TEXT NOT NULL,
-                    sender_short_name TEXT NOT NULL,
-                    date TEXT NOT NULL,
-                    subject TEXT NOT NULL,
-                    content TEXT NOT NULL,
-                    unique_id TEXT NOT NULL
-                )''')
-    c.execute('''CREATE TABLE IF NOT EXISTS mail (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    sender TEXT NOT NULL,
-                    sender_short_name TEXT NOT NULL,
-                    recipient TEXT NOT NULL,
-                    date TEXT NOT NULL,
-                    subject TEXT NOT NULL,
-                    content TEXT NOT NULL,
-                    unique_id TEXT NOT NULL
-                );''')
-    c.execute('''CREATE TABLE IF NOT EXISTS channels (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    name TEXT NOT NULL,
-                    url TEXT NOT NULL
-                );''')
-    conn.commit()
+def add_tombstones(cursor, table, kind, ids):
+    # Record deletes so peers drop these items during reconciliation instead of re-sending them
+    for row_id in ids:
+        cursor.execute(f"SELECT unique_id FROM {table} WHERE id = ?", (row_id.strip(),))
+        result = cursor.fetchone()
+        if result:
+            add_tombstone(cursor, kind, result[0])
 
 def list_bulletins():
     conn = get_db_connection()
@@ -90,6 +62,7 @@ def delete_bulletin():
             return
         conn = get_db_connection()
         c = conn.cursor()
+        add_tombstones(c, 'bulletins', 'bulletin', bulletin_ids)
         for bulletin_id in bulletin_ids:
             c.execute("DELETE FROM bulletins WHERE id = ?", (bulletin_id.strip(),))
         conn.commit()
@@ -106,6 +79,7 @@ def delete_mail():
             return
         conn = get_db_connection()
         c = conn.cursor()
+        add_tombstones(c, 'mail', 'mail', mail_ids)
         for mail_id in mail_ids:
             c.execute("DELETE FROM mail WHERE id = ?", (mail_id.strip(),))
         conn.commit()
@@ -1,11 +1,13 @@
+import functools
 import logging
 import sqlite3
 import threading
+import time
 import uuid
 from datetime import datetime
 
-from meshtastic import BROADCAST_NUM
-
+from metrics import registry
+from tracing import span
 from utils import (
     send_bulletin_to_bbs_nodes,
     send_delete_bulletin_to_bbs_nodes,
@@ -16,11 +18,30 @@ from utils import (
 
 thread_local = threading.local()
 
+# Seconds to wait for a lock held by another thread or process (workers, db_admin) before giving up
+DB_TIMEOUT = 30
+
+db_latency = registry.histogram('bbs_db_seconds', "Time spent in db_operations functions", ('function',))
+
+
+def timed(function):
+    """Times (and traces) a query helper."""
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with db_latency.time(function=function.__name__), span(function.__name__):
+            return function(*args, **kwargs)
+    return wrapper
+
+
 def get_db_connection():
     if not hasattr(thread_local, 'connection'):
-        thread_local.connection = sqlite3.connect('bulletins.db')
+        conn = sqlite3.connect('bulletins.db', timeout=DB_TIMEOUT)
+        # With WAL, reads don't wait for a write in another process and writes don't wait for reads
+        conn.execute("PRAGMA journal_mode=WAL")
+        thread_local.connection = conn
     return thread_local.connection
 
+@timed
 def initialize_database():
     conn = get_db_connection()
     c = conn.cursor()
@@ -48,19 +69,73 @@ def initialize_database():
                     name TEXT NOT NULL,
                     url TEXT NOT NULL
                 );''')
+    c.execute('''CREATE TABLE IF NOT EXISTS tombstones (
+                    unique_id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    date TEXT NOT NULL
+                );''')
+    c.execute('''CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    peer TEXT NOT NULL,
+                    message TEXT NOT NULL,
+                    created REAL NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt REAL NOT NULL,
+                    expires REAL NOT NULL
+                );''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_outbox_peer ON outbox (peer, next_attempt)")
+    c.execute('''CREATE TABLE IF NOT EXISTS changes (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    kind TEXT NOT NULL,
+                    ref TEXT NOT NULL
+                );''')
+    c.execute('''CREATE TABLE IF NOT EXISTS peer_cursors (
+                    peer TEXT PRIMARY KEY,
+                    cursor INTEGER NOT NULL,
+                    updated TEXT NOT NULL
+                );''')
+    c.execute('''CREATE TABLE IF NOT EXISTS sessions (
+                    user_id PRIMARY KEY,
+                    data TEXT NOT NULL,
+                    updated REAL NOT NULL
+                );''')
+    c.execute('''CREATE TABLE IF NOT EXISTS session_lines (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id NOT NULL,
+                    line TEXT NOT NULL
+                );''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_session_lines_user ON session_lines (user_id)")
+    c.execute("SELECT COUNT(*) FROM changes")
+    if c.fetchone()[0] == 0:
+        # Seed the change log from existing data so peers can delta sync from scratch
+        c.execute("INSERT INTO changes (kind, ref) SELECT 'B', unique_id FROM bulletins ORDER BY id")
+        c.execute("INSERT INTO changes (kind, ref) SELECT 'M', unique_id FROM mail ORDER BY id")
+        c.execute("INSERT INTO changes (kind, ref) SELECT 'C', id FROM channels ORDER BY id")
+        c.execute("INSERT INTO changes (kind, ref) SELECT CASE kind WHEN 'mail' THEN 'M' ELSE 'B' END, unique_id FROM tombstones")
     conn.commit()
     print("Database schema initialized.")
 
-def add_channel(name, url, bbs_nodes=None, interface=None):
+@timed
+def add_channel(name, url, bbs_nodes=None, interface=None, from_peer=False):
+    """
+    Adds a channel unless one with the same name and URL is already stored. Channels that came
+    from a peer aren't recorded as changes, so delta sync doesn't send them back around.
+    """
     conn = get_db_connection()
     c = conn.cursor()
+    c.execute("SELECT 1 FROM channels WHERE name = ? AND url = ?", (name, url))
+    if c.fetchone():
+        return
     c.execute("INSERT INTO channels (name, url) VALUES (?, ?)", (name, url))
+    if not from_peer:
+        record_change(c, 'C', c.lastrowid)
     conn.commit()
 
     if bbs_nodes and interface:
         send_channel_to_bbs_nodes(name, url, bbs_nodes, interface)
 
 
+@timed
 def get_channels():
     conn = get_db_connection()
     c = conn.cursor()
@@ -68,8 +143,18 @@ def get_channels():
     return c.fetchall()
 
 
+@timed
+def get_channels_with_ids():
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("SELECT id, name, url FROM channels")
+    return c.fetchall()
+
+
 
-def add_bulletin(board, sender_short_name, subject, content, bbs_nodes, interface, unique_id=None):
+@timed
+def add_bulletin(board, sender_short_name, subject, content, bbs_nodes, interface, unique_id=None, from_peer=False):
+    # Bulletins that came from a peer aren't recorded as changes, so delta sync doesn't send them back
     conn = get_db_connection()
     c = conn.cursor()
     date = datetime.now().strftime('%Y-%m-%d %H:%M')
@@ -78,24 +163,30 @@ def add_bulletin(board, sender_short_name, subject, content, bbs_nodes, interfac
     c.execute(
         "INSERT INTO bulletins (board, sender_short_name, date, subject, content, unique_id) VALUES (?, ?, ?, ?, ?, ?)",
         (board, sender_short_name, date, subject, content, unique_id))
+    if not from_peer:
+        record_change(c, 'B', unique_id)
     conn.commit()
     if bbs_nodes and interface:
         send_bulletin_to_bbs_nodes(board, sender_short_name, subject, content, unique_id, bbs_nodes, interface)
 
     # New logic to send group chat notification for urgent bulletins
     if board.lower() == "urgent":
+        # Imported here so the database can be set up before meshtastic has loaded
+        from meshtastic import BROADCAST_NUM
         notification_message = f"💥NEW URGENT BULLETIN💥\nFrom: {sender_short_name}\nTitle: {subject}\nDM 'CB,,Urgent' to view"
         send_message(notification_message, BROADCAST_NUM, interface)
 
     return unique_id
 
 
+@timed
 def get_bulletins(board):
     conn = get_db_connection()
     c = conn.cursor()
     c.execute("SELECT id, subject, sender_short_name, date, unique_id FROM bulletins WHERE board = ? COLLATE NOCASE", (board,))
     return c.fetchall()
 
+@timed
 def get_bulletin_content(bulletin_id):
     conn = get_db_connection()
     c = conn.cursor()
@@ -103,14 +194,28 @@ def get_bulletin_content(bulletin_id):
     return c.fetchone()
 
 
-def delete_bulletin(bulletin_id, bbs_nodes, interface):
+@timed
+def get_bulletin_by_unique_id(unique_id):
     conn = get_db_connection()
     c = conn.cursor()
-    c.execute("DELETE FROM bulletins WHERE id = ?", (bulletin_id,))
+    c.execute("SELECT board, sender_short_name, subject, content, unique_id FROM bulletins WHERE unique_id = ?", (unique_id,))
+    return c.fetchone()
+
+
+@timed
+def delete_bulletin(unique_id, bbs_nodes, interface):
+    # Bulletins are deleted by unique_id so the same row goes away on every peer
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("DELETE FROM bulletins WHERE unique_id = ?", (unique_id,))
+    add_tombstone(c, 'bulletin', unique_id)
     conn.commit()
-    send_delete_bulletin_to_bbs_nodes(bulletin_id, bbs_nodes, interface)
+    send_delete_bulletin_to_bbs_nodes(unique_id, bbs_nodes, interface)
 
-def add_mail(sender_id, sender_short_name, recipient_id, subject, content, bbs_nodes, interface, unique_id=None):
+@timed
+def add_mail(sender_id, sender_short_name, recipient_id, subject, content, bbs_nodes, interface, unique_id=None,
+             from_peer=False):
+    # Like bulletins, mail from a peer isn't recorded as a change
     conn = get_db_connection()
     c = conn.cursor()
     date = datetime.now().strftime('%Y-%m-%d %H:%M')
@@ -118,17 +223,35 @@ def add_mail(sender_id, sender_short_name, recipient_id, subject, content, bbs_n
         unique_id = str(uuid.uuid4())
     c.execute("INSERT INTO mail (sender, sender_short_name, recipient, date, subject, content, unique_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
               (sender_id, sender_short_name, recipient_id, date, subject, content, unique_id))
+    if not from_peer:
+        record_change(c, 'M', unique_id)
     conn.commit()
     if bbs_nodes and interface:
         send_mail_to_bbs_nodes(sender_id, sender_short_name, recipient_id, subject, content, unique_id, bbs_nodes, interface)
     return unique_id
 
+@timed
+def get_mail_by_unique_id(unique_id):
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("SELECT sender, sender_short_name, recipient, subject, content, unique_id FROM mail WHERE unique_id = ?", (unique_id,))
+    return c.fetchone()
+
+@timed
 def get_mail(recipient_id):
     conn = get_db_connection()
     c = conn.cursor()
     c.execute("SELECT id, sender_short_name, subject, date, unique_id FROM mail WHERE recipient = ?", (recipient_id,))
     return c.fetchall()
 
+@timed
+def get_mail_count(recipient_id):
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("SELECT COUNT(*) FROM mail WHERE recipient = ?", (recipient_id,))
+    return c.fetchone()[0]
+
+@timed
 def get_mail_content(mail_id, recipient_id):
     # TODO: ensure only recipient can read mail
     conn = get_db_connection()
@@ -136,6 +259,7 @@ def get_mail_content(mail_id, recipient_id):
     c.execute("SELECT sender_short_name, date, subject, content, unique_id FROM mail WHERE id = ? and recipient = ?", (mail_id, recipient_id,))
     return c.fetchone()
 
+@timed
 def delete_mail(unique_id, recipient_id, bbs_nodes, interface):
     conn = get_db_connection()
     c = conn.cursor()
@@ -144,10 +268,14 @@ def delete_mail(unique_id, recipient_id, bbs_nodes, interface):
         result = c.fetchone()
         if result is None:
             logging.error(f"No mail found with unique_id: {unique_id}")
+            # Still remember the delete so reconciliation won't pull the mail in later
+            add_tombstone(c, 'mail', unique_id)
+            conn.commit()
             return  # Early exit if no matching mail found
         recipient_id = result[0]
         logging.info(f"Attempting to delete mail with unique_id: {unique_id} by {recipient_id}")
         c.execute("DELETE FROM mail WHERE unique_id = ? and recipient = ?", (unique_id, recipient_id,))
+        add_tombstone(c, 'mail', unique_id)
         conn.commit()
         send_delete_mail_to_bbs_nodes(unique_id, bbs_nodes, interface)
         logging.info(f"Mail with unique_id: {unique_id} deleted and sync message sent.")
@@ -156,6 +284,7 @@ def delete_mail(unique_id, recipient_id, bbs_nodes, interface):
         raise
 
 
+@timed
 def get_sender_id_by_mail_id(mail_id):
     conn = get_db_connection()
     c = conn.cursor()
@@ -164,3 +293,193 @@ def get_sender_id_by_mail_id(mail_id):
     if result:
         return result[0]
     return None
+
+
+def add_tombstone(cursor, kind, unique_id):
+    # Remembers deleted items so reconciliation doesn't bring them back from a peer
+    date = datetime.now().strftime('%Y-%m-%d %H:%M')
+    cursor.execute("INSERT OR REPLACE INTO tombstones (unique_id, kind, date) VALUES (?, ?, ?)", (unique_id, kind, date))
+    record_change(cursor, 'M' if kind == 'mail' else 'B', unique_id)
+
+
+def record_change(cursor, kind, ref):
+    # Appends to the change log that peers delta sync from
+    cursor.execute("INSERT INTO changes (kind, ref) VALUES (?, ?)", (kind, str(ref)))
+
+
+@timed
+def is_tombstoned(unique_id):
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("SELECT 1 FROM tombstones WHERE unique_id = ?", (unique_id,))
+    return c.fetchone() is not None
+
+
+@timed
+def unique_id_exists(table, unique_id):
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute(f"SELECT 1 FROM {table} WHERE unique_id = ?", (unique_id,))
+    return c.fetchone() is not None
+
+
+@timed
+def get_unique_ids(table):
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute(f"SELECT unique_id FROM {table}")
+    return [row[0] for row in c.fetchall()]
+
+
+@timed
+def get_table_signature(table):
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute(f"SELECT COUNT(*), MAX(id) FROM {table}")
+    return c.fetchone()
+
+
+@timed
+def enqueue_outbox(peer, message, expires_after):
+    conn = get_db_connection()
+    c = conn.cursor()
+    now = time.time()
+    c.execute("INSERT INTO outbox (peer, message, created, next_attempt, expires) VALUES (?, ?, ?, ?, ?)",
+              (peer, message, now, now, now + expires_after))
+    conn.commit()
+    return c.lastrowid
+
+
+@timed
+def get_outbox_peers(now):
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("SELECT DISTINCT peer FROM outbox WHERE next_attempt <= ?", (now,))
+    return [row[0] for row in c.fetchall()]
+
+
+@timed
+def get_outbox_messages(peer, now, limit):
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("SELECT id, message, attempts FROM outbox WHERE peer = ? AND next_attempt <= ? ORDER BY id LIMIT ?",
+              (peer, now, limit))
+    return c.fetchall()
+
+
+@timed
+def delete_outbox_message(outbox_id):
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("DELETE FROM outbox WHERE id = ?", (outbox_id,))
+    conn.commit()
+
+
+@timed
+def defer_outbox_message(outbox_id, attempts, next_attempt):
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("UPDATE outbox SET attempts = ?, next_attempt = ? WHERE id = ?", (attempts, next_attempt, outbox_id))
+    conn.commit()
+
+
+@timed
+def purge_expired_outbox(now):
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("DELETE FROM outbox WHERE expires <= ?", (now,))
+    conn.commit()
+    return c.rowcount
+
+
+@timed
+def get_outbox_depth():
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("SELECT peer, COUNT(*) FROM outbox GROUP BY peer")
+    return dict(c.fetchall())
+
+
+@timed
+def get_changes_since(seq, limit):
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("SELECT seq, kind, ref FROM changes WHERE seq > ? ORDER BY seq LIMIT ?", (seq, limit))
+    return c.fetchall()
+
+
+@timed
+def get_channel_by_id(channel_id):
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("SELECT name, url FROM channels WHERE id = ?", (channel_id,))
+    return c.fetchone()
+
+
+@timed
+def get_peer_cursor(peer):
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("SELECT cursor FROM peer_cursors WHERE peer = ?", (peer,))
+    result = c.fetchone()
+    if result:
+        return result[0]
+    return 0
+
+
+@timed
+def set_peer_cursor(peer, cursor):
+    conn = get_db_connection()
+    c = conn.cursor()
+    date = datetime.now().strftime('%Y-%m-%d %H:%M')
+    c.execute("INSERT OR REPLACE INTO peer_cursors (peer, cursor, updated) VALUES (?, ?, ?)", (peer, cursor, date))
+    conn.commit()
+
+
+@timed
+def save_session(user_id, data, updated):
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("INSERT OR REPLACE INTO sessions (user_id, data, updated) VALUES (?, ?, ?)", (user_id, data, updated))
+    conn.commit()
+
+
+@timed
+def replace_session_content(user_id, content):
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("DELETE FROM session_lines WHERE user_id = ?", (user_id,))
+    if content:
+        c.execute("INSERT INTO session_lines (user_id, line) VALUES (?, ?)", (user_id, content))
+    conn.commit()
+
+
+@timed
+def append_session_line(user_id, line, updated):
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("INSERT INTO session_lines (user_id, line) VALUES (?, ?)", (user_id, line))
+    c.execute("UPDATE sessions SET updated = ? WHERE user_id = ?", (updated, user_id))
+    conn.commit()
+
+
+@timed
+def delete_session(user_id):
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("DELETE FROM session_lines WHERE user_id = ?", (user_id,))
+    c.execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
+    conn.commit()
+
+
+@timed
+def load_sessions():
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("SELECT user_id, data, updated FROM sessions")
+    sessions = c.fetchall()
+    c.execute("SELECT user_id, line FROM session_lines ORDER BY id")
+    lines = {}
+    for user_id, line in c.fetchall():
+        lines.setdefault(user_id, []).append(line)
+    return [(user_id, data, updated, ''.join(lines.get(user_id, []))) for user_id, data, updated in sessions]
@@ -0,0 +1,124 @@
+"""
+Random fortunes from one or more fortune files.
+
+Each file is memory-mapped and indexed once by the offset of every non-blank
+line, so picking a fortune is one random index and one small slice of the
+map, however large the file is. Files are only re-indexed when their mtime or
+size changes, so fortunes can be edited while the BBS is running.
+
+When several files are configured each one is picked with its relative
+weight, e.g. `fortunes.txt:3, examples/example_RulesOfAcquisition_fortunes.txt:1`
+draws from fortunes.txt three times as often.
+"""
+
+import logging
+import mmap
+import os
+import random
+import threading
+from array import array
+
+
+class FortuneFile:
+    def __init__(self, path, weight=1):
+        self.path = path
+        self.weight = weight
+        self.offsets = array('Q')
+        self.data = None
+        self.signature = None
+
+    def close(self):
+        if self.data is not None:
+            self.data.close()
+            self.data = None
+        self.offsets = array('Q')
+
+    def refresh(self):
+        """Re-indexes the file if it changed since it was last indexed. Returns the number of fortunes."""
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            if self.signature is not None:
+                logging.error(f"Fortune file {self.path} is no longer available")
+            self.close()
+            self.signature = None
+            return 0
+
+        signature = (stat.st_mtime_ns, stat.st_size)
+        if signature == self.signature:
+            return len(self.offsets)
+
+        self.close()
+        self.signature = signature
+        if stat.st_size == 0:
+            return 0
+
+        with open(self.path, 'rb') as file:
+            self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # Every line start, skipping blank lines
+        start = 0
+        size = len(self.data)
+        while start < size:
+            end = self.data.find(b'\n', start)
+            if end < 0:
+                end = size
+            if self.data[start:end].strip():
+                self.offsets.append(start)
+            start = end + 1
+
+        logging.info(f"Indexed {len(self.offsets)} fortunes from {self.path}")
+        return len(self.offsets)
+
+    def read(self, index):
+        start = self.offsets[index]
+        end = self.data.find(b'\n', start)
+        if end < 0:
+            end = len(self.data)
+        # Collapse tabs and other runs of whitespace, as used in the example files
+        return ' '.join(self.data[start:end].decode('utf-8', errors='replace').split())
+
+
+class FortuneProvider:
+    def __init__(self, files=(('fortunes.txt', 1),)):
+        self._lock = threading.Lock()
+        self.files = []
+        self.configure(files)
+
+    def configure(self, files):
+        """Replaces the fortune files with a list of (path, weight) pairs."""
+        with self._lock:
+            for fortune_file in self.files:
+                fortune_file.close()
+            self.files = [FortuneFile(path, weight) for path, weight in files]
+
+    def pick(self):
+        """Returns a random fortune, or None if no fortune file has any."""
+        with self._lock:
+            available = [fortune_file for fortune_file in self.files if fortune_file.refresh() and fortune_file.weight > 0]
+            if not available:
+                return None
+            fortune_file = random.choices(available, weights=[f.weight for f in available])[0]
+            return fortune_file.read(random.randrange(len(fortune_file.offsets)))
+
+    def count(self):
+        with self._lock:
+            return sum(fortune_file.refresh() for fortune_file in self.files)
+
+
+def parse_fortune_files(value):
+    """Parses `path[:weight], path[:weight]` into (path, weight) pairs."""
+    files = []
+    for entry in value.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        path, _, weight = entry.rpartition(':')
+        if path and weight.strip().replace('.', '', 1).isdigit():
+            files.append((path.strip(), float(weight)))
+        else:
+            files.append((entry, 1))
+    return files
+
+
+fortunes = FortuneProvider()
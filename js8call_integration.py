@@ -1,16 +1,31 @@
-from socket import socket, AF_INET, SOCK_STREAM
+from socket import socket, AF_INET, SOCK_STREAM, SHUT_RDWR
 import json
+import re
+import queue
 import time
 import sqlite3
-import configparser
 import logging
+import threading
+from collections import OrderedDict, deque
 
 from meshtastic import BROADCAST_NUM
 
 from command_handlers import handle_help_command
-from utils import send_message, update_user_state
+from tracing import traced
+from utils import pack_lines, send_message, update_user_state
 
-config_file = 'config.ini'
+# Rows read per page of a listing; pack_lines() decides how many fit in a frame
+PAGE_ROWS = 8
+
+# Destination of an HF relay message: a callsign or an @GROUP
+JS8_DESTINATION = re.compile(r'^@?[A-Z0-9/]{3,}$')
+
+# Listing name -> (table, header, message when empty)
+JS8_LISTINGS = {
+    'groups': ('groups', "Messages for group {groupname}:", "No messages for group {groupname}."),
+    'station': ('messages', "Station Messages:", "No station messages available."),
+    'urgent': ('urgent', "Urgent Messages:", "No urgent messages available.")
+}
 
 def from_message(content):
     try:
@@ -24,37 +39,174 @@ def to_message(typ, value='', params=None):
     return json.dumps({'type': typ, 'value': value, 'params': params})
 
 
+class JS8LineReader:
+    """
+    Incremental reader for the newline-delimited JSON that JS8Call sends.
+
+    Bytes from recv() are fed in as they arrive; complete lines are parsed and
+    returned, and a trailing partial line is kept until the rest shows up. A
+    line that grows past `max_buffer` bytes is discarded up to its newline so
+    a misbehaving peer can't grow the buffer without limit.
+    """
+
+    def __init__(self, max_buffer=65536):
+        self.max_buffer = max_buffer
+        self.buffer = bytearray()
+        self.discarding = False
+
+        self.started = time.time()
+        self.bytes_received = 0
+        self.messages_received = 0
+        self.invalid_messages = 0
+        self.dropped_bytes = 0
+
+    def feed(self, data):
+        self.bytes_received += len(data)
+        self.buffer += data
+        messages = []
+
+        while True:
+            newline = self.buffer.find(b'\n')
+            if newline < 0:
+                break
+            line = bytes(self.buffer[:newline])
+            del self.buffer[:newline + 1]
+            if self.discarding:
+                # Tail of an oversized line we already gave up on
+                self.dropped_bytes += len(line) + 1
+                self.discarding = False
+                continue
+            message = self.parse(line)
+            if message:
+                messages.append(message)
+
+        if len(self.buffer) > self.max_buffer:
+            self.dropped_bytes += len(self.buffer)
+            self.buffer.clear()
+            self.discarding = True
+
+        return messages
+
+    def parse(self, line):
+        line = line.strip()
+        if not line:
+            return None
+        try:
+            message = json.loads(line.decode('utf-8'))
+        except ValueError:
+            self.invalid_messages += 1
+            return None
+        if not isinstance(message, dict):
+            self.invalid_messages += 1
+            return None
+        self.messages_received += 1
+        return message
+
+    def stats(self):
+        elapsed = max(time.time() - self.started, 1e-9)
+        return {
+            'bytes_received': self.bytes_received,
+            'messages_received': self.messages_received,
+            'invalid_messages': self.invalid_messages,
+            'dropped_bytes': self.dropped_bytes,
+            'messages_per_second': self.messages_received / elapsed,
+            'bytes_per_second': self.bytes_received / elapsed
+        }
+
+
 class JS8CallClient:
-    def __init__(self, interface, logger=None):
+    def __init__(self, interface, config, logger=None):
         self.logger = logger or logging.getLogger('js8call')
         self.logger.setLevel(logging.INFO)
         self.logger.propagate = False
 
-        self.config = configparser.ConfigParser()
-        self.config.read(config_file)
-
-        self.server = (
-            self.config.get('js8call', 'host', fallback=None),
-            self.config.getint('js8call', 'port', fallback=None)
-        )
-        self.db_file = self.config.get('js8call', 'db_file', fallback=None)
-        self.js8groups = self.config.get('js8call', 'js8groups', fallback='').split(',')
-        self.store_messages = self.config.getboolean('js8call', 'store_messages', fallback=True)
-        self.js8urgent = self.config.get('js8call', 'js8urgent', fallback='').split(',')
-        self.js8groups = [group.strip() for group in self.js8groups]
-        self.js8urgent = [group.strip() for group in self.js8urgent]
+        self.server = (None, None)
+        self.db_file = config.get('js8call', 'db_file', fallback=None)
+        self._thread = None
+        self._tx_thread = None
+        self.configure(config)
 
         self.connected = False
         self.sock = None
+        self.reader = None
         self.db_conn = None
+        self.db_lock = threading.Lock()
         self.interface = interface
 
+        self.state = 'stopped'
+        self.reconnects = 0
+        self.last_error = None
+        self.connected_since = None
+        self._stop = threading.Event()
+
+        # Received messages are queued by the client thread and written in batches by the ingest thread
+        self.ingest_queue = queue.Queue()
+        self._ingest_thread = None
+        self._ingest_lock = threading.Lock()
+        self._recent = OrderedDict()
+        self.ingest_started = time.time()
+        self.ingest_received = 0
+        self.ingest_stored = 0
+        self.ingest_duplicates = 0
+        self.ingest_failed = 0
+        self.ingest_batches = 0
+        self.ingest_lag = 0.0
+        self.ingest_max_lag = 0.0
+
+        # Messages from mesh users waiting to be sent over HF, paced by the tx thread
+        self.tx_queue = deque()
+        self.tx_recent = deque(maxlen=50)
+        self._tx_ready = threading.Condition()
+        self._send_lock = threading.Lock()
+        self.tx_next_id = 1
+        self.tx_sent = 0
+        self.tx_failed = 0
+
         if self.db_file:
-            self.db_conn = sqlite3.connect(self.db_file)
+            # One connection shared by the client thread and the menu handlers, guarded by db_lock
+            self.db_conn = sqlite3.connect(self.db_file, check_same_thread=False)
             self.create_tables()
         else:
             self.logger.info("JS8Call configuration not found. Skipping JS8Call integration.")
 
+    def configure(self, config):
+        """
+        Applies the [js8call] settings. Called again with the new config when it is reloaded:
+        a changed host or port drops the connection so the client reconnects to the new server.
+        """
+        server = (
+            config.get('js8call', 'host', fallback=None),
+            config.getint('js8call', 'port', fallback=None)
+        )
+        db_file = config.get('js8call', 'db_file', fallback=None)
+        if db_file != self.db_file:
+            self.logger.warning(f"JS8Call db_file changed to {db_file}, restart the BBS to use it")
+
+        self.js8groups = config.get('js8call', 'js8groups', fallback='').split(',')
+        self.store_messages = config.getboolean('js8call', 'store_messages', fallback=True)
+        self.js8urgent = config.get('js8call', 'js8urgent', fallback='').split(',')
+        self.js8groups = [group.strip() for group in self.js8groups]
+        self.js8urgent = [group.strip() for group in self.js8urgent]
+
+        self.reconnect_min = config.getint('js8call', 'reconnect_min', fallback=5)
+        self.reconnect_max = config.getint('js8call', 'reconnect_max', fallback=300)
+        self.ingest_batch_size = config.getint('js8call', 'ingest_batch_size', fallback=50)
+        self.ingest_flush_interval = config.getfloat('js8call', 'ingest_flush_interval', fallback=2)
+        self.dedupe_window = config.getint('js8call', 'dedupe_window', fallback=300)
+        self.allow_transmit = config.getboolean('js8call', 'allow_transmit', fallback=False)
+        self.tx_frame_seconds = config.getfloat('js8call', 'tx_frame_seconds', fallback=15)
+        self.tx_frame_chars = config.getint('js8call', 'tx_frame_chars', fallback=12)
+        self.tx_max_chars = config.getint('js8call', 'tx_max_chars', fallback=160)
+        self.tx_max_queue = config.getint('js8call', 'tx_max_queue', fallback=20)
+
+        if server != self.server:
+            self.server = server
+            if self._thread:
+                self.logger.info(f"JS8Call server changed to {server}, reconnecting")
+                self.close()
+        if self._thread and self.allow_transmit and not self._tx_thread:
+            self.start_transmitter()
+
     def create_tables(self):
         if not self.db_conn:
             return
@@ -87,48 +239,134 @@ class JS8CallClient:
                     timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
                 )
             ''')
+            # Listings are read newest first, the rowid in each index breaks timestamp ties
+            self.db_conn.execute('CREATE INDEX IF NOT EXISTS idx_groups_groupname_timestamp ON groups (groupname, timestamp)')
+            self.db_conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON messages (timestamp)')
+            self.db_conn.execute('CREATE INDEX IF NOT EXISTS idx_urgent_timestamp ON urgent (timestamp)')
         self.logger.info("Database tables created or verified.")
 
     def insert_message(self, table, sender, recipient, message):
         """
-        Inserts a message into the specified table in the database.
-
-        This method saves a message along with its sender and receiver or group name into the specified table.
-        If the database connection is not available, it logs an error message.
-
-        Parameters:
-        -----------
-        table : str
-            The name of the table where the message should be inserted. It can be 'messages', 'groups', or 'urgent'.
-        
-        sender : str
-            The meshtastic node identifier of the sender who issued the command
-        
-        recipient : str
-            The identifier of the receiver of the message or the group name.
-        
-        message : str
-            The content of the message.
+        Inserts a single message into 'messages', 'groups' or 'urgent'. The recipient is the
+        receiving callsign for 'messages' and the group name for the other tables.
 
         Example Usage:
         --------------
-        client.insert_message('messages', sender='CALLSIGN1', receiver_or_group='CALLSIGN2', message='This is a message.')
-        client.insert_message('groups', sender='CALLSIGN1', receiver_or_group='GroupName', message='This is a group message.')
-        client.insert_message('urgent', sender='CALLSIGN1', receiver_or_group='UrgentGroupName', message='This is an urgent message.')
+        client.insert_message('messages', 'CALLSIGN1', 'CALLSIGN2', 'This is a message.')
+        client.insert_message('groups', 'CALLSIGN1', '@GRP1', 'This is a group message.')
         """
+        return self.insert_messages([(table, sender, recipient, message, time.time())])
 
+    def insert_messages(self, rows):
+        """Writes (table, sender, recipient, message, received) rows in a single transaction."""
         if not self.db_conn:
             self.logger.error("Database connection is not available.")
-            return
+            return False
+
+        by_table = {}
+        for table, sender, recipient, message, received in rows:
+            timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(received))
+            by_table.setdefault(table, []).append((sender, recipient, message, timestamp))
 
         try:
-            with self.db_conn:
-                self.db_conn.execute(f'''
-                    INSERT INTO {table} (sender, { 'receiver' if table == 'messages' else 'groupname' }, message)
-                    VALUES (?, ?, ?)
-                ''', (sender, receiver_or_group, message))
+            with self.db_lock, self.db_conn:
+                for table, values in by_table.items():
+                    recipient_column = 'receiver' if table == 'messages' else 'groupname'
+                    self.db_conn.executemany(
+                        f"INSERT INTO {table} (sender, {recipient_column}, message, timestamp) VALUES (?, ?, ?, ?)",
+                        values
+                    )
         except sqlite3.Error as e:
-            self.logger.error(f"Failed to insert message into {table} table: {e}")
+            self.logger.error(f"Failed to store {len(rows)} JS8Call message(s): {e}")
+            return False
+        return True
+
+    def queue_message(self, table, sender, recipient, message):
+        """Queues a received message for the ingest thread, dropping repeat decodes within dedupe_window."""
+        now = time.time()
+        key = (sender, recipient, message)
+        with self._ingest_lock:
+            # Entries are in first-seen order, so expired ones are at the front
+            while self._recent and now - next(iter(self._recent.values())) > self.dedupe_window:
+                self._recent.popitem(last=False)
+            if key in self._recent:
+                self.ingest_duplicates += 1
+                return False
+            self._recent[key] = now
+            self.ingest_received += 1
+        self.ingest_queue.put((table, sender, recipient, message, now))
+        return True
+
+    def ingest(self):
+        """Writes queued messages in batches until stop() is called and the queue is drained."""
+        while not (self._stop.is_set() and self.ingest_queue.empty()):
+            try:
+                batch = [self.ingest_queue.get(timeout=self.ingest_flush_interval)]
+            except queue.Empty:
+                continue
+            deadline = time.time() + self.ingest_flush_interval
+            while len(batch) < self.ingest_batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.ingest_queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            if self.insert_messages(batch):
+                now = time.time()
+                with self._ingest_lock:
+                    self.ingest_stored += len(batch)
+                    self.ingest_batches += 1
+                    self.ingest_lag = now - batch[0][4]
+                    self.ingest_max_lag = max(self.ingest_max_lag, self.ingest_lag)
+            else:
+                with self._ingest_lock:
+                    self.ingest_failed += len(batch)
+
+    def ingest_stats(self):
+        with self._ingest_lock:
+            elapsed = max(time.time() - self.ingest_started, 1e-9)
+            return {
+                'ingest_received': self.ingest_received,
+                'ingest_stored': self.ingest_stored,
+                'ingest_duplicates': self.ingest_duplicates,
+                'ingest_failed': self.ingest_failed,
+                'ingest_batches': self.ingest_batches,
+                'ingest_queued': self.ingest_queue.qsize(),
+                'ingest_per_minute': self.ingest_stored * 60 / elapsed,
+                'ingest_lag': round(self.ingest_lag, 3),
+                'ingest_max_lag': round(self.ingest_max_lag, 3)
+            }
+
+    def fetch_group_names(self):
+        with self.db_lock:
+            return [row[0] for row in self.db_conn.execute("SELECT DISTINCT groupname FROM groups")]
+
+    def fetch_page(self, table, groupname=None, before=None, limit=PAGE_ROWS):
+        """
+        Returns up to `limit` (id, timestamp, sender, receiver or group, message) rows of a table,
+        newest first, starting after the (timestamp, id) cursor `before`.
+        """
+        recipient = 'receiver' if table == 'messages' else 'groupname'
+        conditions = []
+        params = []
+        if groupname is not None:
+            conditions.append("groupname = ?")
+            params.append(groupname)
+        if before:
+            timestamp, row_id = before
+            conditions.append("timestamp <= ? AND (timestamp < ? OR id < ?)")
+            params.extend([timestamp, timestamp, row_id])
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        params.append(limit)
+        with self.db_lock:
+            return self.db_conn.execute(
+                f"SELECT id, timestamp, sender, {recipient}, message FROM {table}{where} "
+                f"ORDER BY timestamp DESC, id DESC LIMIT ?",
+                params
+            ).fetchall()
 
     def process(self, message):
         typ = message.get('type', '')
@@ -160,13 +398,14 @@ class JS8CallClient:
             self.logger.info(f"Received JS8Call message: {sender} to {receiver} - {msg}")
 
             if receiver in self.js8urgent:
-                self.insert_urgent('urgent', sender, receiver, msg)
+                if not self.queue_message('urgent', sender, receiver, msg):
+                    return
                 notification_message = f"💥 URGENT JS8Call Message Received 💥\nFrom: {sender}\nCheck BBS for message"
                 send_message(notification_message, BROADCAST_NUM, self.interface)
             elif receiver in self.js8groups:
-                self.insert_message('groups', sender, receiver, msg)
+                self.queue_message('groups', sender, receiver, msg)
             elif self.store_messages:
-                self.insert_message('messages', sender, receiver, msg)
+                self.queue_message('messages', sender, receiver, msg)
         else:
             pass
 
@@ -176,7 +415,84 @@ class JS8CallClient:
             params['_ID'] = '{}'.format(int(time.time() * 1000))
             kwargs['params'] = params
         message = to_message(*args, **kwargs)
-        self.sock.send((message + '\n').encode('utf-8'))  # Convert to bytes
+        with self._send_lock:
+            self.sock.sendall((message + '\n').encode('utf-8'))  # Convert to bytes
+
+    def airtime(self, destination, text):
+        """Rough seconds JS8Call needs to transmit a message, from the characters per frame."""
+        frames = -(-(len(destination) + 1 + len(text)) // self.tx_frame_chars)
+        return frames * self.tx_frame_seconds
+
+    def queue_transmit(self, sender_id, destination, text):
+        """Queues a message from a mesh user for HF. Returns the queued item, or None if the queue is full."""
+        with self._tx_ready:
+            if len(self.tx_queue) >= self.tx_max_queue:
+                return None
+            item = {
+                'id': self.tx_next_id, 'sender_id': sender_id, 'destination': destination,
+                'text': text, 'status': 'queued', 'created': time.time(), 'attempts': 0
+            }
+            self.tx_next_id += 1
+            self.tx_queue.append(item)
+            self._tx_ready.notify()
+            return item
+
+    def transmit_status(self, sender_id):
+        """Returns (item, messages ahead of it) for a user's queued and recently finished messages."""
+        with self._tx_ready:
+            queued = [(item, position) for position, item in enumerate(self.tx_queue) if item['sender_id'] == sender_id]
+            finished = [(item, 0) for item in self.tx_recent if item['sender_id'] == sender_id]
+        return queued + finished
+
+    def transmit(self):
+        """Hands queued messages to JS8Call one at a time, waiting out each one's airtime before the next."""
+        while not self._stop.is_set():
+            with self._tx_ready:
+                while not self.tx_queue and not self._stop.is_set():
+                    self._tx_ready.wait(1)
+                if self._stop.is_set():
+                    break
+                item = self.tx_queue[0]
+
+            if not self.connected or not self.allow_transmit:
+                # Hold the queue until the client is reconnected or transmitting is allowed again
+                self._stop.wait(1)
+                continue
+
+            item['status'] = 'sending'
+            item['attempts'] += 1
+            try:
+                self.send("TX.SEND_MESSAGE", f"{item['destination']} {item['text']}")
+            except OSError as e:
+                self.logger.error(f"Failed to send HF message #{item['id']} to JS8Call: {e}")
+                item['status'] = 'queued'
+                if item['attempts'] < 3:
+                    self._stop.wait(self.tx_frame_seconds)
+                    continue
+                self.finish_transmit(item, 'failed')
+                send_message(f"Your JS8Call message #{item['id']} to {item['destination']} could not be sent.",
+                             item['sender_id'], self.interface)
+                continue
+
+            self.logger.info(f"Sent HF message #{item['id']} to {item['destination']} for {item['sender_id']}")
+            if self._stop.wait(self.airtime(item['destination'], item['text']) + self.tx_frame_seconds):
+                break
+            self.finish_transmit(item, 'sent')
+            send_message(f"Your JS8Call message #{item['id']} to {item['destination']} has been sent.",
+                         item['sender_id'], self.interface)
+
+    def finish_transmit(self, item, status):
+        with self._tx_ready:
+            if self.tx_queue and self.tx_queue[0] is item:
+                self.tx_queue.popleft()
+            item['status'] = status
+            self.tx_recent.append(item)
+            if status == 'sent':
+                self.tx_sent += 1
+            else:
+                self.tx_failed += 1
+            # stop() waits for the queue to empty
+            self._tx_ready.notify_all()
 
     def connect(self):
         if not self.server[0] or not self.server[1]:
@@ -185,42 +501,158 @@ class JS8CallClient:
 
         self.logger.info(f"Connecting to {self.server}")
         self.sock = socket(AF_INET, SOCK_STREAM)
+        self.reader = JS8LineReader()
         try:
             self.sock.connect(self.server)
             self.connected = True
+            self.connected_since = time.time()
+            self.state = 'connected'
             self.send("STATION.GET_STATUS")
 
             while self.connected:
-                content = self.sock.recv(65500).decode('utf-8')  # Decode received bytes to string
-                if not content:
-                    continue  # Skip empty content
-
-                try:
-                    message = json.loads(content)
-                except ValueError:
-                    continue  # Skip invalid JSON content
-
-                if not message:
-                    continue  # Skip empty message
-
-                self.process(message)
-        except ConnectionRefusedError:
+                data = self.sock.recv(65500)
+                if not data:
+                    if not self._stop.is_set():
+                        self.logger.warning(f"JS8Call server {self.server} closed the connection.")
+                    break
+
+                for message in self.reader.feed(data):
+                    try:
+                        self.process(message)
+                    except Exception as e:
+                        # One odd message shouldn't take the connection down
+                        self.logger.error(f"Failed to process JS8Call message {message!r}: {e}")
+        except ConnectionRefusedError as e:
+            self.last_error = str(e)
             self.logger.error(f"Connection to JS8Call server {self.server} refused.")
+        except OSError as e:
+            self.last_error = str(e)
+            if not self._stop.is_set():
+                self.logger.error(f"Connection to JS8Call server {self.server} lost: {e}")
         finally:
+            self.connected = False
+            self.connected_since = None
             self.sock.close()
+            self.logger.info(f"JS8Call connection closed. Stats: {self.reader.stats()}")
+
+    def run(self):
+        """Keeps the connection to JS8Call up, reconnecting with exponential backoff until stop() is called."""
+        delay = self.reconnect_min
+        while not self._stop.is_set():
+            self.state = 'connecting'
+            started = time.time()
+            try:
+                self.connect()
+            except Exception as e:
+                # Anything unexpected is treated like a lost connection, so the client backs off and retries
+                self.last_error = str(e)
+                self.logger.error(f"JS8Call client failed: {e}")
+            if self._stop.is_set():
+                break
+
+            # A connection that stayed up for a while resets the backoff
+            if time.time() - started > self.reconnect_max:
+                delay = self.reconnect_min
+            self.state = 'backoff'
+            self.reconnects += 1
+            self.logger.info(f"Reconnecting to JS8Call in {delay}s")
+            if self._stop.wait(delay):
+                break
+            delay = min(delay * 2, self.reconnect_max)
+        self.state = 'stopped'
+
+    def start(self):
+        if not self.server[0] or not self.server[1]:
+            self.logger.info("JS8Call server configuration not found. Skipping JS8Call connection.")
+            self.state = 'disabled'
+            return
+        self._stop.clear()
+        self._ingest_thread = threading.Thread(target=self.ingest, name="js8call-ingest", daemon=True)
+        self._ingest_thread.start()
+        self._thread = threading.Thread(target=self.run, name="js8call-client", daemon=True)
+        self._thread.start()
+        if self.allow_transmit:
+            self.start_transmitter()
+
+    def start_transmitter(self):
+        self._tx_thread = threading.Thread(target=self.transmit, name="js8call-tx", daemon=True)
+        self._tx_thread.start()
+
+    def stop(self, timeout=5):
+        deadline = time.monotonic() + timeout
+        # Give queued HF messages until the timeout to go out while JS8Call is still connected
+        if self._tx_thread and self._tx_thread.is_alive() and self.connected:
+            with self._tx_ready:
+                if self.tx_queue:
+                    self.logger.info(f"Waiting up to {timeout:.0f}s for {len(self.tx_queue)} queued HF message(s)")
+                    self._tx_ready.wait_for(lambda: not self.tx_queue, timeout)
+
+        self._stop.set()
+        self.close()
+        with self._tx_ready:
+            self._tx_ready.notify_all()
+            # The message being sent has already been handed to JS8Call; the rest never will be
+            dropped = [item for item in self.tx_queue if item['status'] != 'sending']
+            for item in dropped:
+                self.tx_queue.remove(item)
+        for item in dropped:
+            self.logger.warning(f"Dropping HF message #{item['id']} to {item['destination']} for {item['sender_id']}")
+            self.finish_transmit(item, 'failed')
+            send_message(f"Your JS8Call message #{item['id']} to {item['destination']} was not sent "
+                         f"before the BBS shut down.", item['sender_id'], self.interface)
+        remaining = max(deadline - time.monotonic(), 1)
+        if self._thread:
+            self._thread.join(remaining)
+        if self._tx_thread:
+            self._tx_thread.join(remaining)
+        if self._ingest_thread:
+            # Let the ingest thread write whatever is still queued
+            self._ingest_thread.join(remaining + self.ingest_flush_interval)
+        if self.db_conn:
+            with self.db_lock:
+                self.db_conn.close()
+                self.db_conn = None
+
+    def health(self):
+        health = {
+            'state': self.state,
+            'server': f"{self.server[0]}:{self.server[1]}",
+            'reconnects': self.reconnects,
+            'last_error': self.last_error,
+            'uptime': int(time.time() - self.connected_since) if self.connected_since else 0
+        }
+        if self.reader:
+            health.update(self.reader.stats())
+        health.update(self.ingest_stats())
+        if self.allow_transmit:
+            health.update({'tx_queued': len(self.tx_queue), 'tx_sent': self.tx_sent, 'tx_failed': self.tx_failed})
+        return health
 
     def close(self):
         self.connected = False
+        if self.sock:
+            try:
+                # Unblocks the recv() in connect() so the client thread can exit
+                self.sock.shutdown(SHUT_RDWR)
+            except OSError:
+                pass
 
 
+@traced()
 def handle_js8call_command(sender_id, interface):
-    response = "JS8Call Menu:\n[G]roup Messages\n[S]tation Messages\n[U]rgent Messages\nE[X]IT"
+    client = getattr(interface, 'js8call_client', None)
+    response = "JS8Call Menu:\n[G]roup Messages\n[S]tation Messages\n[U]rgent Messages\n"
+    if client and client.allow_transmit:
+        response += "[T]ransmit Message\n[Q]ueue Status\n"
+    response += "E[X]IT"
     send_message(response, sender_id, interface)
     update_user_state(sender_id, {'command': 'JS8CALL_MENU', 'step': 1})
 
 
+@traced()
 def handle_js8call_steps(sender_id, message, step, interface, state):
-    message = message.lower().strip()
+    text = message.strip()
+    message = text.lower()
     if len(message) == 2 and message[1] == 'x':
         message = message[0]
 
@@ -235,67 +667,159 @@ def handle_js8call_steps(sender_id, message, step, interface, state):
             handle_station_messages_command(sender_id, interface)
         elif choice == 'u':
             handle_urgent_messages_command(sender_id, interface)
+        elif choice == 't':
+            handle_transmit_command(sender_id, interface)
+        elif choice == 'q':
+            handle_transmit_status_command(sender_id, interface)
         else:
             send_message("Invalid option. Please choose again.", sender_id, interface)
             handle_js8call_command(sender_id, interface)
 
+    elif step == 2:
+        destination = text.upper()
+        if message == 'x':
+            handle_js8call_command(sender_id, interface)
+        elif not JS8_DESTINATION.match(destination):
+            send_message("Invalid callsign or group. Enter a callsign or @GROUP, or X to cancel:", sender_id, interface)
+        else:
+            client = get_transmit_client(interface)
+            limit = client.tx_max_chars if client else 0
+            send_message(f"Enter your message for {destination} (up to {limit} characters), or X to cancel:",
+                         sender_id, interface)
+            update_user_state(sender_id, {'command': 'JS8CALL_MENU', 'step': 3, 'recipient_id': destination})
+
+    elif step == 3:
+        if message == 'x':
+            handle_js8call_command(sender_id, interface)
+            return
+        client = get_transmit_client(interface)
+        if not client:
+            send_message("HF relay is not available on this BBS.", sender_id, interface)
+            handle_js8call_command(sender_id, interface)
+            return
+        # JS8Call only sends upper case
+        text = ' '.join(text.upper().split())
+        if not text or len(text) > client.tx_max_chars:
+            send_message(f"Messages must be 1 to {client.tx_max_chars} characters. Please try again:", sender_id, interface)
+            return
+        destination = state['recipient_id']
+        item = client.queue_transmit(sender_id, destination, text)
+        if item:
+            ahead = len(client.tx_queue) - 1
+            send_message(f"Queued as #{item['id']} for {destination} ({ahead} ahead of it). "
+                         f"You'll be notified once it has been sent.", sender_id, interface)
+        else:
+            send_message("The HF transmit queue is full. Please try again later.", sender_id, interface)
+        handle_js8call_command(sender_id, interface)
+
+
+def get_transmit_client(interface):
+    client = getattr(interface, 'js8call_client', None)
+    return client if client and client.allow_transmit and client.state != 'disabled' else None
+
+
+@traced()
+def handle_transmit_command(sender_id, interface):
+    if not get_transmit_client(interface):
+        send_message("HF relay is not available on this BBS.", sender_id, interface)
+        handle_js8call_command(sender_id, interface)
+        return
+    send_message("Enter the callsign or @GROUP to send to, or X to cancel:", sender_id, interface)
+    update_user_state(sender_id, {'command': 'JS8CALL_MENU', 'step': 2})
+
+
+@traced()
+def handle_transmit_status_command(sender_id, interface):
+    client = get_transmit_client(interface)
+    items = client.transmit_status(sender_id) if client else []
+    if items:
+        lines = []
+        for item, ahead in items:
+            status = f"queued, {ahead} ahead" if item['status'] == 'queued' else item['status']
+            lines.append(f"#{item['id']} to {item['destination']}: {status}")
+        response, _ = pack_lines("Your HF messages:", lines[-PAGE_ROWS:])
+        send_message(response, sender_id, interface)
+    else:
+        send_message("You have no HF messages queued.", sender_id, interface)
+    handle_js8call_command(sender_id, interface)
+
+
+def get_js8call_client(interface):
+    client = getattr(interface, 'js8call_client', None)
+    return client if client and client.db_conn else None
+
+
+def send_js8call_page(sender_id, interface, listing, groupname=None, before=None):
+    client = get_js8call_client(interface)
+    if not client:
+        send_message("JS8Call messages are not available.", sender_id, interface)
+        handle_help_command(sender_id, interface, 'bbs')
+        return
+
+    table, header, empty = JS8_LISTINGS[listing]
+    rows = client.fetch_page(table, groupname, before, PAGE_ROWS + 1)
+    if not rows:
+        if before is None:
+            send_message(empty.format(groupname=groupname), sender_id, interface)
+        handle_js8call_command(sender_id, interface)
+        return
+
+    if listing == 'groups':
+        lines = [f"{row[2]}: {row[4]} ({row[1]})" for row in rows[:PAGE_ROWS]]
+    else:
+        lines = [f"{row[2]} -> {row[3]}: {row[4]} ({row[1]})" for row in rows[:PAGE_ROWS]]
+    footer = "[M]ore\nE[X]IT"
+    response, count = pack_lines(header.format(groupname=groupname), lines, footer)
+
+    if count < len(rows):
+        send_message(response, sender_id, interface)
+        last = rows[count - 1]
+        update_user_state(sender_id, {
+            'command': 'JS8CALL_PAGE', 'step': 1, 'view': listing, 'groupname': groupname,
+            'cursor': [last[1], last[0]]
+        })
+    else:
+        send_message(response[:-len(footer) - 1], sender_id, interface)
+        handle_js8call_command(sender_id, interface)
+
+
+@traced()
+def handle_js8call_page_steps(sender_id, message, state, interface):
+    if message.lower().strip() == 'm':
+        send_js8call_page(sender_id, interface, state['view'], state.get('groupname'), state['cursor'])
+    else:
+        handle_js8call_command(sender_id, interface)
 
 
+@traced()
 def handle_group_messages_command(sender_id, interface):
-    conn = sqlite3.connect('js8call.db')
-    c = conn.cursor()
-    c.execute("SELECT DISTINCT groupname FROM groups")
-    groups = c.fetchall()
+    client = get_js8call_client(interface)
+    groups = client.fetch_group_names() if client else []
     if groups:
-        response = "Group Messages Menu:\n" + "\n".join([f"[{i}] {group[0]}" for i, group in enumerate(groups)])
+        response = "Group Messages Menu:\n" + "\n".join([f"[{i}] {group}" for i, group in enumerate(groups)])
         send_message(response, sender_id, interface)
         update_user_state(sender_id, {'command': 'GROUP_MESSAGES', 'step': 1, 'groups': groups})
     else:
         send_message("No group messages available.", sender_id, interface)
         handle_js8call_command(sender_id, interface)
 
+@traced()
 def handle_station_messages_command(sender_id, interface):
-    conn = sqlite3.connect('js8call.db')
-    c = conn.cursor()
-    c.execute("SELECT sender, receiver, message, timestamp FROM messages")
-    messages = c.fetchall()
-    if messages:
-        response = "Station Messages:\n" + "\n".join([f"[{i+1}] {msg[0]} -> {msg[1]}: {msg[2]} ({msg[3]})" for i, msg in enumerate(messages)])
-        send_message(response, sender_id, interface)
-    else:
-        send_message("No station messages available.", sender_id, interface)
-    handle_js8call_command(sender_id, interface)
+    send_js8call_page(sender_id, interface, 'station')
 
+@traced()
 def handle_urgent_messages_command(sender_id, interface):
-    conn = sqlite3.connect('js8call.db')
-    c = conn.cursor()
-    c.execute("SELECT sender, groupname, message, timestamp FROM urgent")
-    messages = c.fetchall()
-    if messages:
-        response = "Urgent Messages:\n" + "\n".join([f"[{i+1}] {msg[0]} -> {msg[1]}: {msg[2]} ({msg[3]})" for i, msg in enumerate(messages)])
-        send_message(response, sender_id, interface)
-    else:
-        send_message("No urgent messages available.", sender_id, interface)
-    handle_js8call_command(sender_id, interface)
+    send_js8call_page(sender_id, interface, 'urgent')
 
+@traced()
 def handle_group_message_selection(sender_id, message, step, state, interface):
     groups = state['groups']
     try:
         group_index = int(message)
-        groupname = groups[group_index][0]
-
-        conn = sqlite3.connect('js8call.db')
-        c = conn.cursor()
-        c.execute("SELECT sender, message, timestamp FROM groups WHERE groupname=?", (groupname,))
-        messages = c.fetchall()
-
-        if messages:
-            response = f"Messages for group {groupname}:\n" + "\n".join([f"[{i+1}] {msg[0]}: {msg[1]} ({msg[2]})" for i, msg in enumerate(messages)])
-            send_message(response, sender_id, interface)
-        else:
-            send_message(f"No messages for group {groupname}.", sender_id, interface)
+        groupname = groups[group_index]
     except (IndexError, ValueError):
         send_message("Invalid group selection. Please choose again.", sender_id, interface)
         handle_group_messages_command(sender_id, interface)
+        return
 
-    handle_js8call_command(sender_id, interface)
\ No newline at end of file
+    send_js8call_page(sender_id, interface, 'groups', groupname)
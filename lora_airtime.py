@@ -0,0 +1,39 @@
+"""
+LoRa time-on-air estimates, from the formula in the Semtech SX127x datasheet.
+
+The defaults match Meshtastic's LongFast preset (SF11, 250 kHz, coding rate
+4/5, 16 symbol preamble). PACKET_OVERHEAD approximates the Meshtastic radio
+header and protobuf wrapping added around a text payload.
+"""
+
+import math
+
+PACKET_OVERHEAD = 32
+
+spreading_factor = 11
+bandwidth = 250000
+coding_rate = 5
+preamble = 16
+
+
+def configure(sf=None, bw=None, cr=None):
+    global spreading_factor, bandwidth, coding_rate
+    if sf is not None:
+        spreading_factor = sf
+    if bw is not None:
+        bandwidth = bw
+    if cr is not None:
+        coding_rate = cr
+
+
+def airtime(payload_bytes, sf=None, bw=None, cr=None):
+    """Returns the seconds a packet carrying `payload_bytes` of text is on the air."""
+    sf = sf or spreading_factor
+    bw = bw or bandwidth
+    cr = cr or coding_rate
+    symbol_time = (2 ** sf) / bw
+    # Low data rate optimisation is mandatory once a symbol lasts longer than 16 ms
+    low_data_rate = 1 if symbol_time > 0.016 else 0
+    size = payload_bytes + PACKET_OVERHEAD
+    payload_symbols = 8 + max(math.ceil((8 * size - 4 * sf + 28 + 16) / (4 * (sf - 2 * low_data_rate))) * cr, 0)
+    return (preamble + 4.25 + payload_symbols) * symbol_time
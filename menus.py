@@ -0,0 +1,93 @@
+"""
+Menus compiled once from the [menu] config.
+
+Each menu is rendered to its text and split into payload-sized frames when
+it is compiled, so showing a menu is just sending the ready frames. Fields
+that change per user (the main menu's mail count) are left as placeholders
+and measured at their widest when the frames are laid out, so filling them
+in never pushes a frame over the payload size.
+"""
+
+import threading
+
+from utils import MAX_PAYLOAD_BYTES
+
+ITEM_LABELS = {
+    'Q': "[Q]uick Commands",
+    'B': "[B]BS",
+    'U': "[U]tilities",
+    'X': "E[X]IT",
+    'M': "[M]ail",
+    'C': "[C]hannel Dir",
+    'J': "[J]S8CALL",
+    'S': "[S]tats",
+    'F': "[F]ortune",
+    'W': "[W]all of Shame"
+}
+
+# Menu name -> (config option, default items, title, labels that differ in this menu)
+MENUS = {
+    'main': ('main_menu_items', "Q, B, U, X", "💾TC² BBS💾 (✉️:{mail_count})", {}),
+    'bbs': ('bbs_menu_items', "M, B, C, J, X", "📰BBS Menu📰", {'B': "[B]ulletins"}),
+    'utilities': ('utilities_menu_items', "S, F, W, X", "🛠️Utilities Menu🛠️", {})
+}
+
+# Widest value of each dynamic field, used to measure the frames
+FIELD_WIDTHS = {'mail_count': "99999"}
+
+
+class CompiledMenu:
+    __slots__ = ('frames', 'dynamic')
+
+    def __init__(self, lines, max_bytes=MAX_PAYLOAD_BYTES):
+        self.frames = []
+        frame = []
+        size = 0
+        for line in lines:
+            line_size = len(line.format(**FIELD_WIDTHS).encode('utf-8')) + 1
+            if frame and size + line_size > max_bytes:
+                self.frames.append("\n".join(frame))
+                frame = []
+                size = 0
+            frame.append(line)
+            size += line_size
+        if frame:
+            self.frames.append("\n".join(frame))
+        self.dynamic = [('{' in frame) for frame in self.frames]
+
+    def render(self, **fields):
+        return [frame.format(**fields) if dynamic else frame for frame, dynamic in zip(self.frames, self.dynamic)]
+
+    def __len__(self):
+        return len(self.frames)
+
+
+_menus = {}
+_lock = threading.Lock()
+
+
+def compile_menus(config=None):
+    """Compiles every menu from the [menu] section of `config`, or the defaults if there is none."""
+    menus = {}
+    for name, (option, default, title, labels) in MENUS.items():
+        items = default
+        if config is not None:
+            items = config.get('menu', option, fallback=default)
+        lines = [title]
+        for item in items.split(','):
+            item = item.strip()
+            if item in ITEM_LABELS:
+                lines.append(labels.get(item, ITEM_LABELS[item]))
+        menus[name] = CompiledMenu(lines)
+
+    global _menus
+    with _lock:
+        _menus = menus
+
+
+def render_menu(name, **fields):
+    """Returns the frames for a menu with its dynamic fields filled in."""
+    return _menus[name].render(**fields)
+
+
+compile_menus()
@@ -8,11 +8,30 @@ from command_handlers import (
     handle_channel_directory_command, handle_channel_directory_steps, handle_send_mail_command,
     handle_read_mail_command, handle_check_mail_command, handle_delete_mail_confirmation, handle_post_bulletin_command,
     handle_check_bulletin_command, handle_read_bulletin_command, handle_read_channel_command,
-    handle_post_channel_command, handle_list_channels_command, handle_quick_help_command
+    handle_post_channel_command, handle_list_channels_command, handle_quick_help_command, handle_trace_command
 )
-from db_operations import add_bulletin, add_mail, delete_bulletin, delete_mail, get_db_connection, add_channel
-from js8call_integration import handle_js8call_command, handle_js8call_steps, handle_group_message_selection
-from utils import get_user_state, get_node_short_name, get_node_id_from_num, send_message
+from db_operations import (
+    add_bulletin, add_mail, delete_bulletin, delete_mail, get_db_connection, add_channel,
+    is_tombstoned, unique_id_exists
+)
+from js8call_integration import (
+    handle_group_message_selection, handle_js8call_command, handle_js8call_page_steps, handle_js8call_steps
+)
+from sync_delta import DELTA_PREFIXES, handle_delta_message
+from sync_framing import FRAME_PREFIX, reassembler, split_fields
+from sync_reconcile import RECONCILE_PREFIXES, handle_reconcile_message
+from metrics import registry
+import packet_capture
+from tracing import trace
+from utils import get_user_state, get_node_short_name, get_node_id_from_num, send_message, sync_messages
+
+SYNC_PREFIXES = ("BULLETIN|", "MAIL|", "DELETE_BULLETIN|", "DELETE_MAIL|", "CHANNEL|") + RECONCILE_PREFIXES + DELTA_PREFIXES
+
+# Quick commands, as labels for the command latency metric
+QUICK_COMMANDS = ("sm,,", "cm", "pb,,", "cb,,", "chp,,", "chl", "trace")
+
+packets_received = registry.counter('bbs_packets_received_total', "Packets received, by port", ('port',))
+command_latency = registry.histogram('bbs_command_seconds', "Time taken to handle a message, by command", ('command',))
 
 main_menu_handlers = {
     "q": handle_quick_help_command,
@@ -65,30 +84,45 @@ def process_message(sender_id, message, interface, is_sync_message=False):
         message_lower = message_lower[0]
 
     if is_sync_message:
-        if message.startswith("BULLETIN|"):
-            parts = message.split("|")
-            board, sender_short_name, subject, content, unique_id = parts[1], parts[2], parts[3], parts[4], parts[5]
-            add_bulletin(board, sender_short_name, subject, content, [], interface, unique_id=unique_id)
-
-            if board.lower() == "urgent":
-                notification_message = f"💥NEW URGENT BULLETIN💥\nFrom: {sender_short_name}\nTitle: {subject}\nDM 'CB,,Urgent' to view"
-                send_message(notification_message, BROADCAST_NUM, interface)
-        elif message.startswith("MAIL|"):
-            parts = message.split("|")
-            sender_id, sender_short_name, recipient_id, subject, content, unique_id = parts[1], parts[2], parts[3], parts[4], parts[5], parts[6]
-            add_mail(sender_id, sender_short_name, recipient_id, subject, content, [], interface, unique_id=unique_id)
-        elif message.startswith("DELETE_BULLETIN|"):
-            unique_id = message.split("|")[1]
-            delete_bulletin(unique_id, [], interface)
-        elif message.startswith("DELETE_MAIL|"):
-            unique_id = message.split("|")[1]
-            logging.info(f"Processing delete mail with unique_id: {unique_id}")
-            recipient_id = get_recipient_id_by_mail(unique_id)
-            delete_mail(unique_id, recipient_id, [], interface)
-        elif message.startswith("CHANNEL|"):
-            parts = message.split("|")
-            channel_name, channel_url = parts[1], parts[2]
-            add_channel(channel_name, channel_url)
+        try:
+            if message.startswith("BULLETIN|"):
+                parts = split_fields(message)
+                board, sender_short_name, subject, content, unique_id = parts[1], parts[2], parts[3], parts[4], parts[5]
+                if unique_id_exists('bulletins', unique_id) or is_tombstoned(unique_id):
+                    logging.info(f"Ignoring already known bulletin with unique_id: {unique_id}")
+                    return
+                add_bulletin(board, sender_short_name, subject, content, [], interface, unique_id=unique_id,
+                             from_peer=True)
+
+                if board.lower() == "urgent":
+                    notification_message = f"💥NEW URGENT BULLETIN💥\nFrom: {sender_short_name}\nTitle: {subject}\nDM 'CB,,Urgent' to view"
+                    send_message(notification_message, BROADCAST_NUM, interface)
+            elif message.startswith("MAIL|"):
+                parts = split_fields(message)
+                sender_id, sender_short_name, recipient_id, subject, content, unique_id = parts[1], parts[2], parts[3], parts[4], parts[5], parts[6]
+                if unique_id_exists('mail', unique_id) or is_tombstoned(unique_id):
+                    logging.info(f"Ignoring already known mail with unique_id: {unique_id}")
+                    return
+                add_mail(sender_id, sender_short_name, recipient_id, subject, content, [], interface, unique_id=unique_id,
+                         from_peer=True)
+            elif message.startswith("DELETE_BULLETIN|"):
+                unique_id = split_fields(message)[1]
+                delete_bulletin(unique_id, [], interface)
+            elif message.startswith("DELETE_MAIL|"):
+                unique_id = split_fields(message)[1]
+                logging.info(f"Processing delete mail with unique_id: {unique_id}")
+                recipient_id = get_recipient_id_by_mail(unique_id)
+                delete_mail(unique_id, recipient_id, [], interface)
+            elif message.startswith("CHANNEL|"):
+                parts = split_fields(message)
+                channel_name, channel_url = parts[1], parts[2]
+                add_channel(channel_name, channel_url, from_peer=True)
+            elif message.startswith(RECONCILE_PREFIXES):
+                handle_reconcile_message(get_node_id_from_num(sender_id, interface), message, interface)
+            elif message.startswith(DELTA_PREFIXES):
+                handle_delta_message(get_node_id_from_num(sender_id, interface), split_fields(message), interface)
+        except IndexError:
+            logging.error(f"Malformed sync message from {sender_id}: {message}")
     else:
         if message_lower.startswith("sm,,"):
             handle_send_mail_command(sender_id, message_strip, interface, bbs_nodes)
@@ -102,6 +136,8 @@ def process_message(sender_id, message, interface, is_sync_message=False):
             handle_post_channel_command(sender_id, message_strip, interface)
         elif message_lower.startswith("chl"):
             handle_list_channels_command(sender_id, interface)
+        elif message_lower == "trace":
+            handle_trace_command(sender_id, interface)
         else:
             if state and state['command'] == 'MENU':
                 menu_name = state['menu']
@@ -121,6 +157,9 @@ def process_message(sender_id, message, interface, is_sync_message=False):
             elif state and state['command'] == 'GROUP_MESSAGES':
                 handle_group_message_selection(sender_id, message, state['step'], state, interface)
                 return
+            elif state and state['command'] == 'JS8CALL_PAGE':
+                handle_js8call_page_steps(sender_id, message, state, interface)
+                return
             else:
                 handlers = main_menu_handlers
 
@@ -176,7 +215,21 @@ def process_message(sender_id, message, interface, is_sync_message=False):
                 handle_help_command(sender_id, interface)
 
 
+def command_label(sender_id, message, is_sync_message):
+    """Names the command a message is for, from a small fixed set so the metric labels stay bounded."""
+    if is_sync_message:
+        return message.split('|', 1)[0]
+    message_lower = message.lower().strip()
+    for prefix in QUICK_COMMANDS:
+        if message_lower.startswith(prefix):
+            return prefix.rstrip(',').upper()
+    state = get_user_state(sender_id)
+    return state['command'] if state else 'MENU'
+
+
 def on_receive(packet, interface):
+    packet_capture.record(packet)
+    packets_received.inc(port=packet.get('decoded', {}).get('portnum', 'ENCRYPTED'))
     try:
         if 'decoded' in packet and packet['decoded']['portnum'] == 'TEXT_MESSAGE_APP':
             message_bytes = packet['decoded']['payload']
@@ -191,16 +244,28 @@ def on_receive(packet, interface):
             logging.info(f"Received message from user '{sender_short_name}' ({sender_node_id}) to {receiver_short_name}: {message_string}")
 
             bbs_nodes = interface.bbs_nodes
-            is_sync_message = any(message_string.startswith(prefix) for prefix in
-                                  ["BULLETIN|", "MAIL|", "DELETE_BULLETIN|", "DELETE_MAIL|"])
+            if sender_node_id in bbs_nodes and message_string.startswith(FRAME_PREFIX):
+                # Part of a multi-frame sync message; wait until every part is in
+                message_string = reassembler.add(sender_node_id, message_string)
+                if message_string is None:
+                    return
+            is_sync_message = message_string.startswith(SYNC_PREFIXES)
 
             if sender_node_id in bbs_nodes:
+                outbox = getattr(interface, 'outbox', None)
+                if outbox is not None:
+                    outbox.notify_heard(sender_node_id)
                 if is_sync_message:
-                    process_message(sender_id, message_string, interface, is_sync_message=True)
+                    sync_messages.inc(peer=sender_node_id, direction='received')
+                    label = command_label(sender_id, message_string, True)
+                    with command_latency.time(command=label), trace('process_message', command=label):
+                        process_message(sender_id, message_string, interface, is_sync_message=True)
                 else:
                     logging.info("Ignoring non-sync message from known BBS node")
             elif to_id is not None and to_id != 0 and to_id != 255 and to_id == interface.myInfo.my_node_num:
-                process_message(sender_id, message_string, interface, is_sync_message=False)
+                label = command_label(sender_id, message_string, False)
+                with command_latency.time(command=label), trace('process_message', command=label):
+                    process_message(sender_id, message_string, interface, is_sync_message=False)
             else:
                 logging.info("Ignoring message sent to group chat or from unknown node")
     except KeyError as e:
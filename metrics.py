@@ -0,0 +1,231 @@
+"""
+In-process metrics: counters, gauges and histograms with labels.
+
+Metrics are registered once at import time in the module that updates them,
+and read by two optional exporters:
+
+    start_http_server(port)          Prometheus text format on http://host:port/metrics
+    start_json_writer(path, interval) the same values as a JSON snapshot, rewritten
+                                      every `interval` seconds
+
+Gauges can be given a function instead of being set, so values that already
+live elsewhere (queue depths, session counts) are only read when exported.
+"""
+
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Seconds; covers a fast SQLite query up to a reply that waits on several sends
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(label, '')) for label in self.labels)
+
+    def collect(self):
+        """Returns a list of (label values, value) pairs."""
+        with self._lock:
+            return list(self._values.items())
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, description, labels=(), function=None):
+        super().__init__(name, description, labels)
+        self.function = function
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def collect(self):
+        if self.function is None:
+            return super().collect()
+        try:
+            value = self.function()
+        except Exception as e:
+            logging.error(f"Failed to read metric {self.name}: {e}")
+            return []
+        # Functions return either a single value or a dict of label values -> value
+        if isinstance(value, dict):
+            return list(value.items())
+        return [((), value)]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # One count per bucket plus +Inf, then the sum
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def collect(self):
+        with self._lock:
+            return [(key, list(counts)) for key, counts in self._values.items()]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, cls, name, *args, **kwargs):
+        with self._lock:
+            if name not in self.metrics:
+                self.metrics[name] = cls(name, *args, **kwargs)
+            return self.metrics[name]
+
+    def counter(self, name, description, labels=()):
+        return self._register(Counter, name, description, labels)
+
+    def gauge(self, name, description, labels=(), function=None):
+        return self._register(Gauge, name, description, labels, function=function)
+
+    def histogram(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram, name, description, labels, buckets=buckets)
+
+    def render(self):
+        """Returns every metric in the Prometheus text exposition format."""
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for key, value in metric.collect():
+                labels = list(zip(metric.labels, key))
+                if metric.kind != 'histogram':
+                    lines.append(f"{metric.name}{format_labels(labels)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(metric.buckets + ('+Inf',), value[:-1]):
+                    cumulative += count
+                    lines.append(f"{metric.name}_bucket{format_labels(labels + [('le', bound)])} {cumulative}")
+                lines.append(f"{metric.name}_sum{format_labels(labels)} {value[-1]}")
+                lines.append(f"{metric.name}_count{format_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """Returns every metric as a dict, with histograms summarised by count, sum and bucket counts."""
+        snapshot = {'time': time.time()}
+        for metric in list(self.metrics.values()):
+            samples = []
+            for key, value in metric.collect():
+                sample = {'labels': dict(zip(metric.labels, key))}
+                if metric.kind == 'histogram':
+                    sample['count'] = sum(value[:-1])
+                    sample['sum'] = value[-1]
+                    sample['buckets'] = dict(zip([str(bound) for bound in metric.buckets] + ['+Inf'], value[:-1]))
+                else:
+                    sample['value'] = value
+                samples.append(sample)
+            snapshot[metric.name] = samples
+        return snapshot
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in labels) + '}'
+
+
+registry = Registry()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port, host='127.0.0.1'):
+    """Serves the metrics for Prometheus on a daemon thread."""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True)
+    thread.start()
+    logging.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
+
+
+def write_snapshot(path):
+    # Written to a temporary file first so readers never see a partial snapshot
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w') as file:
+        json.dump(registry.snapshot(), file)
+    os.replace(temp_path, path)
+
+
+def start_json_writer(path, interval):
+    """Writes a JSON snapshot of the metrics to `path` every `interval` seconds on a daemon thread."""
+    stop_event = threading.Event()
+
+    def run():
+        while not stop_event.wait(interval):
+            try:
+                write_snapshot(path)
+            except OSError as e:
+                logging.error(f"Failed to write metrics to {path}: {e}")
+
+    thread = threading.Thread(target=run, name="metrics-json", daemon=True)
+    thread.stop_event = stop_event
+    thread.start()
+    logging.info(f"Writing metrics to {path} every {interval}s")
+    return thread
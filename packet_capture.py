@@ -0,0 +1,165 @@
+"""
+Packet capture, for replaying real traffic with replay.py.
+
+When a capture file is configured every packet on_receive is given is
+appended to it with the time it arrived. The file is a short header followed
+by length-prefixed records, all integers big-endian:
+
+    header   b'BBSCAP', version (1 byte), this BBS's node number (uint32)
+    record   length (uint32), then
+             receive time (float64), from (uint32), to (uint32),
+             fromId length (1 byte) + fromId, portnum length (1 byte) + portnum,
+             payload bytes up to the end of the record
+
+Packets that arrive without a decoded part are recorded with the portnum
+ENCRYPTED and no payload.
+"""
+
+import logging
+import os
+import struct
+import threading
+import time
+
+MAGIC = b'BBSCAP'
+VERSION = 1
+HEADER = struct.Struct('>6sBI')
+LENGTH = struct.Struct('>I')
+RECORD = struct.Struct('>dII')
+
+_file = None
+_path = None
+_lock = threading.Lock()
+
+
+def configure(path, my_node_num):
+    """Starts appending to the capture file at `path`, or stops capturing if path is empty."""
+    global _file, _path
+    with _lock:
+        if path == _path and _file is not None:
+            return
+        if _file is not None:
+            _file.close()
+            _file = None
+        _path = path
+        if not path:
+            return
+
+        try:
+            file = open(path, 'r+b' if os.path.exists(path) else 'w+b')
+            header = file.read(HEADER.size)
+            if not header:
+                file.write(HEADER.pack(MAGIC, VERSION, my_node_num))
+            else:
+                magic, version, node_num = HEADER.unpack(header)
+                if magic != MAGIC or version != VERSION:
+                    file.close()
+                    logging.error(f"Not capturing packets: {path} is not a version {VERSION} capture file")
+                    return
+                if node_num != my_node_num:
+                    logging.warning(f"Capture file {path} was started by node {node_num}, appending anyway")
+                # Drop a record left half-written by a crash so new records line up
+                file.truncate(complete_length(file))
+                file.seek(0, os.SEEK_END)
+        except (OSError, struct.error) as e:
+            logging.error(f"Not capturing packets to {path}: {e}")
+            return
+        _file = file
+    logging.info(f"Capturing received packets to {path}")
+
+
+def close():
+    configure('', 0)
+
+
+def complete_length(file):
+    """Returns the length of a capture file up to the end of its last complete record."""
+    size = file.seek(0, os.SEEK_END)
+    position = HEADER.size
+    while position + LENGTH.size <= size:
+        file.seek(position)
+        end = position + LENGTH.size + LENGTH.unpack(file.read(LENGTH.size))[0]
+        if end > size:
+            break
+        position = end
+    return position
+
+
+def encode(packet):
+    decoded = packet.get('decoded')
+    if decoded is None:
+        portnum, payload = 'ENCRYPTED', b''
+    else:
+        portnum = str(decoded.get('portnum', ''))
+        payload = decoded.get('payload', b'')
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+    from_id = (packet.get('fromId') or '').encode('utf-8')[:255]
+    portnum = portnum.encode('utf-8')[:255]
+    body = b''.join((
+        RECORD.pack(time.time(), packet.get('from', 0) & 0xFFFFFFFF, (packet.get('to') or 0) & 0xFFFFFFFF),
+        bytes((len(from_id),)), from_id,
+        bytes((len(portnum),)), portnum,
+        payload
+    ))
+    return LENGTH.pack(len(body)) + body
+
+
+def decode(body):
+    """Returns (receive time, packet) for a record body."""
+    received, sender, to = RECORD.unpack_from(body)
+    offset = RECORD.size
+    from_id = body[offset + 1:offset + 1 + body[offset]].decode('utf-8')
+    offset += 1 + body[offset]
+    portnum = body[offset + 1:offset + 1 + body[offset]].decode('utf-8')
+    offset += 1 + body[offset]
+    packet = {'from': sender, 'fromId': from_id or None, 'to': to}
+    if portnum != 'ENCRYPTED':
+        packet['decoded'] = {'portnum': portnum, 'payload': body[offset:]}
+    return received, packet
+
+
+def record(packet):
+    """Appends a received packet to the capture file, if capturing."""
+    if _file is None:
+        return
+    data = encode(packet)
+    with _lock:
+        if _file is None:
+            return
+        try:
+            _file.write(data)
+            _file.flush()
+        except OSError as e:
+            logging.error(f"Failed to capture packet to {_path}: {e}")
+
+
+def read_capture(path):
+    """
+    Returns the node number a capture was taken on and a generator of its (receive time, packet) records.
+    A record cut short at the end of the file, as left by a crash, is skipped.
+    """
+    file = open(path, 'rb')
+    header = file.read(HEADER.size)
+    try:
+        magic, version, my_node_num = HEADER.unpack(header)
+    except struct.error:
+        magic = version = None
+    if magic != MAGIC or version != VERSION:
+        file.close()
+        raise ValueError(f"{path} is not a version {VERSION} capture file")
+
+    def records():
+        with file:
+            while True:
+                prefix = file.read(LENGTH.size)
+                if len(prefix) < LENGTH.size:
+                    return
+                length = LENGTH.unpack(prefix)[0]
+                body = file.read(length)
+                if len(body) < length:
+                    logging.warning(f"Skipping a truncated record at the end of {os.path.basename(path)}")
+                    return
+                yield decode(body)
+
+    return my_node_num, records()
@@ -0,0 +1,149 @@
+"""
+A radio connection that notices when it drops and reconnects itself.
+
+RadioLink stands in for a Meshtastic interface and holds the current
+connection. The link is marked lost when meshtastic publishes
+meshtastic.connection.lost for its radio, or when a periodic heartbeat to
+the radio fails. A watchdog thread then closes the old connection and
+opens a new one, retrying with exponential backoff.
+
+The server's pubsub subscriptions are per topic rather than per
+connection, so they carry over to the new radio, and everything the server
+attached to the link (bbs_nodes, the outbox, ...) stays in place. Sessions
+live in the shared session store and are untouched. While the link is
+down sends raise ConnectionError, and the sync outbox holds its queue
+until the link's on_reconnect callbacks wake it.
+"""
+
+import logging
+import threading
+import time
+
+from metrics import registry
+
+radio_connected = registry.gauge('bbs_radio_connected', "1 if the radio is connected, by radio", ('radio',))
+radio_reconnects = registry.counter('bbs_radio_reconnects_total', "Reconnections after a radio link dropped",
+                                    ('radio',))
+
+
+class RadioLink:
+    def __init__(self, name, connect, heartbeat_interval=60, reconnect_min=1, reconnect_max=60):
+        self.name = name
+        self.connect = connect
+        self.heartbeat_interval = heartbeat_interval
+        self.reconnect_min = reconnect_min
+        self.reconnect_max = reconnect_max
+        self.on_reconnect = []
+
+        self.radio = connect()
+        self.last_nodes = {}
+        self._lost = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        radio_connected.set(1, radio=name)
+
+    @property
+    def connected(self):
+        return self.radio is not None and not self._lost.is_set()
+
+    @property
+    def nodes(self):
+        # Keep answering node lookups from the last node DB while reconnecting
+        if self.radio is not None:
+            self.last_nodes = self.radio.nodes
+        return self.last_nodes
+
+    @property
+    def myInfo(self):
+        return self.radio.myInfo if self.radio is not None else None
+
+    def sendText(self, text, **kwargs):
+        radio = self.radio
+        if radio is None or self._lost.is_set():
+            raise ConnectionError(f"radio {self.name} is reconnecting")
+        try:
+            return radio.sendText(text, **kwargs)
+        except (OSError, ConnectionError):
+            self.lost(radio, "send failed")
+            raise
+
+    def __getattr__(self, name):
+        # Anything else a handler needs comes from the current connection
+        radio = self.__dict__.get('radio')
+        if radio is None:
+            raise AttributeError(name)
+        return getattr(radio, name)
+
+    def owns(self, radio):
+        return radio is not None and radio is self.radio
+
+    def lost(self, radio, reason):
+        """Marks the link lost if `radio` is its current connection."""
+        if self._stop.is_set() or not self.owns(radio) or self._lost.is_set():
+            return
+        logging.warning(f"Radio {self.name} connection lost ({reason}), reconnecting")
+        radio_connected.set(0, radio=self.name)
+        self._lost.set()
+
+    def heartbeat(self):
+        radio = self.radio
+        send_heartbeat = getattr(radio, 'sendHeartbeat', None)
+        if send_heartbeat is None:
+            return
+        try:
+            send_heartbeat()
+        except Exception as e:
+            self.lost(radio, f"heartbeat failed: {e}")
+
+    def reconnect(self):
+        started = time.time()
+        old, self.radio = self.radio, None
+        try:
+            old.close()
+        except Exception as e:
+            logging.info(f"Closing radio {self.name} after the link dropped: {e}")
+
+        delay = self.reconnect_min
+        while not self._stop.is_set():
+            try:
+                radio = self.connect()
+            except Exception as e:
+                logging.error(f"Reconnecting radio {self.name} failed: {e}, retrying in {delay}s")
+                if self._stop.wait(delay):
+                    return
+                delay = min(delay * 2, self.reconnect_max)
+                continue
+
+            self.radio = radio
+            self._lost.clear()
+            radio_connected.set(1, radio=self.name)
+            radio_reconnects.inc(radio=self.name)
+            logging.info(f"Radio {self.name} reconnected after {time.time() - started:.1f}s")
+            for callback in self.on_reconnect:
+                try:
+                    callback()
+                except Exception as e:
+                    logging.error(f"Reconnect callback for radio {self.name} failed: {e}")
+            return
+
+    def run(self):
+        while not self._stop.is_set():
+            if self._lost.wait(self.heartbeat_interval):
+                if self._stop.is_set():
+                    return
+                self.reconnect()
+            else:
+                self.heartbeat()
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name=f"radio-watchdog-{self.name}", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        self._lost.set()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join(timeout=5)
+        radio, self.radio = self.radio, None
+        if radio is not None:
+            radio.close()
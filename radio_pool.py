@@ -0,0 +1,141 @@
+"""
+Several radios served by one BBS process.
+
+A RadioPool stands in for the single Meshtastic interface the rest of the
+BBS expects. The server attaches bbs_nodes, allowed_nodes, the outbox and
+the JS8Call client to the pool once, and both it and the per-radio views
+read them from there, so every radio shares one database, session store
+and sync state.
+
+Packets are handled with the RadioView of the radio they arrived on, so
+replies and node lookups for a request use that radio. Sends that don't
+answer a request (sync, notifications, JS8Call relays) go through the pool:
+it prefers the radios that have heard the destination recently and, among
+those, the one with the least recent airtime. Broadcasts go out on every
+radio, since each may be on a different channel or preset.
+"""
+
+import math
+import threading
+import time
+
+from lora_airtime import airtime
+from metrics import registry
+
+BROADCAST_NUM = 0xFFFFFFFF
+BROADCAST_ADDR = "^all"
+
+# Seconds over which a radio's recent airtime decays, for choosing the least busy radio
+LOAD_DECAY = 600
+
+radio_airtime = registry.counter('bbs_radio_airtime_seconds_total', "Estimated time on air of sent packets, by radio",
+                                 ('radio',))
+
+
+def node_key(destination):
+    """Returns the node DB key ('!1234abcd') for a node number or ID."""
+    if isinstance(destination, int):
+        return f"!{destination:08x}"
+    return destination
+
+
+class RadioView:
+    """One radio as seen by the message handlers."""
+
+    def __init__(self, pool, radio, name):
+        self._pool = pool
+        self.radio = radio
+        self.name = name
+
+    @property
+    def nodes(self):
+        return self.radio.nodes
+
+    @property
+    def myInfo(self):
+        return self.radio.myInfo
+
+    def sendText(self, text, destinationId=BROADCAST_ADDR, **kwargs):
+        return self._pool.send_on(self, text, destinationId, **kwargs)
+
+    def __getattr__(self, name):
+        # bbs_nodes, allowed_nodes, outbox, js8call_client and the rest are shared through the pool
+        return getattr(self._pool, name)
+
+
+class RadioPool:
+    def __init__(self, radios, names=None, heard_window=3600):
+        names = names or [str(index + 1) for index in range(len(radios))]
+        self.views = [RadioView(self, radio, name) for radio, name in zip(radios, names)]
+        self.heard_window = heard_window
+        self._load = {view.name: (0.0, time.monotonic()) for view in self.views}
+        self._lock = threading.Lock()
+
+    @property
+    def radios(self):
+        return [view.radio for view in self.views]
+
+    @property
+    def myInfo(self):
+        return self.views[0].radio.myInfo
+
+    @property
+    def nodes(self):
+        """Every radio's node DB merged, keeping the most recently heard entry for each node."""
+        merged = {}
+        for view in self.views:
+            for node_id, node in view.radio.nodes.items():
+                known = merged.get(node_id)
+                if known is None or (node.get('lastHeard') or 0) > (known.get('lastHeard') or 0):
+                    merged[node_id] = node
+        return merged
+
+    @property
+    def connected(self):
+        return any(self.is_up(view) for view in self.views)
+
+    @staticmethod
+    def is_up(view):
+        return getattr(view.radio, 'connected', True)
+
+    def view(self, radio):
+        """Returns the view of the radio a packet arrived on."""
+        for view in self.views:
+            # Radios may be wrapped in a RadioLink, which owns the live connection
+            if view.radio is radio or (hasattr(view.radio, 'owns') and view.radio.owns(radio)):
+                return view
+        return self.views[0]
+
+    def load(self, view, now=None):
+        now = now or time.monotonic()
+        value, updated = self._load[view.name]
+        return value * math.exp(-(now - updated) / LOAD_DECAY)
+
+    def pick(self, destination):
+        """Chooses the radio for a send: one that heard the destination recently, then the least busy."""
+        key = node_key(destination)
+        cutoff = time.time() - self.heard_window
+        up = [view for view in self.views if self.is_up(view)] or self.views
+        heard = [view for view in up if ((view.radio.nodes.get(key) or {}).get('lastHeard') or 0) >= cutoff]
+        now = time.monotonic()
+        with self._lock:
+            return min(heard or up, key=lambda view: self.load(view, now))
+
+    def send_on(self, view, text, destinationId, **kwargs):
+        seconds = airtime(len(text.encode('utf-8')))
+        now = time.monotonic()
+        with self._lock:
+            self._load[view.name] = (self.load(view, now) + seconds, now)
+        radio_airtime.inc(seconds, radio=view.name)
+        return view.radio.sendText(text, destinationId=destinationId, **kwargs)
+
+    def sendText(self, text, destinationId=BROADCAST_ADDR, **kwargs):
+        if destinationId in (BROADCAST_ADDR, BROADCAST_NUM):
+            up = [view for view in self.views if self.is_up(view)] or self.views
+            results = [self.send_on(view, text, destinationId, **kwargs) for view in up]
+            return results[0]
+        return self.send_on(self.pick(destinationId), text, destinationId, **kwargs)
+
+    def close(self):
+        for view in self.views:
+            view.radio.close()
@@ -0,0 +1,129 @@
+"""
+Replays a packet capture through on_receive against a fake interface.
+
+Captures are recorded by a running BBS when [capture] file is set in
+config.ini (see packet_capture.py). Replay runs against a scratch database,
+optionally a copy of a real one, and sends replies to a FakeInterface
+(from benchmark.py) that records them instead of transmitting. The fake
+node database holds the nodes that sent packets in the capture, so commands
+naming other nodes (SM,, to a node that never spoke) get a not-found reply.
+
+    python replay.py capture.bin                 # at the speed it was recorded
+    python replay.py capture.bin --speed 10      # ten times faster
+    python replay.py capture.bin --speed 0       # as fast as possible
+    python replay.py capture.bin --database bulletins.db --bbs-nodes !a1b2c3d4
+
+The report gives packets/sec, p50/p99 on_receive latency, how far replay
+fell behind the capture's timing, frames sent and database calls, so the
+same capture can be used to compare a change before and after.
+"""
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a packet capture through the BBS.")
+    parser.add_argument('capture', help="Capture file written by the BBS")
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help="Replay speed, 1 for real time, 0 for as fast as possible (default: 1)")
+    parser.add_argument('--bbs-nodes', default='', help="Comma-separated node IDs to treat as sync peers")
+    parser.add_argument('--database', help="Start from a copy of this database instead of an empty one")
+    parser.add_argument('--send-interval', type=float, default=0,
+                        help="Seconds to pause after each sent packet, as the BBS does on air (default: 0)")
+    parser.add_argument('--limit', type=int, help="Stop after this many packets")
+    parser.add_argument('--json', help="Also write the results to this JSON file")
+    parser.add_argument('--verbose', action='store_true', help="Show the BBS log output")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+
+    repo = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, repo)
+    from benchmark import FakeInterface, db_calls, percentile
+    from packet_capture import read_capture
+
+    capture = os.path.abspath(args.capture)
+    database = os.path.abspath(args.database) if args.database else None
+    json_path = os.path.abspath(args.json) if args.json else None
+    my_node_num, records = read_capture(capture)
+
+    with tempfile.TemporaryDirectory(prefix='bbs-replay-') as scratch:
+        # The database lives in the working directory, so run in a scratch one
+        os.chdir(scratch)
+        if database:
+            shutil.copy(database, 'bulletins.db')
+
+        import utils
+        from db_operations import initialize_database
+        from fortune_provider import fortunes
+        from message_processing import on_receive
+        utils.SEND_INTERVAL = args.send_interval
+        initialize_database()
+        fortunes.configure([(os.path.join(repo, 'fortunes.txt'), 1)])
+
+        bbs_nodes = [node_id.strip() for node_id in args.bbs_nodes.split(',') if node_id.strip()]
+        interface = FakeInterface(0, bbs_nodes=bbs_nodes, my_node_num=my_node_num)
+
+        latencies = []
+        max_lag = 0.0
+        first_received = None
+        db_before = db_calls()
+        start = time.perf_counter()
+        for received, packet in records:
+            if args.limit is not None and len(latencies) >= args.limit:
+                break
+            if first_received is None:
+                first_received = received
+            if args.speed > 0:
+                due = start + (received - first_received) / args.speed
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    max_lag = max(max_lag, -delay)
+
+            sender = packet.get('from')
+            if sender and packet.get('fromId') and packet['fromId'] not in interface.nodes:
+                interface.add_node(sender)
+
+            began = time.perf_counter()
+            on_receive(packet, interface)
+            latencies.append(time.perf_counter() - began)
+        elapsed = time.perf_counter() - start
+        os.chdir(repo)
+
+    latencies.sort()
+    results = {
+        'capture': capture,
+        'packets': len(latencies),
+        'seconds': elapsed,
+        'packets_per_second': len(latencies) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'max_ms': latencies[-1] * 1000 if latencies else 0.0,
+        'max_lag_seconds': max_lag,
+        'frames': len(interface.frames),
+        'bytes': interface.bytes,
+        'db_calls': db_calls() - db_before
+    }
+
+    print(f"Replayed {results['packets']} packets in {elapsed:.2f}s ({results['packets_per_second']:.0f}/s)")
+    print(f"on_receive: p50 {results['p50_ms']:.2f}ms, p99 {results['p99_ms']:.2f}ms, max {results['max_ms']:.2f}ms")
+    if args.speed > 0:
+        print(f"Fell behind the capture by up to {max_lag:.2f}s")
+    print(f"Sent {results['frames']} frames ({results['bytes']} bytes), {results['db_calls']} database calls")
+    if json_path:
+        with open(json_path, 'w') as file:
+            json.dump({'args': vars(args), 'results': results}, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -12,14 +12,30 @@ database for data storage. Mail messages and bulletins are synced with
 other BBS servers listed in the config.ini file.
 """
 
+import configparser
 import logging
+import signal
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 from config_init import initialize_config, get_interface, init_cli_parser, merge_config
 from db_operations import initialize_database
-from js8call_integration import JS8CallClient
-from message_processing import on_receive
-from pubsub import pub
+from fortune_provider import fortunes
+from lora_airtime import configure as configure_airtime
+from metrics import registry, start_http_server, start_json_writer
+import packet_capture
+import tracing
+from menus import compile_menus
+from radio_link import RadioLink
+from radio_pool import RadioPool
+from session_journal import SessionJournal
+from sync_delta import configure as configure_delta_sync, request_all as request_delta_sync
+from sync_outbox import SyncOutbox
+from sync_reconcile import start_reconciliation
+from utils import user_states
+from worker_pool import WorkerPool
 
 # General logging
 logging.basicConfig(
@@ -37,6 +53,61 @@ js8call_formatter = logging.Formatter('%(asctime)s - JS8Call - %(levelname)s - %
 js8call_handler.setFormatter(js8call_formatter)
 js8call_logger.addHandler(js8call_handler)
 
+# Seconds between JS8Call health reports in the log
+HEALTH_REPORT_INTERVAL = 600
+
+
+class StartupProfile:
+    """Records when each startup phase began and how long it took, for --startup-profile."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.phases.append((name, start - self.started, time.perf_counter() - start))
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def report(self):
+        lines = [f"Startup profile, ready after {self.elapsed():.2f}s:"]
+        for name, offset, duration in sorted(self.phases, key=lambda phase: phase[1]):
+            lines.append(f"  {name:<14} {duration:7.2f}s   started at {offset:6.2f}s")
+        return "\n".join(lines)
+
+
+class InFlight:
+    """Counts packets being handled, so shutdown can wait for their replies to go out."""
+
+    def __init__(self):
+        self.count = 0
+        self._done = threading.Condition()
+
+    @contextmanager
+    def handling(self):
+        with self._done:
+            self.count += 1
+        try:
+            yield
+        finally:
+            with self._done:
+                self.count -= 1
+                self._done.notify_all()
+
+    def wait(self, timeout):
+        """Returns True if every handler finished within timeout seconds."""
+        with self._done:
+            return self._done.wait_for(lambda: self.count == 0, timeout)
+
+
 def display_banner():
     banner = """
 ████████╗ ██████╗██████╗       ██████╗ ██████╗ ███████╗
@@ -49,45 +120,352 @@ Meshtastic Version
 """
     print(banner)
 
+def start_metrics(system_config, interface, js8call_client):
+    configure_airtime(*system_config['lora_modem'])
+
+    def queue_depths():
+        depths = {('outbox',): sum(interface.outbox.depth().values())}
+        if js8call_client.db_conn:
+            depths[('js8call_ingest',)] = js8call_client.ingest_queue.qsize()
+            depths[('js8call_tx',)] = len(js8call_client.tx_queue)
+        return depths
+
+    registry.gauge('bbs_send_queue_depth', "Messages waiting to be sent, by queue", ('queue',), function=queue_depths)
+
+    if system_config['metrics_port']:
+        try:
+            start_http_server(system_config['metrics_port'], system_config['metrics_host'])
+        except OSError as e:
+            logging.error(f"Could not serve metrics on port {system_config['metrics_port']}: {e}")
+    if system_config['metrics_file']:
+        start_json_writer(system_config['metrics_file'], system_config['metrics_interval'])
+
+
+def my_node_num(interface):
+    """Returns our node number, or 0 while the radio is reconnecting and its info isn't known."""
+    my_info = interface.myInfo
+    return my_info.my_node_num if my_info else 0
+
+
+def apply_config(system_config, new_config, interface, js8call_client, reconciler, workers=None):
+    """Applies a re-read config to the running server. Returns the reconciliation thread."""
+    for key in ('interface_type', 'hostname', 'port', 'interfaces', 'worker_count'):
+        if new_config[key] != system_config[key]:
+            logging.warning(f"Changing {key} needs a restart, still using {system_config[key]}")
+        new_config[key] = system_config[key]
+
+    interface.bbs_nodes = new_config['bbs_nodes']
+    interface.allowed_nodes = new_config['allowed_nodes']
+
+    compile_menus(new_config['config'])
+    fortunes.configure(new_config['fortune_files'])
+    tracing.configure(new_config['tracing_enabled'], new_config['trace_buffer'], new_config['trace_file'],
+                      new_config['trace_admins'])
+    packet_capture.configure(new_config['capture_file'], my_node_num(interface))
+    user_states.configure(
+        ttl=new_config['session_ttl'],
+        max_sessions=new_config['max_sessions'],
+        max_bytes=new_config['max_session_bytes'],
+        max_draft_bytes=new_config['max_draft_bytes']
+    )
+
+    interface.outbox.expiry = new_config['outbox_expiry']
+    interface.outbox.retry_base = new_config['outbox_retry']
+    interface.outbox.heard_window = new_config['peer_heard_window']
+    if isinstance(interface, RadioPool):
+        interface.heard_window = new_config['peer_heard_window']
+    for radio_link in (interface.radios if isinstance(interface, RadioPool) else [interface]):
+        radio_link.heartbeat_interval = new_config['heartbeat_interval']
+        radio_link.reconnect_min = new_config['reconnect_min']
+        radio_link.reconnect_max = new_config['reconnect_max']
+    configure_delta_sync(new_config['delta_batch_bytes'], new_config['delta_interval'])
+
+    js8call_client.configure(new_config['config'])
+    if js8call_client.db_conn and js8call_client.state == 'disabled':
+        js8call_client.start()
+
+    if workers:
+        workers.reload()
+
+    # Last, so a failure above doesn't leave the old thread stopped
+    if new_config['reconcile_interval'] != system_config['reconcile_interval']:
+        if reconciler:
+            reconciler.stop_event.set()
+        reconciler = start_reconciliation(interface, new_config['reconcile_interval'])
+    return reconciler
+
+
+def reload_config(system_config, args, interface, js8call_client, reconciler, workers=None):
+    """
+    Re-reads the config file and applies everything that can change without reopening the radio.
+    Returns the new config and reconciliation thread, or the current ones if the file can't be read or applied.
+    """
+    try:
+        new_config = initialize_config(system_config['config_file'])
+        merge_config(new_config, args)
+    except (configparser.Error, KeyError, ValueError) as e:
+        logging.error(f"Not reloading {system_config['config_file']}: {e}")
+        return system_config, reconciler
+
+    try:
+        reconciler = apply_config(system_config, new_config, interface, js8call_client, reconciler, workers)
+    except Exception as e:
+        # A bad value shouldn't take the BBS down, so carry on with what was running before
+        logging.error(f"Failed to apply {new_config['config_file']}, keeping the current configuration: {e}")
+        return system_config, reconciler
+
+    logging.info(f"Reloaded configuration from {new_config['config_file']}")
+    return new_config, reconciler
+
+
+def shutdown(system_config, interface, js8call_client, reconciler, profiler, stop_intake, in_flight, workers=None):
+    """
+    Stops taking new packets, then gives replies still being sent, due sync messages and the JS8Call
+    ingest queue until shutdown_timeout to finish, saves the user sessions and closes the radio.
+    """
+    deadline = time.monotonic() + system_config['shutdown_timeout']
+
+    def remaining():
+        return max(deadline - time.monotonic(), 0)
+
+    logging.info(f"Shutting down the server (waiting up to {system_config['shutdown_timeout']}s for queued messages)...")
+    stop_intake()
+    if reconciler:
+        reconciler.stop_event.set()
+
+    if not in_flight.wait(remaining()):
+        logging.warning(f"Gave up waiting for {in_flight.count} message(s) still being handled")
+    if workers:
+        # Workers save their own sessions as they stop
+        workers.stop(remaining())
+
+    interface.outbox.stop(timeout=remaining())
+    left = sum(interface.outbox.depth().values())
+    if left:
+        logging.info(f"{left} sync message(s) stay in the outbox for the next start")
+
+    # Stopping the client writes out the messages its ingest thread has batched
+    js8call_client.stop(timeout=max(remaining(), 1))
+
+    if not workers:
+        saved = user_states.checkpoint()
+        if saved:
+            logging.info(f"Saved {saved} user session(s)")
+
+    interface.close()
+    packet_capture.close()
+    if profiler:
+        profiler.stop()
+    logging.info("Shutdown complete")
+
+
 def main():
+    profile = StartupProfile()
     display_banner()
     args = init_cli_parser()
-    config_file = None
-    if args.config is not None:
-        config_file = args.config
-    system_config = initialize_config(config_file)
 
-    merge_config(system_config, args)
+    with profile.phase("config"):
+        system_config = initialize_config(args.config)
+        merge_config(system_config, args)
+
+    # Connecting to the radio and downloading its node DB is by far the slowest step,
+    # so it runs on its own thread while everything that doesn't need the radio is set up
+    radio = {}
+
+    def connect_radio():
+        with profile.phase("radio"):
+            try:
+                radios = system_config['interfaces']
+
+                def link(r):
+                    # Each radio reconnects itself if its connection drops
+                    return RadioLink(r['name'], lambda: get_interface(r),
+                                     heartbeat_interval=system_config['heartbeat_interval'],
+                                     reconnect_min=system_config['reconnect_min'],
+                                     reconnect_max=system_config['reconnect_max'])
+
+                if len(radios) == 1:
+                    radio['interface'] = link(radios[0])
+                else:
+                    # Several radios share one database and session store through a pool
+                    with ThreadPoolExecutor(len(radios)) as executor:
+                        links = list(executor.map(link, radios))
+                    radio['interface'] = RadioPool(links, [r['name'] for r in radios],
+                                                   heard_window=system_config['peer_heard_window'])
+            except Exception as e:
+                radio['error'] = e
+
+    radio_thread = threading.Thread(target=connect_radio, name="radio-connect", daemon=True)
+    radio_thread.start()
+
+    tracing.configure(system_config['tracing_enabled'], system_config['trace_buffer'], system_config['trace_file'],
+                      system_config['trace_admins'])
+    profiler = None
+    if system_config['profiler_interval'] > 0:
+        profiler = tracing.SamplingProfiler(system_config['profiler_interval'], system_config['profiler_file'])
+        profiler.start()
+
+    with profile.phase("database"):
+        initialize_database()
+
+    with profile.phase("sessions"):
+        # With worker processes each worker journals and restores its own users' sessions,
+        # so the gateway keeps none and must not touch the journal
+        workers_enabled = system_config['worker_count'] > 0
+        user_states.configure(
+            ttl=system_config['session_ttl'],
+            max_sessions=system_config['max_sessions'],
+            max_bytes=system_config['max_session_bytes'],
+            max_draft_bytes=system_config['max_draft_bytes'],
+            journal=None if workers_enabled else SessionJournal()
+        )
+        restored = 0 if workers_enabled else user_states.restore()
+        if restored:
+            logging.info(f"Restored {restored} user session(s) from the last run")
+
+    with profile.phase("menus"):
+        compile_menus(system_config['config'])
+
+        # Index the fortune files now rather than on the first request
+        fortunes.configure(system_config['fortune_files'])
+        logging.info(f"Loaded {fortunes.count()} fortunes")
+
+    with profile.phase("imports"):
+        # These pull in meshtastic, so they are imported while the radio connects
+        from js8call_integration import JS8CallClient
+        from message_processing import on_receive, packets_received
+        from pubsub import pub
+
+    with profile.phase("js8call"):
+        # Creates the JS8Call tables; the client is given the interface once the radio is up
+        js8call_client = JS8CallClient(None, system_config['config'], js8call_logger)
 
-    interface = get_interface(system_config)
-    interface.bbs_nodes = system_config['bbs_nodes']
-    interface.allowed_nodes = system_config['allowed_nodes']
+    with profile.phase("radio wait"):
+        radio_thread.join()
+    if 'error' in radio:
+        raise radio['error']
 
-    logging.info(f"TC²-BBS is running on {system_config['interface_type']} interface...")
+    with profile.phase("serve"):
+        interface = radio['interface']
+        interface.bbs_nodes = system_config['bbs_nodes']
+        interface.allowed_nodes = system_config['allowed_nodes']
 
-    initialize_database()
+        radio_types = ', '.join(r['interface_type'] for r in system_config['interfaces'])
+        logging.info(f"TC²-BBS is running on {radio_types} interface...")
 
-    def receive_packet(packet, interface):
-        on_receive(packet, interface)
+        # Sync messages to peers are queued and sent once the peer is heard
+        interface.outbox = SyncOutbox(
+            interface,
+            expiry=system_config['outbox_expiry'],
+            retry_base=system_config['outbox_retry'],
+            heard_window=system_config['peer_heard_window']
+        )
+        interface.outbox.start()
 
-    pub.subscribe(receive_packet, system_config['mqtt_topic'])
+        packet_capture.configure(system_config['capture_file'], my_node_num(interface))
 
-    # Initialize and start JS8Call Client if configured
-    js8call_client = JS8CallClient(interface)
-    js8call_client.logger = js8call_logger
+        pool = interface if isinstance(interface, RadioPool) else None
+        links = pool.radios if pool else [interface]
+        served = interface
+        in_flight = InFlight()
+        stopping = threading.Event()
 
-    if js8call_client.db_conn:
-        js8call_client.connect()
+        workers = None
+        if system_config['worker_count'] > 0:
+            workers = WorkerPool(interface, system_config['worker_count'], system_config['config_file'])
+            workers.start()
+
+        def receive_packet(packet, interface):
+            if stopping.is_set():
+                return
+            # With several radios, handle the packet as the radio it arrived on so replies go out there
+            ingress = pool.view(interface) if pool else served
+            if workers:
+                packet_capture.record(packet)
+                packets_received.inc(port=packet.get('decoded', {}).get('portnum', 'ENCRYPTED'))
+                workers.dispatch(packet, getattr(ingress, 'name', None))
+                return
+            with in_flight.handling():
+                on_receive(packet, ingress)
+
+        def stop_intake():
+            stopping.set()
+            pub.unsubscribe(receive_packet, system_config['mqtt_topic'])
+
+        def connection_lost(interface):
+            for radio_link in links:
+                radio_link.lost(interface, "connection lost")
+
+        pub.subscribe(receive_packet, system_config['mqtt_topic'])
+        pub.subscribe(connection_lost, "meshtastic.connection.lost")
+
+        for radio_link in links:
+            # Whatever the outbox held back while the radio was down goes out once it is back
+            radio_link.on_reconnect.append(interface.outbox.wake)
+            radio_link.start()
+
+        # Ask every peer for whatever changed since we last heard from it
+        configure_delta_sync(system_config['delta_batch_bytes'], system_config['delta_interval'])
+        request_delta_sync(interface)
+
+        # Periodically catch up with peers that missed sync messages
+        reconciler = start_reconciliation(interface, system_config['reconcile_interval'])
+
+        js8call_client.interface = interface
+        interface.js8call_client = js8call_client
+        if js8call_client.db_conn:
+            js8call_client.start()
+
+        start_metrics(system_config, interface, js8call_client)
+
+    logging.info(f"TC²-BBS ready in {profile.elapsed():.1f}s")
+    if args.startup_profile:
+        print(profile.report())
+
+    # SIGHUP reloads the config; the work is done on the main loop rather than in the handler
+    reload_requested = threading.Event()
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, lambda signum, frame: reload_requested.set())
+
+    # SIGUSR1 dumps the recent traces and the profiler's stacks so far
+    dump_requested = threading.Event()
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: dump_requested.set())
+
+    # SIGTERM (systemctl stop) shuts down the same way as Ctrl-C
+    stop_requested = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_requested.set())
 
     try:
-        while True:
+        last_health_report = time.time()
+        while not stop_requested.is_set():
             time.sleep(1)
 
+            if reload_requested.is_set():
+                reload_requested.clear()
+                system_config, reconciler = reload_config(system_config, args, interface, js8call_client, reconciler,
+                                                          workers)
+
+            if workers:
+                workers.check()
+
+            if dump_requested.is_set():
+                dump_requested.clear()
+                try:
+                    tracing.dump()
+                    if profiler:
+                        profiler.write()
+                except OSError as e:
+                    logging.error(f"Failed to dump traces: {e}")
+
+            if js8call_client.state not in ('stopped', 'disabled') and time.time() - last_health_report >= HEALTH_REPORT_INTERVAL:
+                js8call_logger.info(f"Health: {js8call_client.health()}")
+                last_health_report = time.time()
+
     except KeyboardInterrupt:
-        logging.info("Shutting down the server...")
-        interface.close()
-        if js8call_client.connected:
-            js8call_client.close()
+        pass
+
+    shutdown(system_config, interface, js8call_client, reconciler, profiler, stop_intake, in_flight, workers)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,42 @@
+"""
+SQLite checkpoints for user sessions so a restart doesn't lose conversations.
+
+The step, command and IDs of a session are saved as a small JSON row whenever
+the session changes. Draft content (mail and bulletin bodies sent over many
+packets) is journaled one appended line at a time instead of rewriting the
+whole draft, and stitched back together when sessions are restored.
+"""
+
+import json
+import logging
+
+from db_operations import (
+    append_session_line, delete_session, load_sessions,
+    replace_session_content, save_session
+)
+
+
+class SessionJournal:
+    def save(self, user_id, fields, updated):
+        save_session(user_id, json.dumps(fields), updated)
+
+    def replace_content(self, user_id, content):
+        replace_session_content(user_id, content)
+
+    def append(self, user_id, line, updated):
+        append_session_line(user_id, line, updated)
+
+    def delete(self, user_id):
+        delete_session(user_id)
+
+    def load(self):
+        sessions = []
+        for user_id, data, updated, content in load_sessions():
+            try:
+                fields = json.loads(data)
+            except ValueError:
+                logging.error(f"Discarding unreadable saved session for {user_id}")
+                delete_session(user_id)
+                continue
+            sessions.append((user_id, fields, updated, content))
+        return sessions
@@ -0,0 +1,273 @@
+"""
+Bounded session store for per-user conversation state.
+
+Sessions are compact __slots__ objects that hold the current command and
+step plus only IDs and cursors (never whole result sets). They still support
+the dict-style access the handlers use (state['step'], state.get('board')).
+
+The store expires sessions that have been idle longer than `ttl` and evicts
+the least recently used ones once `max_sessions` or `max_bytes` (mostly
+draft content) is exceeded. All operations take a lock so handlers can run
+on several threads.
+
+When a journal is attached (see session_journal.py) every change is also
+checkpointed so sessions survive a restart. Draft text should be added with
+append_content() so only the new line is written.
+
+Drafts live in a CompositionBuffer, which collects the received lines and
+joins them only once when the draft is posted. Each draft is limited to
+`max_draft_bytes` (UTF-8) so an oversized post is refused line by line
+instead of after it has all been sent.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+# Rough per-session overhead used for the memory cap, on top of any draft text
+SESSION_OVERHEAD = 256
+
+
+class CompositionBuffer:
+    __slots__ = ('parts', 'size')
+
+    def __init__(self, text=''):
+        self.parts = [text] if text else []
+        self.size = len(text.encode('utf-8'))
+
+    def append(self, text):
+        self.parts.append(text)
+        self.size += len(text.encode('utf-8'))
+
+    def getvalue(self):
+        if len(self.parts) > 1:
+            # Collapse so repeated reads don't join again
+            self.parts = [''.join(self.parts)]
+        return self.parts[0] if self.parts else ''
+
+    def __len__(self):
+        return self.size
+
+    def __str__(self):
+        return self.getvalue()
+
+    def __repr__(self):
+        return f"CompositionBuffer({self.size} bytes in {len(self.parts)} parts)"
+
+
+class Session:
+    __slots__ = (
+        'command', 'step', 'menu', 'board', 'board_name', 'subject', 'content',
+        'mail_id', 'unique_id', 'sender', 'recipient_id', 'reply_to_mail_id',
+        'channel_name', 'node_nums', 'mail_ids', 'bulletin_ids', 'channel_ids', 'groups',
+        'view', 'groupname', 'cursor'
+    )
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, None)
+        for name, value in fields.items():
+            setattr(self, name, value)
+        if isinstance(self.content, str):
+            self.content = CompositionBuffer(self.content)
+
+    def __getitem__(self, key):
+        value = getattr(self, key, None) if key in self.__slots__ else None
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.__slots__ and getattr(self, key) is not None
+
+    def get(self, key, default=None):
+        value = getattr(self, key, None) if key in self.__slots__ else None
+        return default if value is None else value
+
+    def fields(self):
+        """Returns the set fields with the draft content blanked out, since it is journaled separately."""
+        fields = {name: getattr(self, name) for name in self.__slots__ if getattr(self, name) is not None}
+        if 'content' in fields:
+            fields['content'] = ''
+        return fields
+
+    def size(self):
+        size = SESSION_OVERHEAD
+        if self.content:
+            size += len(self.content)
+        return size
+
+    def __repr__(self):
+        fields = ', '.join(f"{name}={getattr(self, name)!r}" for name in self.__slots__ if getattr(self, name) is not None)
+        return f"Session({fields})"
+
+
+class SessionStore:
+    def __init__(self, ttl=3600, max_sessions=1000, max_bytes=1048576, max_draft_bytes=4096):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.max_draft_bytes = max_draft_bytes
+
+        self._sessions = OrderedDict()
+        self._last_active = {}
+        self._sizes = {}
+        self._size = 0
+        self._lock = threading.RLock()
+
+        self.journal = None
+        self._journaled_length = {}
+
+    def configure(self, ttl=None, max_sessions=None, max_bytes=None, max_draft_bytes=None, journal=None):
+        with self._lock:
+            if max_draft_bytes is not None:
+                self.max_draft_bytes = max_draft_bytes
+            if journal is not None:
+                self.journal = journal
+            if ttl is not None:
+                self.ttl = ttl
+            if max_sessions is not None:
+                self.max_sessions = max_sessions
+            if max_bytes is not None:
+                self.max_bytes = max_bytes
+            self._evict(time.time())
+
+    def _remove(self, user_id):
+        session = self._sessions.pop(user_id, None)
+        self._last_active.pop(user_id, None)
+        self._size -= self._sizes.pop(user_id, 0)
+        self._journaled_length.pop(user_id, None)
+        if session is not None and self.journal:
+            self.journal.delete(user_id)
+
+    def _checkpoint(self, user_id, session, previous, now):
+        self.journal.save(user_id, session.fields(), now)
+        content_length = len(session.content or '')
+        if previous is not session or self._journaled_length.get(user_id, 0) != content_length:
+            self.journal.replace_content(user_id, str(session.content or ''))
+            self._journaled_length[user_id] = content_length
+
+    def _evict(self, now):
+        # Sessions are kept in least recently used order, so idle ones are at the front
+        while self._sessions:
+            user_id = next(iter(self._sessions))
+            expired = now - self._last_active[user_id] > self.ttl
+            if not expired and len(self._sessions) <= self.max_sessions and self._size <= self.max_bytes:
+                break
+            self._remove(user_id)
+
+    def get(self, user_id):
+        with self._lock:
+            session = self._sessions.get(user_id)
+            if session is None:
+                return None
+            now = time.time()
+            if now - self._last_active[user_id] > self.ttl:
+                self._remove(user_id)
+                return None
+            self._sessions.move_to_end(user_id)
+            self._last_active[user_id] = now
+            return session
+
+    def set(self, user_id, state):
+        if state is None:
+            self.delete(user_id)
+            return
+        session = state if isinstance(state, Session) else Session(**state)
+        size = session.size()
+        now = time.time()
+        with self._lock:
+            previous = self._sessions.get(user_id)
+            self._size += size - self._sizes.get(user_id, 0)
+            self._sizes[user_id] = size
+            self._sessions[user_id] = session
+            self._sessions.move_to_end(user_id)
+            self._last_active[user_id] = now
+            if self.journal:
+                self._checkpoint(user_id, session, previous, now)
+            self._evict(now)
+
+    def append_content(self, user_id, text):
+        """
+        Appends draft text to a session, journaling only the new text.
+        Returns False if the draft would exceed max_draft_bytes, and raises KeyError if the session has
+        expired or been evicted.
+        """
+        now = time.time()
+        with self._lock:
+            session = self._sessions.get(user_id)
+            if session is None:
+                raise KeyError(user_id)
+            if session.content is None:
+                session.content = CompositionBuffer()
+            size_before = len(session.content)
+            if size_before + len(text.encode('utf-8')) > self.max_draft_bytes:
+                return False
+            session.content.append(text)
+            added = len(session.content) - size_before
+            self._size += added
+            self._sizes[user_id] += added
+            self._sessions.move_to_end(user_id)
+            self._last_active[user_id] = now
+            if self.journal:
+                self.journal.append(user_id, text, now)
+                self._journaled_length[user_id] = len(session.content)
+            self._evict(now)
+            return True
+
+    def restore(self, keep=None):
+        """
+        Loads the sessions saved by the journal, dropping any that went idle past the TTL.
+        If given, keep(user_id) picks the sessions to load; the others are left in the journal untouched.
+        """
+        if not self.journal:
+            return 0
+        now = time.time()
+        restored = 0
+        with self._lock:
+            for user_id, fields, updated, content in sorted(self.journal.load(), key=lambda s: s[2]):
+                if keep is not None and not keep(user_id):
+                    continue
+                if now - updated > self.ttl:
+                    self.journal.delete(user_id)
+                    continue
+                if 'content' in fields:
+                    fields['content'] = content
+                try:
+                    session = Session(**fields)
+                except AttributeError:
+                    self.journal.delete(user_id)
+                    continue
+                size = session.size()
+                self._sessions[user_id] = session
+                self._last_active[user_id] = updated
+                self._sizes[user_id] = size
+                self._size += size
+                self._journaled_length[user_id] = len(session.content or '')
+                restored += 1
+            self._evict(now)
+        return restored
+
+    def checkpoint(self):
+        """Saves every session to the journal, e.g. on shutdown. Returns the number saved."""
+        if not self.journal:
+            return 0
+        with self._lock:
+            for user_id, session in self._sessions.items():
+                self._checkpoint(user_id, session, session, self._last_active[user_id])
+            return len(self._sessions)
+
+    def delete(self, user_id):
+        with self._lock:
+            self._remove(user_id)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
+
+    def total_bytes(self):
+        with self._lock:
+            return self._size
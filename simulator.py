@@ -0,0 +1,579 @@
+"""
+Simulates a mesh of several BBS nodes in one process, for testing sync without radios.
+
+Every BBS runs the real message handling code with its own database, and the
+nodes are joined by a virtual LoRa channel driven by a virtual clock, so an
+hour of mesh traffic runs in seconds. The channel models:
+
+    time on air     from lora_airtime, for the modem settings given
+    collisions      a packet is lost at a receiver if anything else it can hear
+                    is on the air at the same time, or if it is transmitting
+    carrier sense   a node waits for the channel to go quiet plus a random
+                    contention delay before it transmits
+    packet loss     each reception is dropped with a fixed probability
+    flooding        nodes relay packets not addressed to them until the hop
+                    limit runs out, and skip the relay if they hear another
+                    node relay it first, as Meshtastic does
+    acks            sync messages are acked by the destination and resent up
+                    to `retries` times
+
+Users are attached directly to their BBS: their commands arrive without
+crossing the channel, and replies to them take one hop of airtime without
+being relayed.
+
+    python simulator.py --nodes 5 --topology line --posts 30 --mails 30
+    python simulator.py --traffic traffic.tsv --loss 0.1 --json results.json
+
+A traffic file has one command per line: `<seconds>\t<bbs number>\t<user node
+number>\t<text>`, for example `120\t1\t4096\tPB,,General,,Hello,,First post`.
+
+The report shows how long each bulletin and mail took to reach every BBS,
+and the airtime spent per kind of message (BULLETIN, MAIL, SYNC_DIGEST, ...),
+including relays, acks and resends.
+
+Sync messages are sent as soon as they are created rather than through the
+outbox, and SYNC_SINCE catch-up isn't started, since both pace themselves by
+the wall clock.
+"""
+
+import argparse
+import heapq
+import itertools
+import json
+import logging
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+BROADCAST_NUM = 0xFFFFFFFF
+FIRST_USER_NUM = 0x1000
+TOPOLOGIES = ('full', 'line', 'ring', 'star')
+
+
+class Packet:
+    __slots__ = ('id', 'source', 'destination', 'text', 'size', 'hop_limit', 'want_ack', 'ack_for', 'flow',
+                 'attempts')
+
+    def __init__(self, packet_id, source, destination, text, hop_limit, want_ack=False, ack_for=None, flow=None):
+        self.id = packet_id
+        self.source = source
+        self.destination = destination
+        self.text = text
+        self.size = len(text.encode('utf-8'))
+        self.hop_limit = hop_limit
+        self.want_ack = want_ack
+        self.ack_for = ack_for
+        self.flow = flow
+        self.attempts = 0
+
+
+class Transmission:
+    __slots__ = ('sender', 'packet', 'start', 'end')
+
+    def __init__(self, sender, packet, start, end):
+        self.sender = sender
+        self.packet = packet
+        self.start = start
+        self.end = end
+
+
+class SimNode:
+    """One BBS: its radio state, its database and the per-BBS state the BBS modules keep in globals."""
+
+    def __init__(self, num, directory):
+        from session_store import SessionStore
+        from sync_framing import FrameReassembler
+
+        self.num = num
+        self.node_id = node_id_for(num)
+        self.neighbors = set()
+        self.interface = None
+
+        self.connection = sqlite3.connect(os.path.join(directory, f"bbs-{num}.db"))
+        self.sessions = SessionStore()
+        self.reassembler = FrameReassembler()
+        self.index_cache = {}
+        self.pending_ids = {}
+        self.last_served = {}
+        self.deferred = {}
+
+        self.queue = deque()
+        self.transmitting = None
+        self.waiting = False
+        self.seen = set()
+        self.relays = {}
+        self.awaiting_ack = {}
+        self.frame_flows = {}
+
+
+def node_id_for(num):
+    return f"!{num:08x}"
+
+
+@contextmanager
+def activate(node):
+    """Points the BBS modules' global state at one node, so the code that runs next acts as that BBS."""
+    import db_operations
+    import message_processing
+    import sync_delta
+    import sync_reconcile
+    import utils
+
+    db_operations.thread_local.connection = node.connection
+    utils.user_states = node.sessions
+    message_processing.reassembler = node.reassembler
+    sync_reconcile._index_cache = node.index_cache
+    sync_reconcile._pending_ids = node.pending_ids
+    sync_delta._last_served = node.last_served
+    sync_delta._deferred = node.deferred
+    yield
+
+
+def build_topology(name, count):
+    """Returns the pairs of node indexes in radio range of each other."""
+    if name == 'full':
+        return list(itertools.combinations(range(count), 2))
+    if name == 'line':
+        return [(i, i + 1) for i in range(count - 1)]
+    if name == 'ring':
+        return [(i, (i + 1) % count) for i in range(count)] if count > 2 else [(0, 1)]
+    if name == 'star':
+        return [(0, i) for i in range(1, count)]
+    raise ValueError(f"Unknown topology {name}")
+
+
+def parse_links(value):
+    """Parses `1-2,2-3` (BBS numbers from 1) into index pairs."""
+    links = []
+    for link in value.split(','):
+        first, _, second = link.strip().partition('-')
+        links.append((int(first) - 1, int(second) - 1))
+    return links
+
+
+class Simulator:
+    def __init__(self, args, directory):
+        from benchmark import FakeInterface
+        from lora_airtime import airtime, configure as configure_airtime
+
+        configure_airtime(args.sf, args.bw, args.cr)
+        self.airtime = airtime
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.now = 0.0
+        self.events = []
+        self._sequence = itertools.count()
+        self._packet_ids = itertools.count(1)
+
+        self.nodes = [SimNode(index + 1, directory) for index in range(args.nodes)]
+        self.by_num = {node.num: node for node in self.nodes}
+        links = parse_links(args.links) if args.links else build_topology(args.topology, args.nodes)
+        for first, second in links:
+            self.nodes[first].neighbors.add(self.nodes[second])
+            self.nodes[second].neighbors.add(self.nodes[first])
+
+        self.users = {node.num: [FIRST_USER_NUM + index * 0x100 + user for user in range(args.users)]
+                      for index, node in enumerate(self.nodes)}
+        simulator = self
+
+        class SimInterface(FakeInterface):
+            def __init__(self, node):
+                super().__init__(0, my_node_num=node.num)
+                self.sim_node = node
+
+            def sendText(self, text, destinationId=None, wantAck=False, wantResponse=False, **kwargs):
+                super().sendText(text, destinationId, wantAck, wantResponse)
+                return simulator.originate(self.sim_node, text, destinationId)
+
+        for node in self.nodes:
+            node.interface = SimInterface(node)
+            for other in self.nodes:
+                node.interface.add_node(other.num)
+            for users in self.users.values():
+                for user in users:
+                    node.interface.add_node(user)
+            peers = self.nodes if args.peers == 'all' else node.neighbors
+            node.interface.bbs_nodes = [peer.node_id for peer in peers if peer is not node]
+
+        self.transmissions = []
+        self.stats = defaultdict(lambda: defaultdict(float))
+        self.channel = defaultdict(int)
+        self.airtime_total = 0.0
+        self.first_seen = {}
+        self.converged = {}
+        self.holders = defaultdict(set)
+        self.errors = 0
+
+    # Event loop
+
+    def schedule(self, delay, function, *args):
+        heapq.heappush(self.events, (self.now + delay, next(self._sequence), function, args))
+
+    def run(self, until):
+        while self.events and self.events[0][0] <= until:
+            self.now, _, function, args = heapq.heappop(self.events)
+            function(*args)
+        self.now = max(self.now, until)
+
+    # Radio
+
+    def flow_of(self, node, text, destination):
+        from message_processing import SYNC_PREFIXES
+        from sync_framing import FRAME_PREFIX
+
+        if text.startswith(FRAME_PREFIX):
+            _, msg_id, index, _, chunk = text.split('|', 4)
+            if index == '0':
+                node.frame_flows[msg_id] = chunk.split('|', 1)[0]
+            return node.frame_flows.get(msg_id, 'SYNC')
+        if text.startswith(SYNC_PREFIXES):
+            return text.split('|', 1)[0]
+        return 'BROADCAST' if destination == BROADCAST_NUM else 'USER'
+
+    def originate(self, node, text, destination):
+        """Queues a packet sent by a BBS. Returns it, standing in for the packet sendText returns."""
+        if isinstance(destination, str):
+            destination = BROADCAST_NUM if destination == '^all' else int(destination.lstrip('!'), 16)
+        to_bbs = destination in self.by_num
+        flow = self.flow_of(node, text, destination)
+        # Users sit next to their BBS, so their replies take one hop and aren't relayed or acked
+        hop_limit = self.args.hop_limit if to_bbs or destination == BROADCAST_NUM else 0
+        packet = Packet(next(self._packet_ids), node.num, destination, text, hop_limit, want_ack=to_bbs, flow=flow)
+        self.stats[flow]['packets'] += 1
+        node.seen.add(packet.id)
+        self.send_packet(node, packet)
+        return packet
+
+    def enqueue(self, node, packet):
+        # Acks jump the queue, as in the Meshtastic firmware
+        if packet.ack_for is not None:
+            node.queue.appendleft(packet)
+        else:
+            node.queue.append(packet)
+        if not node.transmitting and not node.waiting:
+            self.try_transmit(node)
+
+    def channel_busy_until(self, node):
+        """Returns when the last transmission node can hear ends, or None if the channel is quiet."""
+        ends = [tx.end for tx in self.transmissions if tx.end > self.now and tx.sender in node.neighbors]
+        return max(ends) if ends else None
+
+    def try_transmit(self, node):
+        node.waiting = False
+        if node.transmitting or not node.queue:
+            return
+        busy_until = self.channel_busy_until(node)
+        if busy_until is not None:
+            node.waiting = True
+            self.schedule(busy_until - self.now + self.random.uniform(0, self.args.contention), self.try_transmit, node)
+            return
+
+        packet = node.queue.popleft()
+        duration = self.airtime(packet.size)
+        transmission = Transmission(node, packet, self.now, self.now + duration)
+        self.transmissions.append(transmission)
+        node.transmitting = transmission
+        self.airtime_total += duration
+        self.stats[packet.flow]['transmissions'] += 1
+        self.stats[packet.flow]['airtime'] += duration
+        self.channel['transmissions'] += 1
+        self.schedule(duration, self.end_transmission, transmission)
+
+    def end_transmission(self, transmission):
+        node = transmission.sender
+        node.transmitting = None
+        packet = transmission.packet
+
+        for receiver in node.neighbors:
+            overlapping = [tx for tx in self.transmissions
+                           if tx is not transmission and tx.start < transmission.end and tx.end > transmission.start
+                           and (tx.sender is receiver or tx.sender in receiver.neighbors)]
+            if overlapping:
+                self.channel['collisions'] += 1
+            elif self.random.random() < self.args.loss:
+                self.channel['lost'] += 1
+            else:
+                self.channel['received'] += 1
+                self.schedule(self.args.hop_delay, self.receive, receiver, packet, node)
+
+        if packet.source == node.num and packet.want_ack and packet.id in node.awaiting_ack:
+            timeout = (2 * packet.hop_limit + 2) * (self.airtime(packet.size) + self.args.contention + self.args.hop_delay)
+            self.schedule(timeout, self.ack_timeout, node, packet)
+
+        # Forget transmissions too old to overlap anything still to come
+        horizon = self.now - 60
+        self.transmissions = [tx for tx in self.transmissions if tx.end > horizon]
+        self.try_transmit(node)
+
+    def send_packet(self, node, packet):
+        """Queues a packet this node originates and wants acked."""
+        packet.attempts += 1
+        if packet.want_ack:
+            node.awaiting_ack[packet.id] = packet
+        self.enqueue(node, packet)
+
+    def ack_timeout(self, node, packet):
+        if packet.id not in node.awaiting_ack:
+            return
+        if packet.attempts > self.args.retries:
+            del node.awaiting_ack[packet.id]
+            self.stats[packet.flow]['failed'] += 1
+            return
+        self.stats[packet.flow]['resends'] += 1
+        self.send_packet(node, packet)
+
+    def receive(self, node, packet, sender):
+        if packet.id in node.seen:
+            # Someone else relayed it first, so ours isn't needed
+            relay = node.relays.pop(packet.id, None)
+            if relay is not None:
+                relay[0] = None
+            # A resend from the source means our ack was lost
+            if packet.destination == node.num and packet.want_ack and sender.num == packet.source:
+                self.send_ack(node, packet)
+            return
+        node.seen.add(packet.id)
+
+        if packet.destination == node.num:
+            if packet.ack_for is not None:
+                node.awaiting_ack.pop(packet.ack_for, None)
+                return
+            if packet.want_ack:
+                self.send_ack(node, packet)
+            self.deliver(node, packet)
+            return
+
+        if packet.destination == BROADCAST_NUM:
+            self.deliver(node, packet)
+        if packet.hop_limit > 0:
+            relay = [packet]
+            node.relays[packet.id] = relay
+            self.schedule(self.random.uniform(0, self.args.contention), self.relay, node, relay)
+
+    def relay(self, node, relay):
+        packet = relay[0]
+        if packet is None:
+            return
+        node.relays.pop(packet.id, None)
+        forwarded = Packet(packet.id, packet.source, packet.destination, packet.text, packet.hop_limit - 1,
+                           ack_for=packet.ack_for, flow=packet.flow)
+        self.enqueue(node, forwarded)
+
+    def send_ack(self, node, packet):
+        ack = Packet(next(self._packet_ids), node.num, packet.source, '', self.args.hop_limit,
+                     ack_for=packet.id, flow=packet.flow)
+        node.seen.add(ack.id)
+        self.enqueue(node, ack)
+
+    # BBS
+
+    def deliver(self, node, packet):
+        """Hands a received packet to the BBS code, as the Meshtastic interface would."""
+        self.handle(node, {
+            'from': packet.source,
+            'fromId': node_id_for(packet.source),
+            'to': packet.destination,
+            'decoded': {'portnum': 'TEXT_MESSAGE_APP', 'payload': packet.text.encode('utf-8')}
+        })
+
+    def handle(self, node, received):
+        from message_processing import on_receive
+
+        with activate(node):
+            try:
+                on_receive(received, node.interface)
+            except Exception as e:
+                self.errors += 1
+                logging.error(f"BBS {node.node_id} failed to handle a packet: {e}")
+            self.record_items(node)
+
+    def user_command(self, node, user, text):
+        self.handle(node, {
+            'from': user,
+            'fromId': node_id_for(user),
+            'to': node.num,
+            'decoded': {'portnum': 'TEXT_MESSAGE_APP', 'payload': text.encode('utf-8')}
+        })
+
+    def reconcile(self, node, until):
+        from sync_reconcile import reconcile_with_peers
+
+        with activate(node):
+            reconcile_with_peers(node.interface.bbs_nodes, node.interface)
+        if self.now + self.args.reconcile_interval <= until:
+            self.schedule(self.args.reconcile_interval, self.reconcile, node, until)
+
+    def record_items(self, node):
+        """Notes which bulletins and mail this node now has, and when each one reached every node."""
+        from db_operations import get_unique_ids
+
+        for unique_id in get_unique_ids('bulletins') + get_unique_ids('mail'):
+            holders = self.holders[unique_id]
+            if node.num in holders:
+                continue
+            holders.add(node.num)
+            self.first_seen.setdefault(unique_id, self.now)
+            if len(holders) == len(self.nodes):
+                self.converged[unique_id] = self.now
+
+    # Traffic
+
+    def generated_traffic(self):
+        """Returns (time, bbs, user, text) for random bulletins and mail spread over the duration."""
+        words = ("mesh", "node", "relay", "antenna", "battery", "solar", "repeater", "hilltop", "weather",
+                 "meetup", "net", "check-in", "frequency", "firmware", "range", "test")
+        commands = []
+        for kind, count in (('post', self.args.posts), ('mail', self.args.mails)):
+            for number in range(count):
+                at = self.random.uniform(0, self.args.duration)
+                node = self.random.choice(self.nodes)
+                user = self.random.choice(self.users[node.num])
+                content = ' '.join(self.random.choice(words) for _ in range(self.random.randint(3, 60)))
+                if kind == 'post':
+                    text = f"PB,,General,,Post {number},,{content}"
+                else:
+                    other = self.random.choice([n for n in self.nodes if n is not node] or self.nodes)
+                    recipient = self.random.choice(self.users[other.num])
+                    short_name = node.interface.nodes[node_id_for(recipient)]['user']['shortName']
+                    text = f"SM,,{short_name},,Mail {number},,{content}"
+                commands.append((at, node.num, user, text))
+        return commands
+
+    def run_traffic(self, commands):
+        for at, bbs, user, text in commands:
+            node = self.by_num[bbs]
+            for other in self.nodes:
+                if node_id_for(user) not in other.interface.nodes:
+                    other.interface.add_node(user)
+            heapq.heappush(self.events, (at, next(self._sequence), self.user_command, (node, user, text)))
+
+        end = self.args.duration + self.args.settle
+        if self.args.reconcile_interval > 0:
+            for node in self.nodes:
+                self.schedule(self.random.uniform(0, self.args.reconcile_interval), self.reconcile, node, end)
+        self.run(end)
+
+    # Results
+
+    def results(self):
+        latencies = sorted(self.converged[unique_id] - self.first_seen[unique_id] for unique_id in self.converged)
+        flows = {flow: dict(values) for flow, values in sorted(self.stats.items())}
+        return {
+            'nodes': len(self.nodes),
+            'simulated_seconds': self.now,
+            'items': len(self.first_seen),
+            'converged': len(self.converged),
+            'convergence_p50': percentile(latencies, 0.5),
+            'convergence_p99': percentile(latencies, 0.99),
+            'convergence_max': latencies[-1] if latencies else 0.0,
+            'all_converged_at': max(self.converged.values()) if len(self.converged) == len(self.first_seen) and self.converged else None,
+            'airtime': self.airtime_total,
+            'channel_utilisation': self.airtime_total / self.now if self.now else 0.0,
+            'channel': dict(self.channel),
+            'errors': self.errors,
+            'flows': flows
+        }
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def read_traffic(path):
+    commands = []
+    with open(path) as file:
+        for line in file:
+            if not line.strip() or line.startswith('#'):
+                continue
+            at, bbs, user, text = line.rstrip('\n').split('\t', 3)
+            commands.append((float(at), int(bbs), int(user, 0), text))
+    return commands
+
+
+def print_results(results):
+    print(f"{results['nodes']} BBS nodes, {results['simulated_seconds']:.0f}s simulated")
+    print(f"Items: {results['items']}, reached every node: {results['converged']}")
+    print(f"Convergence: p50 {results['convergence_p50']:.1f}s, p99 {results['convergence_p99']:.1f}s, "
+          f"max {results['convergence_max']:.1f}s")
+    if results['all_converged_at'] is not None:
+        print(f"All nodes in sync at {results['all_converged_at']:.1f}s")
+    channel = results['channel']
+    print(f"Channel: {channel.get('transmissions', 0)} transmissions, {channel.get('received', 0)} received, "
+          f"{channel.get('collisions', 0)} collisions, {channel.get('lost', 0)} lost, "
+          f"{results['airtime']:.1f}s airtime ({results['channel_utilisation'] * 100:.1f}% utilisation)")
+    if results['errors']:
+        print(f"Handler errors: {results['errors']}")
+    print()
+    print(f"{'flow':<16} {'packets':>8} {'sent':>8} {'resends':>8} {'failed':>7} {'airtime s':>10}")
+    for flow, values in results['flows'].items():
+        print(f"{flow:<16} {values.get('packets', 0):>8.0f} {values.get('transmissions', 0):>8.0f} "
+              f"{values.get('resends', 0):>8.0f} {values.get('failed', 0):>7.0f} {values.get('airtime', 0):>10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate several BBS nodes syncing over a virtual LoRa mesh.")
+    parser.add_argument('--nodes', type=int, default=4, help="Number of BBS nodes (default: 4)")
+    parser.add_argument('--topology', choices=TOPOLOGIES, default='line', help="Which nodes hear each other (default: line)")
+    parser.add_argument('--links', help="Explicit links instead of a topology, e.g. 1-2,2-3,2-4")
+    parser.add_argument('--peers', choices=('all', 'neighbors'), default='all',
+                        help="Sync with every other BBS or only those in radio range (default: all)")
+    parser.add_argument('--users', type=int, default=5, help="Users attached to each BBS (default: 5)")
+    parser.add_argument('--posts', type=int, default=20, help="Bulletins to post (default: 20)")
+    parser.add_argument('--mails', type=int, default=20, help="Mails to send (default: 20)")
+    parser.add_argument('--traffic', help="Replay commands from this file instead of generating them")
+    parser.add_argument('--duration', type=float, default=3600, help="Seconds over which traffic arrives (default: 3600)")
+    parser.add_argument('--settle', type=float, default=7200, help="Seconds to keep running after the traffic (default: 7200)")
+    parser.add_argument('--reconcile-interval', type=float, default=3600,
+                        help="Seconds between reconciliation rounds, 0 to disable (default: 3600)")
+    parser.add_argument('--loss', type=float, default=0.05, help="Chance a reception is lost (default: 0.05)")
+    parser.add_argument('--hop-limit', type=int, default=3, help="Relays allowed per packet (default: 3)")
+    parser.add_argument('--hop-delay', type=float, default=0.05, help="Processing delay per hop in seconds (default: 0.05)")
+    parser.add_argument('--contention', type=float, default=1.0,
+                        help="Longest random wait before a relay or after a busy channel, in seconds (default: 1.0)")
+    parser.add_argument('--retries', type=int, default=3, help="Resends of an unacked packet (default: 3)")
+    parser.add_argument('--sf', type=int, default=11, help="LoRa spreading factor (default: 11)")
+    parser.add_argument('--bw', type=int, default=250000, help="LoRa bandwidth in Hz (default: 250000)")
+    parser.add_argument('--cr', type=int, default=5, help="LoRa coding rate denominator, 4/x (default: 5)")
+    parser.add_argument('--seed', type=int, default=1, help="Random seed (default: 1)")
+    parser.add_argument('--json', help="Also write the results to this JSON file")
+    parser.add_argument('--verbose', action='store_true', help="Show the BBS log output")
+    args = parser.parse_args()
+    if args.nodes < 2:
+        parser.error("--nodes must be at least 2")
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format='%(levelname)s - %(message)s')
+
+    repo = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, repo)
+    commands = read_traffic(args.traffic) if args.traffic else None
+    json_path = os.path.abspath(args.json) if args.json else None
+
+    with tempfile.TemporaryDirectory(prefix='bbs-sim-') as scratch:
+        import utils
+        from db_operations import initialize_database
+        utils.SEND_INTERVAL = 0
+
+        simulator = Simulator(args, scratch)
+        for node in simulator.nodes:
+            with activate(node):
+                initialize_database()
+        simulator.run_traffic(commands if commands is not None else simulator.generated_traffic())
+        results = simulator.results()
+        for node in simulator.nodes:
+            node.connection.close()
+
+    print_results(results)
+    if json_path:
+        with open(json_path, 'w') as file:
+            json.dump({'args': vars(args), 'results': results}, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
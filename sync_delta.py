@@ -0,0 +1,124 @@
+"""
+Per-peer high-water-mark delta sync.
+
+Every add and delete is appended to the `changes` log with an increasing seq.
+For each peer we remember the highest seq of that peer's log we have been
+sent (`peer_cursors`), so a new or restored BBS can ask for everything after
+it instead of waiting for reconciliation:
+
+    SYNC_SINCE|<cursor>          ask a peer for its changes after <cursor>
+    SYNC_CURSOR|<seq>|<more>     sent after a batch; <more> is 1 if the peer
+                                 should ask again for the rest
+
+Changes are replayed with the regular BULLETIN|/MAIL|/CHANNEL|/DELETE_*|
+messages. Each reply is capped in bytes and a peer is served at most once
+per `min_interval`, so a catch-up can't monopolise the channel. A request
+that comes in sooner is held and answered once the interval has passed.
+"""
+
+import logging
+import threading
+import time
+
+from db_operations import get_changes_since, get_channel_by_id, get_peer_cursor, set_peer_cursor
+from sync_framing import join_fields
+from sync_reconcile import push_item
+from utils import send_channel_to_bbs_nodes, send_sync_message
+
+SINCE_PREFIX = "SYNC_SINCE|"
+CURSOR_PREFIX = "SYNC_CURSOR|"
+DELTA_PREFIXES = (SINCE_PREFIX, CURSOR_PREFIX)
+
+# Upper bound on changes read per request, the byte budget is the real limit
+MAX_CHANGES_PER_BATCH = 50
+
+batch_bytes = 2000
+min_interval = 60
+_last_served = {}
+# Cursor of the request each peer is waiting on because it asked too soon
+_deferred = {}
+_lock = threading.Lock()
+
+
+def configure(delta_batch_bytes, delta_interval):
+    global batch_bytes, min_interval
+    batch_bytes = delta_batch_bytes
+    min_interval = delta_interval
+
+
+def request_since(peer, interface):
+    cursor = get_peer_cursor(peer)
+    logging.info(f"SERVER SYNC: Requesting changes after {cursor} from {peer}")
+    send_sync_message(join_fields("SYNC_SINCE", cursor), [peer], interface)
+
+
+def request_all(interface):
+    for peer in interface.bbs_nodes:
+        request_since(peer, interface)
+
+
+def push_change(kind, ref, peer, interface):
+    if kind == 'C':
+        channel = get_channel_by_id(ref)
+        if channel:
+            name, url = channel
+            return send_channel_to_bbs_nodes(name, url, [peer], interface)
+        return 0
+    return push_item(kind, ref, peer, interface)
+
+
+def serve_deferred(peer, interface):
+    with _lock:
+        cursor = _deferred.pop(peer, None)
+    if cursor is not None:
+        handle_since(peer, cursor, interface)
+
+
+def handle_since(peer, cursor, interface):
+    now = time.time()
+    with _lock:
+        wait = min_interval - (now - _last_served.get(peer, 0))
+        if wait > 0:
+            # Answer once the interval has passed; a later request replaces the held one
+            pending = peer in _deferred
+            _deferred[peer] = cursor
+            if not pending:
+                logging.info(f"SERVER SYNC: Holding SYNC_SINCE from {peer} for {wait:.0f}s, served too recently")
+                timer = threading.Timer(wait, serve_deferred, args=(peer, interface))
+                timer.daemon = True
+                timer.start()
+            return
+        _last_served[peer] = now
+
+    changes = get_changes_since(cursor, MAX_CHANGES_PER_BATCH)
+    sent_bytes = 0
+    last_seq = cursor
+    for seq, kind, ref in changes:
+        if sent_bytes >= batch_bytes:
+            break
+        sent_bytes += push_change(kind, ref, peer, interface)
+        last_seq = seq
+
+    more = bool(changes) and (last_seq < changes[-1][0] or len(changes) == MAX_CHANGES_PER_BATCH)
+    send_sync_message(join_fields("SYNC_CURSOR", last_seq, int(more)), [peer], interface)
+    logging.info(f"SERVER SYNC: Sent {sent_bytes} bytes of changes after {cursor} to {peer} (more: {more})")
+
+
+def handle_cursor(peer, seq, more, interface):
+    if seq > get_peer_cursor(peer):
+        set_peer_cursor(peer, seq)
+    if more:
+        # Ask for the next batch once the peer is willing to serve us again
+        timer = threading.Timer(min_interval, request_since, args=(peer, interface))
+        timer.daemon = True
+        timer.start()
+
+
+def handle_delta_message(peer, fields, interface):
+    try:
+        if fields[0] == "SYNC_SINCE":
+            handle_since(peer, int(fields[1]), interface)
+        elif fields[0] == "SYNC_CURSOR":
+            handle_cursor(peer, int(fields[1]), fields[2] == "1", interface)
+    except (IndexError, ValueError):
+        logging.error(f"Malformed delta sync message from {peer}: {'|'.join(fields)}")
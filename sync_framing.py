@@ -0,0 +1,151 @@
+"""
+Framing for sync messages exchanged between BBS peers.
+
+Sync messages are `|`-separated fields. Fields are escaped with join_fields()
+so a `|` in user content can't shift the layout, and split_fields() undoes it.
+
+A message that fits in one radio payload is sent as-is. Longer messages are
+cut into as few frames as possible, each carrying a header:
+
+    SF|<msg_id>|<index>|<count>|<chunk>
+
+The receiver collects the parts in a FrameReassembler until the message is
+complete. Incomplete messages are dropped after a timeout, and the buffer is
+capped in total bytes and in pending messages per sender.
+"""
+
+import itertools
+import logging
+import random
+import threading
+import time
+
+FRAME_PREFIX = "SF|"
+# Same payload budget send_message uses, but counted in UTF-8 bytes
+MAX_FRAME_BYTES = 200
+
+
+def escape_field(value):
+    return str(value).replace("%", "%25").replace("|", "%7C")
+
+
+def unescape_field(value):
+    return value.replace("%7C", "|").replace("%25", "%")
+
+
+def join_fields(*fields):
+    return "|".join(escape_field(field) for field in fields)
+
+
+def split_fields(message):
+    return [unescape_field(field) for field in message.split("|")]
+
+
+_msg_ids = itertools.count(random.randrange(0x10000))
+
+
+def _next_msg_id():
+    return f"{next(_msg_ids) % 0x10000:04x}"
+
+
+def split_utf8(data, size):
+    """Splits bytes into pieces of at most `size` without cutting a UTF-8 character in half."""
+    pieces = []
+    while data:
+        end = min(size, len(data))
+        # Back off continuation bytes (10xxxxxx) so the piece ends on a character boundary
+        while end < len(data) and (data[end] & 0xC0) == 0x80:
+            end -= 1
+        pieces.append(data[:end])
+        data = data[end:]
+    return pieces
+
+
+def frame_message(message, max_bytes=MAX_FRAME_BYTES):
+    """Returns the list of frames to send for a message."""
+    data = message.encode('utf-8')
+    if len(data) <= max_bytes and not message.startswith(FRAME_PREFIX):
+        return [message]
+
+    msg_id = _next_msg_id()
+    count = 1
+    while True:
+        header_size = len(f"{FRAME_PREFIX}{msg_id}|{count}|{count}|".encode('utf-8'))
+        pieces = split_utf8(data, max_bytes - header_size)
+        # The header grows with the part count, so repeat until the count is stable
+        if len(pieces) <= count:
+            break
+        count = len(pieces)
+
+    return [f"{FRAME_PREFIX}{msg_id}|{i}|{len(pieces)}|{piece.decode('utf-8')}" for i, piece in enumerate(pieces)]
+
+
+class FrameReassembler:
+    def __init__(self, timeout=600, max_bytes=65536, max_pending_per_sender=8, max_parts=128):
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.max_pending_per_sender = max_pending_per_sender
+        self.max_parts = max_parts
+
+        self._buffers = {}
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def _drop(self, key, reason):
+        buffer = self._buffers.pop(key)
+        self._size -= buffer['size']
+        logging.warning(f"SERVER SYNC: Dropping incomplete message {key[1]} from {key[0]} "
+                        f"({len(buffer['parts'])}/{buffer['count']} parts): {reason}")
+
+    def _expire(self, now):
+        for key in [key for key, buffer in self._buffers.items() if now - buffer['updated'] > self.timeout]:
+            self._drop(key, "timed out")
+
+    def add(self, sender, frame):
+        """Adds a received frame and returns the full message once every part has arrived, else None."""
+        try:
+            _, msg_id, index, count, chunk = frame.split("|", 4)
+            index, count = int(index), int(count)
+        except ValueError:
+            logging.error(f"SERVER SYNC: Malformed frame from {sender}: {frame}")
+            return None
+        if not 0 <= index < count <= self.max_parts:
+            logging.error(f"SERVER SYNC: Frame {index}/{count} out of range from {sender}")
+            return None
+
+        key = (sender, msg_id)
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+
+            buffer = self._buffers.get(key)
+            if buffer is None:
+                pending = [k for k in self._buffers if k[0] == sender]
+                if len(pending) >= self.max_pending_per_sender:
+                    self._drop(min(pending, key=lambda k: self._buffers[k]['updated']), "too many pending messages")
+                buffer = {'count': count, 'parts': {}, 'size': 0, 'updated': now}
+                self._buffers[key] = buffer
+
+            if index not in buffer['parts']:
+                size = len(chunk)
+                buffer['parts'][index] = chunk
+                buffer['size'] += size
+                self._size += size
+            buffer['updated'] = now
+
+            while self._size > self.max_bytes and self._buffers:
+                oldest = min(self._buffers, key=lambda k: self._buffers[k]['updated'])
+                self._drop(oldest, "reassembly buffer full")
+
+            if key in self._buffers and len(buffer['parts']) == buffer['count']:
+                del self._buffers[key]
+                self._size -= buffer['size']
+                return "".join(buffer['parts'][i] for i in range(buffer['count']))
+        return None
+
+    def pending(self):
+        with self._lock:
+            return len(self._buffers)
+
+
+reassembler = FrameReassembler()
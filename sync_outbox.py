@@ -0,0 +1,143 @@
+"""
+Persistent store-and-forward outbox for peer sync.
+
+Sync messages for the peers in bbs_nodes are written to the `outbox` table
+instead of being sent inline. A background worker drains each peer's queue
+once the peer has been heard recently (`lastHeard` in interface.nodes), so
+offline peers cost no airtime and don't block command handling. Failed sends
+are retried with exponential backoff and undelivered messages expire.
+"""
+
+import logging
+import threading
+import time
+
+from db_operations import (
+    defer_outbox_message, delete_outbox_message, enqueue_outbox,
+    get_outbox_depth, get_outbox_messages, get_outbox_peers, purge_expired_outbox
+)
+from utils import send_framed_message
+
+
+class SyncOutbox:
+    def __init__(self, interface, expiry=604800, retry_base=30, retry_max=3600, heard_window=3600,
+                 poll_interval=30, batch_size=10):
+        self.interface = interface
+        self.expiry = expiry
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.heard_window = heard_window
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._deadline = None
+        self._thread = None
+
+    def enqueue(self, peer, message):
+        outbox_id = enqueue_outbox(peer, message, self.expiry)
+        logging.info(f"SERVER SYNC: Queued sync message {outbox_id} for {peer}")
+        self._wake.set()
+        return outbox_id
+
+    def notify_heard(self, peer):
+        """Called when a packet arrives from a peer so its queue is drained without waiting for the next poll."""
+        self._wake.set()
+
+    def wake(self):
+        """Drains the queue now, e.g. once the radio has reconnected."""
+        self._wake.set()
+
+    def is_connected(self):
+        # Interfaces that reconnect themselves say whether the radio is up; others are assumed to be
+        return getattr(self.interface, 'connected', True)
+
+    def is_peer_heard(self, peer):
+        node = self.interface.nodes.get(peer)
+        if not node or node.get('lastHeard') is None:
+            return False
+        return node['lastHeard'] >= time.time() - self.heard_window
+
+    def backoff(self, attempts):
+        return min(self.retry_base * (2 ** (attempts - 1)), self.retry_max)
+
+    def stopped(self):
+        # When stopping with a timeout, sending carries on until the deadline
+        return self._stop.is_set() and (self._deadline is None or time.monotonic() >= self._deadline)
+
+    def drain(self):
+        """Sends what is due to the peers heard recently. Returns the number of messages sent."""
+        sent = 0
+        now = time.time()
+        expired = purge_expired_outbox(now)
+        if expired:
+            logging.warning(f"SERVER SYNC: Dropped {expired} expired sync message(s) from the outbox")
+
+        if not self.is_connected():
+            return sent
+
+        for peer in get_outbox_peers(now):
+            if self.stopped():
+                return sent
+            if not self.is_peer_heard(peer):
+                continue
+            messages = get_outbox_messages(peer, now, self.batch_size)
+            for outbox_id, message, attempts in messages:
+                if self.stopped():
+                    return sent
+                if send_framed_message(message, peer, self.interface):
+                    delete_outbox_message(outbox_id)
+                    sent += 1
+                elif not self.is_connected():
+                    # The radio dropped; leave the message due so it goes out once the link is back
+                    return sent
+                else:
+                    attempts += 1
+                    delay = self.backoff(attempts)
+                    defer_outbox_message(outbox_id, attempts, time.time() + delay)
+                    logging.warning(f"SERVER SYNC: Send to {peer} failed, retrying in {delay}s (attempt {attempts})")
+                    break
+            else:
+                if len(messages) == self.batch_size:
+                    # More is waiting for this peer; come straight back after this batch
+                    self._wake.set()
+        return sent
+
+    def depth(self):
+        return get_outbox_depth()
+
+    def run(self):
+        while not self._stop.is_set():
+            # Cleared before draining, so a wake-up that arrives during the drain isn't lost
+            self._wake.clear()
+            try:
+                self.drain()
+            except Exception as e:
+                logging.error(f"SERVER SYNC: Outbox drain failed: {e}")
+            self._wake.wait(self.poll_interval)
+
+        # Stopping with a timeout: keep sending what is due until it's all out or time is up
+        while not self.stopped():
+            try:
+                if not self.drain():
+                    break
+            except Exception as e:
+                logging.error(f"SERVER SYNC: Outbox drain failed: {e}")
+                break
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name="sync-outbox", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=0):
+        """
+        Stops the worker. With a timeout, messages already due to heard peers are sent first,
+        waiting up to that many seconds; the rest stay in the outbox for the next start.
+        """
+        if timeout:
+            self._deadline = time.monotonic() + timeout
+        self._stop.set()
+        self._wake.set()
+        if timeout and self._thread and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
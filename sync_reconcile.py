@@ -0,0 +1,217 @@
+"""
+Anti-entropy reconciliation between BBS peers.
+
+Each peer keeps a hash tree over the unique_ids of its bulletins and mail.
+Items are placed in the tree by the hex digits of sha1(unique_id), so the
+layout is the same on every peer no matter when an item arrived. A round
+starts with the root digest; peers only descend into subtrees whose hashes
+differ and swap full id lists once a subtree is small. The cost of catching
+up therefore scales with the number of differing items, not the archive.
+
+Messages (all sent between nodes listed in bbs_nodes):
+    SYNC_DIGEST|<kind>|<prefix>|<h0>,<h1>,...,<h15>
+    SYNC_IDS|<kind>|<prefix>|<unique_id>,<unique_id>,...
+    SYNC_PULL|<kind>|<unique_id>,<unique_id>,...
+"""
+
+import bisect
+import hashlib
+import logging
+import threading
+
+from db_operations import (
+    get_bulletin_by_unique_id, get_mail_by_unique_id,
+    get_table_signature, get_unique_ids, is_tombstoned
+)
+from utils import (
+    send_bulletin_to_bbs_nodes, send_delete_bulletin_to_bbs_nodes,
+    send_delete_mail_to_bbs_nodes, send_mail_to_bbs_nodes, send_message
+)
+
+DIGEST_PREFIX = "SYNC_DIGEST|"
+IDS_PREFIX = "SYNC_IDS|"
+PULL_PREFIX = "SYNC_PULL|"
+RECONCILE_PREFIXES = (DIGEST_PREFIX, IDS_PREFIX, PULL_PREFIX)
+
+KIND_TABLES = {'B': 'bulletins', 'M': 'mail'}
+HEX_DIGITS = "0123456789abcdef"
+
+# Subtrees with at most this many items are settled by exchanging id lists
+LEAF_SIZE = 4
+# Deepest prefix we descend to before falling back to id lists
+MAX_DEPTH = 4
+# Keeps SYNC_IDS / SYNC_PULL messages within a single frame
+IDS_PER_MESSAGE = 4
+HASH_LENGTH = 8
+# Appended to the prefix of a SYNC_IDS batch when more batches follow
+MORE_MARKER = "+"
+
+_index_cache = {}
+_pending_ids = {}
+_index_lock = threading.Lock()
+
+
+def _hash_id(unique_id):
+    return hashlib.sha1(unique_id.encode('utf-8')).hexdigest()
+
+
+def get_index(kind):
+    """Returns the sorted list of (id_hash, unique_id) pairs for a kind, rebuilt only when the table changes."""
+    table = KIND_TABLES[kind]
+    signature = get_table_signature(table)
+    with _index_lock:
+        cached = _index_cache.get(kind)
+        if cached and cached[0] == signature:
+            return cached[1]
+    index = sorted((_hash_id(unique_id), unique_id) for unique_id in get_unique_ids(table))
+    with _index_lock:
+        _index_cache[kind] = (signature, index)
+    return index
+
+
+def _subtree(index, prefix):
+    start = bisect.bisect_left(index, (prefix,))
+    end = bisect.bisect_left(index, (prefix + '\x7f',)) if prefix else len(index)
+    return index[start:end]
+
+
+def _subtree_hash(entries):
+    if not entries:
+        return ''
+    digest = hashlib.sha1('\n'.join(id_hash for id_hash, _ in entries).encode('utf-8'))
+    return digest.hexdigest()[:HASH_LENGTH]
+
+
+def _child_hashes(index, prefix):
+    return [_subtree_hash(_subtree(index, prefix + digit)) for digit in HEX_DIGITS]
+
+
+def send_digest(kind, prefix, destination, interface):
+    index = get_index(kind)
+    hashes = ','.join(_child_hashes(index, prefix))
+    send_message(f"{DIGEST_PREFIX}{kind}|{prefix}|{hashes}", destination, interface)
+
+
+def send_ids(kind, prefix, entries, destination, interface):
+    """Sends the unique_ids under a prefix; every batch but the last is flagged with MORE_MARKER."""
+    unique_ids = [unique_id for _, unique_id in entries]
+    batches = [unique_ids[i:i + IDS_PER_MESSAGE] for i in range(0, len(unique_ids), IDS_PER_MESSAGE)] or [[]]
+    for i, batch in enumerate(batches):
+        marker = MORE_MARKER if i < len(batches) - 1 else ''
+        send_message(f"{IDS_PREFIX}{kind}|{prefix}{marker}|{','.join(batch)}", destination, interface)
+
+
+def push_item(kind, unique_id, destination, interface):
+    """Sends a single item to a peer using the regular sync messages. Returns the bytes queued."""
+    if kind == 'B':
+        bulletin = get_bulletin_by_unique_id(unique_id)
+        if bulletin:
+            board, sender_short_name, subject, content, unique_id = bulletin
+            return send_bulletin_to_bbs_nodes(board, sender_short_name, subject, content, unique_id, [destination],
+                                              interface)
+        elif is_tombstoned(unique_id):
+            return send_delete_bulletin_to_bbs_nodes(unique_id, [destination], interface)
+    elif kind == 'M':
+        mail = get_mail_by_unique_id(unique_id)
+        if mail:
+            sender_id, sender_short_name, recipient_id, subject, content, unique_id = mail
+            return send_mail_to_bbs_nodes(sender_id, sender_short_name, recipient_id, subject, content, unique_id,
+                                          [destination], interface)
+        elif is_tombstoned(unique_id):
+            return send_delete_mail_to_bbs_nodes(unique_id, [destination], interface)
+    return 0
+
+
+def handle_digest(kind, prefix, peer_hashes, sender_id, interface):
+    index = get_index(kind)
+    for digit, peer_hash in zip(HEX_DIGITS, peer_hashes):
+        child_prefix = prefix + digit
+        entries = _subtree(index, child_prefix)
+        if _subtree_hash(entries) == peer_hash:
+            continue
+        if len(entries) <= LEAF_SIZE or not peer_hash or len(child_prefix) >= MAX_DEPTH:
+            send_ids(kind, child_prefix, entries, sender_id, interface)
+        else:
+            send_digest(kind, child_prefix, sender_id, interface)
+
+
+def handle_ids(kind, prefix, peer_ids, sender_id, interface):
+    """Pushes what the peer lacks under a prefix and pulls what we lack."""
+    more = prefix.endswith(MORE_MARKER)
+    prefix = prefix.rstrip(MORE_MARKER)
+    key = (sender_id, kind, prefix)
+    with _index_lock:
+        peer_ids = _pending_ids.pop(key, set()) | set(peer_ids)
+        if more:
+            _pending_ids[key] = peer_ids
+            return
+
+    local_ids = {unique_id for _, unique_id in _subtree(get_index(kind), prefix)}
+
+    missing_here = []
+    for unique_id in sorted(peer_ids - local_ids):
+        if is_tombstoned(unique_id):
+            push_item(kind, unique_id, sender_id, interface)
+        else:
+            missing_here.append(unique_id)
+
+    for unique_id in sorted(local_ids - peer_ids):
+        push_item(kind, unique_id, sender_id, interface)
+
+    for i in range(0, len(missing_here), IDS_PER_MESSAGE):
+        batch = ','.join(missing_here[i:i + IDS_PER_MESSAGE])
+        send_message(f"{PULL_PREFIX}{kind}|{batch}", sender_id, interface)
+
+    if missing_here:
+        logging.info(f"SERVER SYNC: Pulling {len(missing_here)} {KIND_TABLES[kind]} item(s) from peer {sender_id}")
+
+
+def handle_pull(kind, unique_ids, sender_id, interface):
+    for unique_id in unique_ids:
+        push_item(kind, unique_id, sender_id, interface)
+
+
+def handle_reconcile_message(sender_id, message, interface):
+    try:
+        if message.startswith(DIGEST_PREFIX):
+            _, kind, prefix, hashes = message.split("|", 3)
+            if kind in KIND_TABLES:
+                handle_digest(kind, prefix, hashes.split(","), sender_id, interface)
+        elif message.startswith(IDS_PREFIX):
+            _, kind, prefix, unique_ids = message.split("|", 3)
+            if kind in KIND_TABLES:
+                handle_ids(kind, prefix, [u for u in unique_ids.split(",") if u], sender_id, interface)
+        elif message.startswith(PULL_PREFIX):
+            _, kind, unique_ids = message.split("|", 2)
+            if kind in KIND_TABLES:
+                handle_pull(kind, [u for u in unique_ids.split(",") if u], sender_id, interface)
+    except ValueError:
+        logging.error(f"Malformed reconciliation message from {sender_id}: {message}")
+
+
+def reconcile_with_peers(bbs_nodes, interface):
+    """Starts a reconciliation round with every peer by sending the root digests."""
+    for node_id in bbs_nodes:
+        logging.info(f"SERVER SYNC: Starting reconciliation with {node_id}")
+        for kind in KIND_TABLES:
+            send_digest(kind, '', node_id, interface)
+
+
+def start_reconciliation(interface, interval):
+    """Runs reconcile_with_peers every `interval` seconds on a daemon thread."""
+    if interval <= 0:
+        return None
+
+    stop_event = threading.Event()
+
+    def run():
+        while not stop_event.wait(interval):
+            try:
+                reconcile_with_peers(interface.bbs_nodes, interface)
+            except Exception as e:
+                logging.error(f"Reconciliation round failed: {e}")
+
+    thread = threading.Thread(target=run, name="sync-reconcile", daemon=True)
+    thread.stop_event = stop_event
+    thread.start()
+    return thread
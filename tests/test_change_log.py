@@ -0,0 +1,50 @@
+"""
+Only local posts go into the change log that peers delta sync from; items received from a peer don't.
+
+Run from the repository root with `python -m unittest discover tests`.
+"""
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db_operations
+from db_operations import add_bulletin, add_channel, add_mail, get_db_connection, initialize_database
+
+
+def changes():
+    return get_db_connection().execute("SELECT kind, ref FROM changes ORDER BY seq").fetchall()
+
+
+class ChangeLogTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(self.directory.name)
+        if hasattr(db_operations.thread_local, 'connection'):
+            del db_operations.thread_local.connection
+        initialize_database()
+
+    def tearDown(self):
+        get_db_connection().close()
+        del db_operations.thread_local.connection
+        os.chdir(self.cwd)
+        self.directory.cleanup()
+
+    def test_local_posts_are_recorded(self):
+        add_bulletin('General', 'ME', 'Subject', 'Body', [], None, unique_id='b-1')
+        add_mail('!00000001', 'ME', '!00000003', 'Subject', 'Body', [], None, unique_id='m-1')
+        self.assertEqual(changes(), [('B', 'b-1'), ('M', 'm-1')])
+
+    def test_items_from_a_peer_are_not_recorded(self):
+        add_bulletin('General', 'PEER', 'Subject', 'Body', [], None, unique_id='b-2', from_peer=True)
+        add_mail('!00000002', 'PEER', '!00000003', 'Subject', 'Body', [], None, unique_id='m-2', from_peer=True)
+        add_channel('Chat', 'https://example.org/#chat', from_peer=True)
+        self.assertEqual(changes(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
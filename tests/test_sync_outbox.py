@@ -0,0 +1,81 @@
+"""
+Reconciliation replies go through the persistent sync outbox and are sent once the peer is heard.
+
+Run from the repository root with `python -m unittest discover tests`.
+"""
+
+import os
+import sys
+import tempfile
+import time
+import types
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db_operations
+import utils
+from db_operations import add_bulletin, initialize_database
+from sync_outbox import SyncOutbox
+from sync_reconcile import IDS_PREFIX, handle_reconcile_message
+
+PEER_NUM = 2
+PEER_ID = '!00000002'
+
+
+class FakeInterface:
+    def __init__(self):
+        self.nodes = {PEER_ID: {'num': PEER_NUM, 'lastHeard': time.time(), 'user': {'shortName': 'PEER'}}}
+        self.myInfo = types.SimpleNamespace(my_node_num=1)
+        self.bbs_nodes = [PEER_ID]
+        self.allowed_nodes = []
+        self.sent = []
+
+    def sendText(self, text, destinationId=None, **kwargs):
+        self.sent.append((destinationId, text))
+        return types.SimpleNamespace(id=len(self.sent))
+
+
+class ReconcileOutboxTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(self.directory.name)
+        if hasattr(db_operations.thread_local, 'connection'):
+            del db_operations.thread_local.connection
+        self.send_interval = utils.SEND_INTERVAL
+        utils.SEND_INTERVAL = 0
+        initialize_database()
+
+        self.interface = FakeInterface()
+        self.interface.outbox = SyncOutbox(self.interface)
+
+    def tearDown(self):
+        utils.SEND_INTERVAL = self.send_interval
+        db_operations.get_db_connection().close()
+        del db_operations.thread_local.connection
+        os.chdir(self.cwd)
+        self.directory.cleanup()
+
+    def push_bulletin(self, sender):
+        add_bulletin('General', 'ME', 'Subject', 'Body', [], None, unique_id='b-1')
+        # The peer has no bulletins, so everything we hold is pushed to it
+        handle_reconcile_message(sender, f"{IDS_PREFIX}B||", self.interface)
+
+    def test_push_is_sent_by_drain(self):
+        self.push_bulletin(PEER_ID)
+        self.assertEqual(self.interface.outbox.depth(), {PEER_ID: 1})
+
+        self.assertEqual(self.interface.outbox.drain(), 1)
+        self.assertEqual(self.interface.outbox.depth(), {})
+        self.assertTrue(any(destination == PEER_ID and 'BULLETIN|' in text
+                            for destination, text in self.interface.sent))
+
+    def test_node_number_is_queued_under_node_id(self):
+        self.push_bulletin(PEER_NUM)
+        self.assertEqual(self.interface.outbox.depth(), {PEER_ID: 1})
+        self.assertEqual(self.interface.outbox.drain(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,189 @@
+"""
+Opt-in request tracing and a sampling profiler.
+
+When tracing is enabled each message handled by the BBS becomes a trace: a
+root span around process_message with child spans for the handlers, node
+lookups, database calls and sends made while handling it. Finished traces go
+to a ring buffer of the last `buffer_size` traces, which dump() writes out on
+request (SIGUSR1, or the TRACE command from a node listed in admin_nodes).
+
+Spans are only recorded inside a trace, so background threads (outbox,
+reconciliation) don't fill the buffer. With tracing disabled, span() and the
+traced() wrappers return immediately.
+
+The sampling profiler is independent of tracing. It looks at every thread's
+stack every `interval` seconds and counts the stacks, which are written in
+the collapsed format ("thread;outer;inner count") read by flamegraph.pl and
+speedscope.
+"""
+
+import functools
+import logging
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+
+enabled = False
+traces = deque(maxlen=200)
+dump_file = 'traces.txt'
+# Node IDs allowed to use the TRACE command
+admins = []
+_local = threading.local()
+
+
+def configure(enable, buffer_size=200, file='traces.txt', admin_nodes=()):
+    global enabled, traces, dump_file, admins
+    if buffer_size != traces.maxlen:
+        traces = deque(traces, maxlen=buffer_size)
+    dump_file = file
+    admins = list(admin_nodes)
+    enabled = enable
+
+
+@contextmanager
+def trace(name, **attributes):
+    """Starts a trace with a root span. Does nothing if tracing is off or a trace is already running."""
+    if not enabled or getattr(_local, 'spans', None) is not None:
+        yield
+        return
+    _local.spans = []
+    _local.depth = 0
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        spans = _local.spans
+        _local.spans = None
+        traces.append({
+            'time': time.time() - duration,
+            'name': name,
+            'attributes': attributes,
+            'duration': duration,
+            'thread': threading.current_thread().name,
+            'start': start,
+            'spans': spans
+        })
+
+
+@contextmanager
+def span(name, **attributes):
+    """Records a child span of the running trace, if there is one."""
+    spans = getattr(_local, 'spans', None) if enabled else None
+    if spans is None:
+        yield
+        return
+    entry = [name, time.perf_counter(), 0.0, _local.depth, attributes]
+    spans.append(entry)
+    _local.depth += 1
+    try:
+        yield
+    finally:
+        _local.depth -= 1
+        entry[2] = time.perf_counter() - entry[1]
+
+
+def traced(name=None):
+    """Decorator that records a span for each call made inside a trace."""
+    def decorator(function):
+        span_name = name or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            with span(span_name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def format_trace(entry):
+    started = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['time']))
+    attributes = ' '.join(f"{key}={value}" for key, value in entry['attributes'].items())
+    lines = [f"{started} [{entry['thread']}] {entry['name']} {attributes} {entry['duration'] * 1000:.1f}ms"]
+    for name, start, duration, depth, span_attributes in entry['spans']:
+        span_text = ' '.join(f"{key}={value}" for key, value in span_attributes.items())
+        offset = (start - entry['start']) * 1000
+        lines.append(f"{'  ' * (depth + 1)}+{offset:.1f}ms {name} {duration * 1000:.1f}ms {span_text}".rstrip())
+    return "\n".join(lines)
+
+
+def dump(path=None):
+    """Writes the buffered traces, oldest first, to `path` (or dump_file). Returns how many were written."""
+    path = path or dump_file
+    entries = list(traces)
+    with open(path, 'w') as file:
+        for entry in entries:
+            file.write(format_trace(entry) + "\n\n")
+    logging.info(f"Wrote {len(entries)} traces to {path}")
+    return len(entries)
+
+
+def slowest(count):
+    """Returns one line per trace for the slowest `count` buffered traces."""
+    entries = sorted(traces, key=lambda entry: entry['duration'], reverse=True)[:count]
+    lines = []
+    for entry in entries:
+        label = entry['attributes'].get('command', entry['name'])
+        spans = entry['spans']
+        # Innermost spans only, so the answer is e.g. a send or a query rather than the handler around it
+        leaves = [s for i, s in enumerate(spans) if i + 1 == len(spans) or spans[i + 1][3] <= s[3]]
+        slowest_span = max(leaves, key=lambda s: s[2], default=None)
+        detail = f" ({slowest_span[0]} {slowest_span[2] * 1000:.0f}ms)" if slowest_span else ""
+        lines.append(f"{label} {entry['duration'] * 1000:.0f}ms{detail}")
+    return lines
+
+
+class SamplingProfiler:
+    def __init__(self, interval=0.01, file='profile.folded'):
+        self.interval = interval
+        self.file = file
+        self.stacks = Counter()
+        self.samples = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def sample(self):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        own = threading.get_ident()
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{code.co_firstlineno})")
+                frame = frame.f_back
+            stack.append(names.get(thread_id, str(thread_id)))
+            with self._lock:
+                self.stacks[';'.join(reversed(stack))] += 1
+        self.samples += 1
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+        logging.info(f"Sampling profiler running every {self.interval * 1000:.0f}ms")
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        self.write()
+
+    def write(self, path=None):
+        path = path or self.file
+        with self._lock:
+            stacks = list(self.stacks.items())
+        with open(path, 'w') as file:
+            for stack, count in stacks:
+                file.write(f"{stack} {count}\n")
+        logging.info(f"Wrote {len(stacks)} sampled stacks ({self.samples} samples) to {path}")
@@ -1,38 +1,122 @@
 import logging
 import time
 
-user_states = {}
+from lora_airtime import airtime
+from metrics import registry
+from radio_pool import node_key
+from session_store import SessionStore
+from sync_framing import frame_message, join_fields, split_utf8
+from tracing import span, traced
 
+# Largest text payload sent to a node in one packet
+MAX_PAYLOAD_BYTES = 200
 
-def update_user_state(user_id, state):
-    user_states[user_id] = state
+# Seconds to wait after each packet so the radio can keep up
+SEND_INTERVAL = 2
 
+user_states = SessionStore()
 
-def get_user_state(user_id):
-    return user_states.get(user_id, None)
+packets_sent = registry.counter('bbs_packets_sent_total', "Packets sent, by port", ('port',))
+bytes_sent = registry.counter('bbs_bytes_sent_total', "Payload bytes sent, by port", ('port',))
+airtime_used = registry.counter('bbs_airtime_seconds_total', "Estimated time on air of sent packets", ('port',))
+sync_messages = registry.counter('bbs_sync_messages_total', "Sync messages, by peer and direction", ('peer', 'direction'))
+registry.gauge('bbs_sessions', "User sessions in memory", function=lambda: len(user_states))
+registry.gauge('bbs_session_bytes', "Estimated memory used by user sessions", function=lambda: user_states.total_bytes())
 
 
-def send_message(message, destination, interface):
-    max_payload_size = 200
-    for i in range(0, len(message), max_payload_size):
-        chunk = message[i:i + max_payload_size]
+def update_user_state(user_id, state):
+    user_states.set(user_id, state)
+
+
+def get_user_state(user_id):
+    return user_states.get(user_id)
+
+
+def append_user_content(user_id, text):
+    return user_states.append_content(user_id, text)
+
+
+def get_draft_limit():
+    return user_states.max_draft_bytes
+
+
+def pack_lines(header, lines, footer='', max_bytes=MAX_PAYLOAD_BYTES):
+    """
+    Joins the header, as many of `lines` as fit in max_bytes (UTF-8) and the footer.
+    Returns the text and how many lines were used; the first line is always used.
+    """
+    size = len(header.encode('utf-8'))
+    if footer:
+        size += len(footer.encode('utf-8')) + 1
+    count = 0
+    for line in lines:
+        line_size = len(line.encode('utf-8')) + 1
+        if count and size + line_size > max_bytes:
+            break
+        size += line_size
+        count += 1
+    parts = [header] + lines[:count]
+    if footer:
+        parts.append(footer)
+    return "\n".join(parts), count
+
+
+def split_payload(message, max_bytes=MAX_PAYLOAD_BYTES):
+    """
+    Splits a message into frames of at most max_bytes (UTF-8), breaking between lines where possible.
+    Always returns at least one frame, and blank lines are kept even where a frame ends.
+    """
+    frames = []
+    # None until the current frame has a line in it, so a blank first line still counts
+    frame = None
+    for line in message.split('\n'):
+        candidate = line if frame is None else f"{frame}\n{line}"
+        if len(candidate.encode('utf-8')) <= max_bytes:
+            frame = candidate
+            continue
+        if frame is not None:
+            frames.append(frame)
+        pieces = split_utf8(line.encode('utf-8'), max_bytes)
+        frames.extend(piece.decode('utf-8') for piece in pieces[:-1])
+        # A blank line that didn't fit starts the next frame
+        frame = pieces[-1].decode('utf-8') if pieces else ''
+    frames.append(frame)
+    return frames
+
+
+def send_frames(frames, destination, interface):
+    """Sends frames that are already payload-sized, one packet each."""
+    sent = True
+    for chunk in frames:
         try:
-            d = interface.sendText(
-                text=chunk,
-                destinationId=destination,
-                wantAck=True,
-                wantResponse=False
-            )
+            with span('sendText', bytes=len(chunk.encode('utf-8'))):
+                d = interface.sendText(
+                    text=chunk,
+                    destinationId=destination,
+                    wantAck=True,
+                    wantResponse=False
+                )
+            size = len(chunk.encode('utf-8'))
+            packets_sent.inc(port='TEXT_MESSAGE_APP')
+            bytes_sent.inc(size, port='TEXT_MESSAGE_APP')
+            airtime_used.inc(airtime(size), port='TEXT_MESSAGE_APP')
             destid = get_node_id_from_num(destination, interface)
             chunk = chunk.replace('\n', '\\n')
             logging.info(f"Sending message to user '{get_node_short_name(destid, interface)}' ({destid}) with sendID {d.id}: \"{chunk}\"")
         except Exception as e:
-            logging.info(f"REPLY SEND ERROR {e.message}")
+            logging.info(f"REPLY SEND ERROR {e}")
+            sent = False
+
+        with span('send sleep'):
+            time.sleep(SEND_INTERVAL)
+    return sent
 
-        
-        time.sleep(2)
+
+def send_message(message, destination, interface):
+    return send_frames(split_payload(message), destination, interface)
 
 
+@traced()
 def get_node_info(interface, short_name):
     nodes = [{'num': node_id, 'shortName': node['user']['shortName'], 'longName': node['user']['longName']}
              for node_id, node in interface.nodes.items()
@@ -40,6 +124,7 @@ def get_node_info(interface, short_name):
     return nodes
 
 
+@traced()
 def get_node_id_from_num(node_num, interface):
     for node_id, node in interface.nodes.items():
         if node['num'] == node_num:
@@ -47,6 +132,7 @@ def get_node_id_from_num(node_num, interface):
     return None
 
 
+@traced()
 def get_node_short_name(node_id, interface):
     node_info = interface.nodes.get(node_id)
     if node_info:
@@ -54,34 +140,53 @@ def get_node_short_name(node_id, interface):
     return None
 
 
-def send_bulletin_to_bbs_nodes(board, sender_short_name, subject, content, unique_id, bbs_nodes, interface):
-    message = f"BULLETIN|{board}|{sender_short_name}|{subject}|{content}|{unique_id}"
+def send_framed_message(message, destination, interface):
+    """Sends a sync message to a peer in as few frames as possible. Returns True if every frame was sent."""
+    sent = True
+    sync_messages.inc(peer=destination, direction='sent')
+    for frame in frame_message(message):
+        sent = send_message(frame, destination, interface) and sent
+    return sent
+
+
+def send_sync_message(message, bbs_nodes, interface):
+    """
+    Hands a sync message to the persistent outbox when one is attached, otherwise sends it right away.
+    Returns the message size in bytes so callers can budget airtime.
+    """
+    outbox = getattr(interface, 'outbox', None)
     for node_id in bbs_nodes:
-        send_message(message, node_id, interface)
+        if outbox is not None:
+            # The outbox matches peers against the node DB, which is keyed by '!1234abcd'
+            outbox.enqueue(node_key(node_id), message)
+        else:
+            send_framed_message(message, node_id, interface)
+    return len(message.encode('utf-8'))
+
+
+def send_bulletin_to_bbs_nodes(board, sender_short_name, subject, content, unique_id, bbs_nodes, interface):
+    message = join_fields("BULLETIN", board, sender_short_name, subject, content, unique_id)
+    return send_sync_message(message, bbs_nodes, interface)
 
 
 def send_mail_to_bbs_nodes(sender_id, sender_short_name, recipient_id, subject, content, unique_id, bbs_nodes,
                            interface):
-    message = f"MAIL|{sender_id}|{sender_short_name}|{recipient_id}|{subject}|{content}|{unique_id}"
+    message = join_fields("MAIL", sender_id, sender_short_name, recipient_id, subject, content, unique_id)
     logging.info(f"SERVER SYNC: Syncing new mail message {subject} sent from {sender_short_name} to other BBS systems.")
-    for node_id in bbs_nodes:
-        send_message(message, node_id, interface)
+    return send_sync_message(message, bbs_nodes, interface)
 
 
 def send_delete_bulletin_to_bbs_nodes(bulletin_id, bbs_nodes, interface):
-    message = f"DELETE_BULLETIN|{bulletin_id}"
-    for node_id in bbs_nodes:
-        send_message(message, node_id, interface)
+    message = join_fields("DELETE_BULLETIN", bulletin_id)
+    return send_sync_message(message, bbs_nodes, interface)
 
 
 def send_delete_mail_to_bbs_nodes(unique_id, bbs_nodes, interface):
-    message = f"DELETE_MAIL|{unique_id}"
+    message = join_fields("DELETE_MAIL", unique_id)
     logging.info(f"SERVER SYNC: Sending delete mail sync message with unique_id: {unique_id}")
-    for node_id in bbs_nodes:
-        send_message(message, node_id, interface)
+    return send_sync_message(message, bbs_nodes, interface)
 
 
 def send_channel_to_bbs_nodes(name, url, bbs_nodes, interface):
-    message = f"CHANNEL|{name}|{url}"
-    for node_id in bbs_nodes:
-        send_message(message, node_id, interface)
+    message = join_fields("CHANNEL", name, url)
+    return send_sync_message(message, bbs_nodes, interface)
@@ -0,0 +1,300 @@
+"""
+Command handling in worker processes, so a busy BBS can use more than one core.
+
+With [workers] count set, the server process becomes a thin radio gateway:
+it owns the radio (or radios), the sync outbox, reconciliation and JS8Call,
+and forwards every received text packet to one of `count` worker processes
+over a multiprocessing queue. Packets are partitioned by sender node number,
+so each user's session (and each peer's sync frames) always lands in the same
+worker, which runs the normal on_receive path against the shared database.
+
+Workers don't talk to the radio. Their replies come back to the gateway on
+a shared queue and are sent in order, paced by SEND_INTERVAL, on the radio
+the request arrived on. Sync messages for peers are written to the outbox
+table by the worker and sent by the gateway's SyncOutbox. Each worker keeps
+a copy of the node DB, refreshed every NODES_INTERVAL seconds and with the
+sender's entry on every packet.
+
+JS8Call listings and the HF relay live in the gateway and are not available
+to users while workers are enabled. Each worker's metrics and traces stay in
+that worker: TRACE answers with the traces of the admin's own worker, and
+SIGUSR1 only dumps the gateway's.
+"""
+
+import contextlib
+import copy
+import io
+import logging
+import multiprocessing
+import queue
+import signal
+import threading
+import time
+import types
+
+from db_operations import enqueue_outbox
+from utils import send_frames
+
+BROADCAST_ADDR = "^all"
+
+# Seconds between node DB snapshots sent to the workers
+NODES_INTERVAL = 60
+
+
+def partition(user_id, count):
+    """Returns the worker that handles a sender (a node number)."""
+    return int(user_id) % count
+
+
+class OutboxClient:
+    """Stands in for the SyncOutbox in a worker: queues sync messages in the database for the gateway to send."""
+
+    def __init__(self, replies, expiry=604800):
+        self._replies = replies
+        self.expiry = expiry
+
+    def enqueue(self, peer, message):
+        outbox_id = enqueue_outbox(peer, message, self.expiry)
+        logging.info(f"SERVER SYNC: Queued sync message {outbox_id} for {peer}")
+        self._replies.put(('wake',))
+        return outbox_id
+
+    def notify_heard(self, peer):
+        self._replies.put(('wake',))
+
+
+class WorkerInterface:
+    """The interface the message handlers see in a worker. Sends are handed back to the gateway."""
+
+    def __init__(self, replies, expiry):
+        self._replies = replies
+        self.nodes = {}
+        self.myInfo = types.SimpleNamespace(my_node_num=0)
+        self.bbs_nodes = []
+        self.allowed_nodes = []
+        self.outbox = OutboxClient(replies, expiry)
+        self.js8call_client = None
+        # Name of the radio the packet being handled arrived on, so replies go out there
+        self.radio = None
+
+    def sendText(self, text, destinationId=BROADCAST_ADDR, **kwargs):
+        self._replies.put(('send', self.radio, text, destinationId))
+        return types.SimpleNamespace(id='queued')
+
+
+def configure_worker(config_file, first=False):
+    from config_init import initialize_config
+    from fortune_provider import fortunes
+    from menus import compile_menus
+    import tracing
+    from session_journal import SessionJournal
+    from sync_delta import configure as configure_delta_sync
+    from utils import user_states
+
+    # initialize_config prints the peers and allow list, which the gateway has already shown
+    with contextlib.redirect_stdout(io.StringIO()):
+        system_config = initialize_config(config_file)
+    user_states.configure(
+        ttl=system_config['session_ttl'],
+        max_sessions=system_config['max_sessions'],
+        max_bytes=system_config['max_session_bytes'],
+        max_draft_bytes=system_config['max_draft_bytes'],
+        journal=SessionJournal() if first else None
+    )
+    compile_menus(system_config['config'])
+    fortunes.configure(system_config['fortune_files'])
+    tracing.configure(system_config['tracing_enabled'], system_config['trace_buffer'], system_config['trace_file'],
+                      system_config['trace_admins'])
+    configure_delta_sync(system_config['delta_batch_bytes'], system_config['delta_interval'])
+    return system_config
+
+
+def run_worker(index, count, config_file, inbox, replies):
+    """Entry point of a worker process."""
+    logging.basicConfig(
+        level=logging.INFO,
+        format=f'%(asctime)s - worker {index} - %(levelname)s - %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S',
+        force=True
+    )
+    # Ctrl-C and systemctl stop reach every process; the gateway stops the workers once it has stopped intake
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    import utils
+    from message_processing import on_receive
+    from utils import user_states
+
+    # The gateway paces what goes on air
+    utils.SEND_INTERVAL = 0
+
+    system_config = configure_worker(config_file, first=True)
+    restored = user_states.restore(keep=lambda user_id: partition(user_id, count) == index)
+    if restored:
+        logging.info(f"Restored {restored} user session(s) from the last run")
+    interface = WorkerInterface(replies, system_config['outbox_expiry'])
+
+    parent = multiprocessing.parent_process()
+    while True:
+        try:
+            item = inbox.get(timeout=1)
+        except queue.Empty:
+            if parent is not None and not parent.is_alive():
+                logging.error("Gateway exited, stopping")
+                break
+            continue
+        if item is None:
+            break
+
+        kind = item[0]
+        try:
+            if kind == 'packet':
+                _, packet, radio, sender_node = item
+                if sender_node is not None:
+                    interface.nodes[packet['fromId']] = sender_node
+                interface.radio = radio
+                on_receive(packet, interface)
+            elif kind == 'state':
+                _, interface.nodes, my_node_num, interface.bbs_nodes, interface.allowed_nodes = item
+                interface.myInfo = types.SimpleNamespace(my_node_num=my_node_num)
+            elif kind == 'reload':
+                system_config = configure_worker(config_file)
+                interface.outbox.expiry = system_config['outbox_expiry']
+        except Exception as e:
+            logging.error(f"Failed to handle {kind}: {e}")
+
+    saved = user_states.checkpoint()
+    logging.info(f"Stopped, saved {saved} user session(s)")
+
+
+class WorkerPool:
+    """Runs the worker processes from the gateway and sends their replies."""
+
+    def __init__(self, interface, count, config_file):
+        self.interface = interface
+        self.count = count
+        self.config_file = config_file
+
+        # Workers are spawned rather than forked so they don't inherit the radio's threads
+        self._context = multiprocessing.get_context('spawn')
+        self.replies = self._context.Queue()
+        self.inboxes = [self._context.Queue() for _ in range(count)]
+        self.processes = [None] * count
+        self._stop = threading.Event()
+        self._sender = None
+        self._syncer = None
+
+    def spawn(self, index):
+        process = self._context.Process(
+            target=run_worker,
+            args=(index, self.count, self.config_file, self.inboxes[index], self.replies),
+            name=f"bbs-worker-{index}",
+            daemon=True
+        )
+        process.start()
+        self.processes[index] = process
+        self.send_state(index)
+
+    def start(self):
+        for index in range(self.count):
+            self.spawn(index)
+        self._sender = threading.Thread(target=self.send_replies, name="worker-replies", daemon=True)
+        self._sender.start()
+        self._syncer = threading.Thread(target=self.sync_nodes, name="worker-nodes", daemon=True)
+        self._syncer.start()
+        logging.info(f"Handling messages in {self.count} worker processes")
+
+    def nodes_snapshot(self):
+        # Queues pickle on a background thread, so hand them a copy rather than the live node DB
+        for _ in range(3):
+            try:
+                return copy.deepcopy(self.interface.nodes)
+            except RuntimeError:
+                # Changed while being copied
+                continue
+        return {}
+
+    def send_state(self, index=None, nodes=None):
+        nodes = self.nodes_snapshot() if nodes is None else nodes
+        my_info = self.interface.myInfo
+        state = ('state', nodes, my_info.my_node_num if my_info else 0,
+                 list(self.interface.bbs_nodes), list(self.interface.allowed_nodes))
+        for inbox in (self.inboxes if index is None else [self.inboxes[index]]):
+            inbox.put(state)
+
+    def sync_nodes(self):
+        while not self._stop.wait(NODES_INTERVAL):
+            self.send_state()
+
+    def dispatch(self, packet, radio=None):
+        """Forwards a received text packet to the worker for its sender."""
+        decoded = packet.get('decoded')
+        if not decoded or decoded.get('portnum') != 'TEXT_MESSAGE_APP' or not packet.get('fromId'):
+            return
+        forwarded = {
+            'from': packet['from'],
+            'fromId': packet['fromId'],
+            'to': packet.get('to'),
+            'decoded': {'portnum': 'TEXT_MESSAGE_APP', 'payload': decoded['payload']}
+        }
+        sender_node = self.interface.nodes.get(packet['fromId'])
+        if sender_node is not None:
+            sender_node = copy.deepcopy(sender_node)
+        self.inboxes[partition(packet['from'], self.count)].put(('packet', forwarded, radio, sender_node))
+
+    def reload(self):
+        """Passes a config reload on to the workers."""
+        for inbox in self.inboxes:
+            inbox.put(('reload',))
+        self.send_state()
+
+    def check(self):
+        """Restarts any worker that has died."""
+        if self._stop.is_set():
+            return
+        for index, process in enumerate(self.processes):
+            if process is not None and not process.is_alive():
+                logging.error(f"Worker {index} exited with code {process.exitcode}, restarting it")
+                self.spawn(index)
+
+    def target(self, radio):
+        views = getattr(self.interface, 'views', None)
+        if radio and views:
+            for view in views:
+                if view.name == radio:
+                    return view
+        return self.interface
+
+    def send_replies(self):
+        while True:
+            try:
+                item = self.replies.get(timeout=1)
+            except queue.Empty:
+                if self._stop.is_set():
+                    return
+                continue
+            try:
+                if item[0] == 'send':
+                    _, radio, text, destination = item
+                    send_frames([text], destination, self.target(radio))
+                elif item[0] == 'wake':
+                    self.interface.outbox.wake()
+            except Exception as e:
+                logging.error(f"Failed to send a worker's reply: {e}")
+
+    def stop(self, timeout=0):
+        """
+        Stops the workers once they have handled what they were sent, then sends their remaining
+        replies, all within timeout seconds.
+        """
+        deadline = time.monotonic() + timeout
+        for inbox in self.inboxes:
+            inbox.put(None)
+        for index, process in enumerate(self.processes):
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                logging.warning(f"Worker {index} did not stop in time, terminating it")
+                process.terminate()
+        self._stop.set()
+        if self._sender:
+            self._sender.join(max(deadline - time.monotonic(), 0))